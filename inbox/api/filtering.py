@@ -1,3 +1,5 @@
+from collections import defaultdict
+
 from sqlalchemy import and_, or_, desc, asc, func, bindparam
 from sqlalchemy.orm import subqueryload, contains_eager
 from inbox.api.err import InputError
@@ -6,7 +8,7 @@ from inbox.models import (Contact, Event, Calendar, Message,
                           MessageContactAssociation, Thread,
                           Block, Part, MessageCategory, Category,
                           Metadata)
-from inbox.models.event import RecurringEvent
+from inbox.models.event import RecurringEvent, RecurringEventOverride
 from inbox.sqlalchemy_ext.util import bakery
 from inbox.ignition import engine_manager
 from inbox.models.session import session_scope_by_shard_id
@@ -463,15 +465,29 @@ def recurring_events(filters, starts_before, starts_after, ends_before,
 
     recur_query = recur_query.filter(and_(*after_criteria))
 
+    recur_events = recur_query.all()
+
+    # Load the overrides of all the matching events at once rather than
+    # once per event.
+    overrides = defaultdict(list)
+    if recur_events:
+        override_query = db_session.query(RecurringEventOverride).filter(
+            RecurringEventOverride.master_event_id.in_(
+                [r.id for r in recur_events]))
+        for o in override_query:
+            overrides[o.master_event_id].append(o)
+
     recur_instances = []
 
-    for r in recur_query:
+    for r in recur_events:
         # the occurrences check only checks starting timestamps
+        start, end = starts_after, starts_before
         if ends_before and not starts_before:
-            starts_before = ends_before - r.length
+            end = ends_before - r.length
         if ends_after and not starts_after:
-            starts_after = ends_after - r.length
-        instances = r.all_events(start=starts_after, end=starts_before)
+            start = ends_after - r.length
+        instances = r.all_events(start=start, end=end,
+                                 overrides=overrides[r.id])
         recur_instances.extend(instances)
 
     return recur_instances
@@ -557,23 +573,6 @@ def events(namespace_id, event_public_id, calendar_public_id, title,
         return all_events
 
 
-def messages_for_contact_scores(db_session, namespace_id, starts_after=None):
-    query = (db_session.query(
-        Message.to_addr, Message.cc_addr, Message.bcc_addr,
-        Message.id, Message.received_date.label('date'))
-        .join(MessageCategory.message)
-        .join(MessageCategory.category)
-        .filter(Message.namespace_id == namespace_id)
-        .filter(Category.name == 'sent')
-        .filter(~Message.is_draft)
-        .filter(Category.namespace_id == namespace_id))
-
-    if starts_after:
-        query = query.filter(Message.received_date > starts_after)
-
-    return query.all()
-
-
 def metadata(namespace_id, app_id, view, limit, offset,
              db_session):
 
@@ -4,7 +4,6 @@ import json
 import time
 import uuid
 import base64
-import gevent
 import itertools
 from hashlib import sha256
 from datetime import datetime
@@ -21,7 +20,7 @@ from sqlalchemy.orm import joinedload, load_only
 
 from inbox.models import (Message, Block, Part, Thread, Namespace,
                           Contact, Calendar, Event, Transaction,
-                          DataProcessingCache, Category, MessageCategory)
+                          Category, MessageCategory)
 from inbox.models.event import RecurringEvent, RecurringEventOverride
 from inbox.models.category import EPOCH
 from inbox.models.backends.generic import GenericAccount
@@ -41,9 +40,10 @@ from inbox.api.validation import (valid_account, get_attachments, get_calendar,
                                   comma_separated_email_list,
                                   get_sending_draft)
 from inbox.config import config
-from inbox.contacts.algorithms import (calculate_contact_scores,
-                                       calculate_group_scores,
-                                       calculate_group_counts, is_stale)
+from inbox.contacts.algorithms import contact_scores_from_state
+from inbox.contacts.scores import (get_data_processing_cache,
+                                   update_contact_score_state,
+                                   request_rebuild)
 import inbox.contacts.crud
 from inbox.contacts.search import ContactSearchClient
 from inbox.sendmail.base import (create_message_from_json, update_draft,
@@ -54,6 +54,7 @@ from inbox.models.action_log import schedule_action
 from inbox.models.session import new_session, session_scope
 from inbox.search.base import get_search_client, SearchBackendException, SearchStoreException
 from inbox.transactions import delta_sync
+from inbox.transactions.notifier import get_transaction_notifier
 from inbox.api.err import (err, APIException, NotFoundError, InputError,
                            AccountDoesNotExistError, log_exception)
 from inbox.events.ical import generate_rsvp, send_rsvp
@@ -79,7 +80,6 @@ log = get_logger()
 
 DEFAULT_LIMIT = 100
 LONG_POLL_REQUEST_TIMEOUT = 120
-LONG_POLL_POLL_INTERVAL = 1
 SEND_TIMEOUT = 60
 
 app = Blueprint(
@@ -1329,14 +1329,42 @@ def file_download_api(public_id):
             # HACK just append the major part of the content type
             name = 'attachment.{0}'.format(ct.split('/')[0])
 
-    # TODO the part.data object should really behave like a stream we can read
-    # & write to
+    account = g.namespace.account
+    statsd_string = 'api.direct_fetching.{}.{}'.format(account.provider,
+                                                       account.id)
     try:
-        account = g.namespace.account
-        statsd_string = 'api.direct_fetching.{}.{}'.format(account.provider,
-                                                           account.id)
-
-        response = make_response(f.data)
+        if f.is_pending:
+            # The attachment wasn't downloaded during sync. Fetch it first,
+            # so that its exact size is known.
+            if f.data is None:
+                raise NotFoundError("Couldn't find data for file {0}"
+                                    .format(public_id))
+            g.db_session.commit()
+
+        # Serve (a single) HTTP range of the file if requested. Multiple
+        # ranges aren't supported, in which case the whole file is returned.
+        status = 200
+        start, stop = 0, f.size
+        if request.range is not None and len(request.range.ranges) == 1:
+            byte_range = request.range.range_for_length(f.size)
+            if byte_range is None:
+                response = make_response('', 416)
+                response.headers['Content-Range'] = \
+                    'bytes */{}'.format(f.size)
+                return response
+            status = 206
+            start, stop = byte_range
+
+        # Stream the data so that large attachments aren't held in memory.
+        stream = f.stream_data(start, stop if status == 206 else None)
+        if stream is None:
+            raise NotFoundError("Couldn't find data for file {0}"
+                                .format(public_id))
+        response = Response(stream, status=status, direct_passthrough=True)
+        response.headers['Content-Length'] = stop - start
+        if status == 206:
+            response.headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+                start, stop - 1, f.size)
         statsd_client.incr('{}.successes'.format(statsd_string))
 
     except TemporaryEmailFetchException:
@@ -1362,6 +1390,7 @@ def file_download_api(public_id):
         return err(404, "Couldn't find data on email server.")
 
     response.headers['Content-Type'] = 'application/octet-stream'  # ct
+    response.headers['Accept-Ranges'] = 'bytes'
     # Werkzeug will try to encode non-ascii header values as latin-1. Try that
     # first; if it fails, use RFC2047/MIME encoding. See
     # https://tools.ietf.org/html/rfc7230#section-3.2.4.
@@ -1772,30 +1801,39 @@ def sync_deltas():
     # The client wants us to wait until there are changes
     g.db_session.expunge(g.namespace)
     g.db_session.close()  # hack to close the flask session
-    poll_interval = LONG_POLL_POLL_INTERVAL
 
-    start_time = time.time()
-    while time.time() - start_time < timeout:
-        with session_scope(g.namespace.id) as db_session:
-            deltas, _ = delta_sync.format_transactions_after_pointer(
-                g.namespace, start_pointer, db_session, args['limit'],
-                exclude_types, include_types, exclude_folders,
-                exclude_metadata, exclude_account, expand=expand)
-
-        response = {
-            'cursor_start': cursor,
-            'deltas': deltas,
-        }
-        if deltas:
-            response['cursor_end'] = deltas[-1]['cursor']
-            return g.encoder.jsonify(response)
-
-        # No changes. perhaps wait
-        elif '/delta/longpoll' in request.url_rule.rule:
-            gevent.sleep(poll_interval)
-        else:  # Return immediately
-            response['cursor_end'] = cursor
-            return g.encoder.jsonify(response)
+    # Rather than re-querying while the client waits, sleep until the
+    # transaction notifier reports changes for this namespace.
+    notifier = get_transaction_notifier()
+    notifier.watch(g.namespace.id)
+    try:
+        start_time = time.time()
+        while time.time() - start_time < timeout:
+            seen = notifier.latest_transaction_id(g.namespace.id)
+            with session_scope(g.namespace.id) as db_session:
+                deltas, _ = delta_sync.format_transactions_after_pointer(
+                    g.namespace, start_pointer, db_session, args['limit'],
+                    exclude_types, include_types, exclude_folders,
+                    exclude_metadata, exclude_account, expand=expand)
+
+            response = {
+                'cursor_start': cursor,
+                'deltas': deltas,
+            }
+            if deltas:
+                response['cursor_end'] = deltas[-1]['cursor']
+                return g.encoder.jsonify(response)
+
+            # No changes. perhaps wait
+            elif '/delta/longpoll' in request.url_rule.rule:
+                remaining = timeout - (time.time() - start_time)
+                if remaining > 0:
+                    notifier.wait(g.namespace.id, seen, remaining)
+            else:  # Return immediately
+                response['cursor_end'] = cursor
+                return g.encoder.jsonify(response)
+    finally:
+        notifier.unwatch(g.namespace.id)
 
     # If nothing happens until timeout, just return the end of the cursor
     response['cursor_end'] = cursor
@@ -1919,40 +1957,15 @@ def groups_intrinsic():
     g.parser.add_argument('force_recalculate', type=strict_bool,
                           location='args')
     args = strict_parse_args(g.parser, request.args)
-    try:
-        dpcache = g.db_session.query(DataProcessingCache).filter(
-            DataProcessingCache.namespace_id == g.namespace.id).one()
-    except NoResultFound:
-        dpcache = DataProcessingCache(namespace_id=g.namespace.id)
-
-    last_updated = dpcache.contact_groups_last_updated
-    cached_data = dpcache.contact_groups
-
-    use_cached_data = (not (is_stale(last_updated) or cached_data is None) and
-                       args['force_recalculate'] is not True)
-
-    if not use_cached_data:
-        last_updated = None
-
-    messages = filtering.messages_for_contact_scores(
-        g.db_session, g.namespace.id, last_updated)
-
-    from_email = g.namespace.email_address
+    dpcache = get_data_processing_cache(g.db_session, g.namespace.id)
 
-    if use_cached_data:
-        result = cached_data
-        new_guys = calculate_group_counts(messages, from_email)
-        for k, v in new_guys.items():
-            if k in result:
-                result[k] += v
-            else:
-                result[k] = v
-    else:
-        result = calculate_group_scores(messages, from_email)
-        dpcache.contact_groups = result
-        g.db_session.add(dpcache)
-        g.db_session.commit()
+    # Groups are computed by the contact scores service; serve what's cached,
+    # even if stale, and leave the first build or any rebuild to it.
+    if args['force_recalculate'] is True:
+        request_rebuild(dpcache)
+    g.db_session.commit()
 
+    result = dpcache.contact_groups or {}
     result = sorted(result.items(), key=lambda x: x[1], reverse=True)
     return g.encoder.jsonify(result)
 
@@ -1962,37 +1975,24 @@ def contact_rankings():
     g.parser.add_argument('force_recalculate', type=strict_bool,
                           location='args')
     args = strict_parse_args(g.parser, request.args)
-    try:
-        dpcache = g.db_session.query(DataProcessingCache).filter(
-            DataProcessingCache.namespace_id == g.namespace.id).one()
-    except NoResultFound:
-        dpcache = DataProcessingCache(namespace_id=g.namespace.id)
-
-    last_updated = dpcache.contact_rankings_last_updated
-    cached_data = dpcache.contact_rankings
+    dpcache = get_data_processing_cache(g.db_session, g.namespace.id)
 
-    use_cached_data = (not (is_stale(last_updated) or cached_data is None) and
-                       args['force_recalculate'] is not True)
-
-    if not use_cached_data:
-        last_updated = None
-
-    messages = filtering.messages_for_contact_scores(
-        g.db_session, g.namespace.id, last_updated)
-
-    if use_cached_data:
-        new_guys = calculate_contact_scores(messages, time_dependent=False)
-        result = cached_data
-        for k, v in new_guys.items():
-            if k in result:
-                result[k] += v
-            else:
-                result[k] = v
-    else:
-        result = calculate_contact_scores(messages)
-        dpcache.contact_rankings = result
-        g.db_session.add(dpcache)
+    if args['force_recalculate'] is True or \
+            dpcache.contact_score_state is None:
+        # Leave (re)building the score state to the contact scores service,
+        # and serve the cached rankings meanwhile.
+        request_rebuild(dpcache)
         g.db_session.commit()
+        result = dpcache.contact_rankings or {}
+    else:
+        # Only count the messages sent since the state was last updated,
+        # and apply the time decay to the counts.
+        state, changed = update_contact_score_state(
+            g.db_session, dpcache, g.namespace.email_address)
+        result = contact_scores_from_state(state)
+        if changed or dpcache.contact_rankings is None:
+            dpcache.contact_rankings = result
+            g.db_session.commit()
 
     result = sorted(result.items(), key=lambda x: x[1], reverse=True)
     return g.encoder.jsonify(result)
@@ -10,6 +10,12 @@ and the groups/intrinsic endpoint.
 LOOKBACK_TIME = 63072000.0  # datetime.timedelta(days=2*365).total_seconds()
 MIN_MESSAGE_WEIGHT = .01
 
+# For score states. Messages are counted per day they were sent on (a date
+# ordinal); the counts of days older than LOOKBACK_DAYS all have
+# MIN_MESSAGE_WEIGHT and are merged into the EXPIRED_DAY bucket.
+LOOKBACK_DAYS = int(LOOKBACK_TIME / 86400)
+EXPIRED_DAY = 0
+
 # For calculate_group_scores
 MIN_GROUP_SIZE = 2
 MIN_MESSAGE_COUNT = 2.5  # Might want to tune this param. (1.5, 2.5?)
@@ -31,6 +37,18 @@ def _get_message_weight(now, message_date):
     return max(weight, MIN_MESSAGE_WEIGHT)
 
 
+def _get_day_weight(today, day):
+    if day == EXPIRED_DAY:
+        return MIN_MESSAGE_WEIGHT
+    weight = 1 - ((today - day) * 86400 / LOOKBACK_TIME)
+    return max(weight, MIN_MESSAGE_WEIGHT)
+
+
+def _get_bucket_weight(today, buckets):
+    return sum([count * _get_day_weight(today, int(day))
+                for day, count in buckets.iteritems()])
+
+
 def _jaccard_similarity(set1, set2):
     return len(set1.intersection(set2)) / float(len(set1.union(set2)))
 
@@ -96,19 +114,30 @@ def calculate_group_scores(messages, user_email):
         date - datetime.datetime object
     """
     now = datetime.datetime.now()
-    message_ids_to_scores = {}
-    molecules_dict = defaultdict(set)  # (emails, ...) -> {message ids, ...}
-
-    def get_message_list_weight(message_ids):
-        return sum([message_ids_to_scores[m_id] for m_id in message_ids])
-
-    # Gather initial candidate social molecules
+    seed_weights = defaultdict(float)
     for msg in messages:
         participants = _get_participants(msg, [user_email])
         if len(participants) >= MIN_GROUP_SIZE:
-            molecules_dict[tuple(participants)].add(msg.id)
-            message_ids_to_scores[msg.id] = \
+            seed_weights[tuple(participants)] += \
                 _get_message_weight(now, msg.date)
+    return _calculate_group_scores(seed_weights)
+
+
+def _calculate_group_scores(seed_weights):
+    """seed_weights maps the participants of each message, as a sorted
+    tuple, to the summed weight of the messages sent to exactly them.
+
+    Every message belongs to exactly one of these initial molecules, so
+    molecules keep track of the seeds they're made of rather than of
+    individual messages.
+    """
+    # (emails, ...) -> {seeds, ...}
+    molecules_dict = defaultdict(set)
+    for seed in seed_weights:
+        molecules_dict[seed].add(seed)
+
+    def get_message_list_weight(seeds):
+        return sum([seed_weights[seed] for seed in seeds])
 
     if len(molecules_dict) > SOCIAL_MOLECULE_LIMIT:
         return {}  # Not worth the calculation
@@ -134,6 +163,68 @@ def calculate_group_scores(messages, user_email):
             for (g, m) in molecules_list}
 
 
+##
+# Incrementally maintained scores. A score state holds the number of sent
+# messages per day for each recipient ('contacts') and for each distinct
+# list of participants ('groups'), so that new messages can be added to it
+# as they're synced and the time decay only gets applied when reading
+# scores out of it. States are JSON-serializable.
+##
+
+def new_score_state():
+    return {'contacts': {}, 'groups': {}}
+
+
+def add_to_score_state(state, messages, user_email):
+    """ Count the given sent messages (see calculate_group_scores for the
+    properties they must have) in state.
+    """
+    for msg in messages:
+        day = str(msg.date.toordinal())
+        recipients = msg.to_addr + msg.cc_addr + msg.bcc_addr
+        for (name, email) in recipients:
+            buckets = state['contacts'].setdefault(email, {})
+            buckets[day] = buckets.get(day, 0) + 1
+        participants = _get_participants(msg, [user_email])
+        if len(participants) >= MIN_GROUP_SIZE:
+            buckets = state['groups'].setdefault(', '.join(participants), {})
+            buckets[day] = buckets.get(day, 0) + 1
+
+
+def expire_score_state(state, now=None):
+    """ Merge the counts of days past the lookback time, which no longer
+    decay, into the EXPIRED_DAY bucket. Returns whether state changed.
+    """
+    today = (now or datetime.datetime.now()).toordinal()
+    changed = False
+    for scores in state.itervalues():
+        for buckets in scores.itervalues():
+            expired = [day for day in buckets if int(day) != EXPIRED_DAY and
+                       today - int(day) >= LOOKBACK_DAYS]
+            if expired:
+                count = sum([buckets.pop(day) for day in expired])
+                key = str(EXPIRED_DAY)
+                buckets[key] = buckets.get(key, 0) + count
+                changed = True
+    return changed
+
+
+def contact_scores_from_state(state, now=None):
+    """ Same as calculate_contact_scores, from a score state. """
+    today = (now or datetime.datetime.now()).toordinal()
+    return {email: _get_bucket_weight(today, buckets)
+            for email, buckets in state['contacts'].iteritems()}
+
+
+def group_scores_from_state(state, now=None):
+    """ Same as calculate_group_scores, from a score state. """
+    today = (now or datetime.datetime.now()).toordinal()
+    seed_weights = {tuple(group.split(', ')): _get_bucket_weight(today,
+                                                                  buckets)
+                    for group, buckets in state['groups'].iteritems()}
+    return _calculate_group_scores(seed_weights)
+
+
 # Helper functions for calculating group scores
 def _expand_molecule_pool(molecules_dict):
     mditems = [(set(g), msgs) for (g, msgs) in molecules_dict.items()]
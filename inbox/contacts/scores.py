@@ -0,0 +1,142 @@
+"""
+Incrementally maintained contact rankings and intrinsic groups.
+
+The sent messages of a namespace are counted in a score state (see
+inbox.contacts.algorithms) kept in its DataProcessingCache, along with the
+id of the last message counted. Only messages synced since then need to be
+read to bring the state up to date, and the time decay is applied when
+rankings and groups are computed from it.
+
+Messages which become sent after they're counted (e.g. drafts sent through
+the API) are picked up when the state is rebuilt from scratch, every
+STATE_LIFESPAN days.
+
+States are built, rebuilt and turned into groups by the contact scores
+service (inbox/transactions/contact_scores.py), never in API requests: the
+API only serves what's cached, and flags namespaces which need a (re)build,
+see request_rebuild().
+
+"""
+import datetime
+
+from sqlalchemy import or_
+from sqlalchemy.orm.exc import NoResultFound
+
+from inbox.contacts.algorithms import (new_score_state, add_to_score_state,
+                                       expire_score_state, is_stale)
+from inbox.models import (DataProcessingCache, Message, MessageCategory,
+                          Category)
+
+# Number of messages read per query when updating a score state.
+CHUNK_SIZE = 1000
+# Days after which score states get rebuilt.
+STATE_LIFESPAN = 14
+# Groups are recomputed in the background at most this often.
+GROUPS_REFRESH_INTERVAL = datetime.timedelta(hours=1)
+
+
+def get_data_processing_cache(db_session, namespace_id):
+    try:
+        return db_session.query(DataProcessingCache).filter(
+            DataProcessingCache.namespace_id == namespace_id).one()
+    except NoResultFound:
+        dpcache = DataProcessingCache(namespace_id=namespace_id)
+        db_session.add(dpcache)
+        return dpcache
+
+
+def messages_for_contact_scores(db_session, namespace_id, starts_after=None,
+                                after_id=None, limit=None):
+    query = (db_session.query(
+        Message.to_addr, Message.cc_addr, Message.bcc_addr,
+        Message.id, Message.received_date.label('date'))
+        .join(MessageCategory.message)
+        .join(MessageCategory.category)
+        .filter(Message.namespace_id == namespace_id)
+        .filter(Category.name == 'sent')
+        .filter(~Message.is_draft)
+        .filter(Category.namespace_id == namespace_id))
+
+    if starts_after:
+        query = query.filter(Message.received_date > starts_after)
+
+    if after_id is not None:
+        query = query.filter(Message.id > after_id).order_by(Message.id)
+
+    if limit:
+        query = query.limit(limit)
+
+    return query.all()
+
+
+def update_contact_score_state(db_session, dpcache, user_email,
+                               rebuild=False):
+    """
+    Count the sent messages of dpcache's namespace which aren't counted in
+    its score state yet, or all of them if rebuild is True or the state
+    doesn't exist. Doesn't commit.
+
+    Returns
+    -------
+    (dict, bool)
+        The score state, and whether it changed.
+
+    """
+    state = dpcache.contact_score_state
+    if rebuild or state is None:
+        state = new_score_state()
+        last_id = 0
+        dpcache.contact_score_state_rebuilt_at = datetime.datetime.now()
+        changed = True
+    else:
+        last_id = dpcache.contact_score_state_message_id or 0
+        changed = False
+
+    while True:
+        messages = messages_for_contact_scores(
+            db_session, dpcache.namespace_id, after_id=last_id,
+            limit=CHUNK_SIZE)
+        if not messages:
+            break
+        add_to_score_state(state, messages, user_email)
+        last_id = messages[-1].id
+        changed = True
+        if len(messages) < CHUNK_SIZE:
+            break
+
+    changed = expire_score_state(state) or changed
+    if changed:
+        dpcache.contact_score_state = state
+        dpcache.contact_score_state_message_id = last_id
+    return state, changed
+
+
+def score_state_is_stale(dpcache):
+    return is_stale(dpcache.contact_score_state_rebuilt_at, STATE_LIFESPAN)
+
+
+def groups_need_refresh(dpcache):
+    last_updated = dpcache.contact_groups_last_updated
+    return (last_updated is None or
+            datetime.datetime.now() - last_updated > GROUPS_REFRESH_INTERVAL)
+
+
+def request_rebuild(dpcache):
+    """
+    Have the contact scores service rebuild dpcache's score state and
+    groups on its next pass. Doesn't commit.
+
+    """
+    dpcache.contact_score_state_rebuilt_at = None
+
+
+def namespaces_needing_update(db_session):
+    """
+    Ids of the namespaces whose score state or groups were never built, or
+    whose rebuild was requested.
+
+    """
+    return [namespace_id for namespace_id, in db_session.query(
+        DataProcessingCache.namespace_id).filter(or_(
+            DataProcessingCache.contact_score_state_rebuilt_at.is_(None),
+            DataProcessingCache._contact_groups.is_(None)))]
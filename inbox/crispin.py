@@ -35,6 +35,7 @@ from sqlalchemy.orm import joinedload
 from inbox.util.concurrency import retry
 from inbox.util.itert import chunk
 from inbox.util.misc import or_none
+from inbox.util.bodystructure import MessageSkeleton, UnsupportedStructure
 from inbox.basicauth import GmailSettingError
 from inbox.models.session import session_scope
 from inbox.models.backends.imap import ImapAccount
@@ -52,9 +53,12 @@ Flags = namedtuple('Flags', 'flags modseq')
 # Flags includes labels on Gmail because Gmail doesn't use \Draft.
 GmailFlags = namedtuple('GmailFlags', 'flags labels modseq')
 GMetadata = namedtuple('GMetadata', 'g_msgid g_thrid size')
+# deferred_sections: for messages downloaded without their attachments, a
+# dict mapping the IMAP sections of the parts left out to their approximate
+# size, see CrispinClient.uids_without_attachments(). None otherwise.
 RawMessage = namedtuple(
     'RawImapMessage',
-    'uid internaldate flags body g_thrid g_msgid g_labels')
+    'uid internaldate flags body g_thrid g_msgid g_labels deferred_sections')
 RawFolder = namedtuple('RawFolder', 'display_name role')
 
 # Lazily-initialized map of account ids to lock objects.
@@ -233,9 +237,12 @@ class CrispinConnectionPool(object):
 
     def _new_connection(self):
         conn = self._new_raw_connection()
-        return self.client_cls(self.account_id, self.provider_info,
-                               self.email_address, conn,
-                               readonly=self.readonly)
+        client = self.client_cls(self.account_id, self.provider_info,
+                                 self.email_address, conn,
+                                 readonly=self.readonly)
+        # QRESYNC can only be enabled before the first folder is selected.
+        client.enable_qresync()
+        return client
 
 
 def _exc_callback(exc):
@@ -297,6 +304,7 @@ class CrispinClient(object):
         self._folder_names = None
         self.conn = conn
         self.readonly = readonly
+        self.qresync_enabled = False
 
     def _fetch_folder_list(self):
         """ NOTE: XLIST is deprecated, so we just use LIST.
@@ -609,6 +617,33 @@ class CrispinClient(object):
         capabilities = self.conn.capabilities()
         return 'CONDSTORE' in capabilities or 'QRESYNC' in capabilities
 
+    def qresync_supported(self):
+        return 'QRESYNC' in self.conn.capabilities()
+
+    def enable_qresync(self):
+        """
+        Enable QRESYNC (RFC 7162) for this connection if the server supports
+        it. Must be called before any folder is selected.
+
+        Returns
+        -------
+        bool
+            Whether QRESYNC is enabled.
+
+        """
+        if self.qresync_enabled:
+            return True
+        if self.selected_folder is not None or not self.qresync_supported():
+            return False
+        try:
+            enabled = self.conn.enable('QRESYNC')
+        except imapclient.IMAPClient.Error as e:
+            log.info('Error enabling QRESYNC', account_id=self.account_id,
+                     error=str(e))
+            return False
+        self.qresync_enabled = 'QRESYNC' in enabled
+        return self.qresync_enabled
+
     def idle_supported(self):
         return 'IDLE' in self.conn.capabilities()
 
@@ -660,8 +695,109 @@ class CrispinClient(object):
     def uids(self, uids):
         uid_set = set(uids)
         messages = []
-        raw_messages = {}
+        raw_messages = None
 
+        if len(uid_set) > 1:
+            # Fetch the whole batch in a single round trip. Some servers fail
+            # the entire FETCH if just one of the messages is broken, so fall
+            # back to fetching one UID at a time in that case.
+            try:
+                raw_messages = self.conn.fetch(
+                    sorted(uid_set), ['BODY.PEEK[]', 'INTERNALDATE', 'FLAGS'])
+            except imapclient.IMAPClient.Error as e:
+                log.info('Got an exception while requesting a batch of UIDs, '
+                         'retrying one UID at a time',
+                         uid_count=len(uid_set), error=e,
+                         logstash_tag='imap_download_exception')
+
+        if raw_messages is None:
+            raw_messages = self._fetch_uids_individually(uid_set)
+
+        for uid in sorted(raw_messages.iterkeys(), key=long):
+            # Skip handling unsolicited FETCH responses
+            if uid not in uid_set:
+                continue
+            msg = raw_messages[uid]
+            if msg.keys() == ['SEQ']:
+                log.error('No data returned for UID, skipping', uid=uid)
+                continue
+
+            messages.append(self._raw_message(uid, msg, msg['BODY[]']))
+        return messages
+
+    # FETCH items of the message attributes _raw_message() needs.
+    RAW_MESSAGE_ITEMS = ['INTERNALDATE', 'FLAGS']
+
+    def _raw_message(self, uid, msg, body, deferred_sections=None):
+        return RawMessage(uid=long(uid),
+                          internaldate=msg['INTERNALDATE'],
+                          flags=msg['FLAGS'],
+                          body=body,
+                          # TODO: use data structure that isn't
+                          # Gmail-specific
+                          g_thrid=None, g_msgid=None,
+                          g_labels=None,
+                          deferred_sections=deferred_sections)
+
+    def uids_without_attachments(self, uids):
+        """
+        Like uids(), but without downloading the bodies of attachments: only
+        the headers and text parts of the messages are fetched, guided by
+        their BODYSTRUCTURE, and reassembled into skeleton messages (see
+        inbox.util.bodystructure). The sections left out are listed in the
+        deferred_sections of the returned messages.
+
+        Messages which can't be reassembled that way are downloaded in full
+        with uids().
+
+        """
+        uid_set = set(uids)
+        structures = self.conn.fetch(
+            sorted(uid_set),
+            ['BODYSTRUCTURE', 'BODY.PEEK[HEADER]'] + self.RAW_MESSAGE_ITEMS)
+
+        skeletons = {}
+        full_uids = []
+        for uid, msg in structures.iteritems():
+            # Skip handling unsolicited FETCH responses
+            if uid not in uid_set or 'BODYSTRUCTURE' not in msg:
+                continue
+            try:
+                skeletons[uid] = MessageSkeleton(msg['BODYSTRUCTURE'])
+            except UnsupportedStructure:
+                full_uids.append(uid)
+
+        # Messages with the same structure need the same FETCH items: fetch
+        # their parts together.
+        uids_by_items = defaultdict(list)
+        for uid, skeleton in skeletons.iteritems():
+            uids_by_items[tuple(skeleton.fetch_items)].append(uid)
+        parts = {}
+        for items, item_uids in uids_by_items.iteritems():
+            for uid_chunk in chunk(sorted(item_uids), 100):
+                parts.update(self.conn.fetch(uid_chunk, list(items)))
+
+        messages = []
+        for uid in sorted(skeletons, key=long):
+            skeleton = skeletons[uid]
+            msg = structures[uid]
+            try:
+                body = skeleton.assemble(msg['BODY[HEADER]'],
+                                         parts.get(uid, {}))
+            except UnsupportedStructure as e:
+                log.info('Could not reassemble message, downloading it in '
+                         'full', uid=uid, error=str(e))
+                full_uids.append(uid)
+                continue
+            messages.append(self._raw_message(uid, msg, body,
+                                              skeleton.deferred_sections))
+
+        if full_uids:
+            messages.extend(self.uids(full_uids))
+        return sorted(messages, key=lambda m: m.uid)
+
+    def _fetch_uids_individually(self, uid_set):
+        raw_messages = {}
         for uid in uid_set:
             try:
                 raw_messages.update(self.conn.fetch(
@@ -679,25 +815,22 @@ class CrispinClient(object):
                              uid=uid, error=e,
                              logstash_tag='imap_download_exception')
                     raise
+        return raw_messages
 
-        for uid in sorted(raw_messages.iterkeys(), key=long):
-            # Skip handling unsolicited FETCH responses
-            if uid not in uid_set:
-                continue
-            msg = raw_messages[uid]
-            if msg.keys() == ['SEQ']:
-                log.error('No data returned for UID, skipping', uid=uid)
-                continue
+    def uid_sizes(self, uids):
+        """
+        Message sizes for the given UIDs, used to size download batches.
 
-            messages.append(RawMessage(uid=long(uid),
-                                       internaldate=msg['INTERNALDATE'],
-                                       flags=msg['FLAGS'],
-                                       body=msg['BODY[]'],
-                                       # TODO: use data structure that isn't
-                                       # Gmail-specific
-                                       g_thrid=None, g_msgid=None,
-                                       g_labels=None))
-        return messages
+        Returns
+        -------
+        dict
+            Mapping of `uid` (long) : RFC822.SIZE in bytes (int)
+
+        """
+        data = self.conn.fetch(uids, ['RFC822.SIZE'])
+        uid_set = set(uids)
+        return {uid: ret['RFC822.SIZE'] for uid, ret in data.items()
+                if uid in uid_set and 'RFC822.SIZE' in ret}
 
     def flags(self, uids):
         if len(uids) > 100:
@@ -751,6 +884,18 @@ class CrispinClient(object):
         return self.conn.append(self.selected_folder_name, message, ['\\Seen'],
                                 date)
 
+    def fetch_section(self, uid, section):
+        """
+        Fetch the body of a single MIME part of the message with the given
+        uid, e.g. section '2.1', still transfer-encoded. Returns None if the
+        message doesn't exist.
+
+        """
+        response = self.conn.fetch([uid], ['BODY.PEEK[{}]'.format(section)])
+        if uid not in response:
+            return None
+        return response[uid].get('BODY[{}]'.format(section))
+
     def fetch_headers(self, uids):
         """
         Fetch headers for the given uids. Chunked because certain providers
@@ -868,10 +1013,53 @@ class CrispinClient(object):
                            if 'MODSEQ' in ret else None)
                 for uid, ret in data.items()}
 
+    def qresync_changes(self, modseq):
+        """
+        Flags changed and UIDs expunged in the selected folder since `modseq`,
+        in a single UID FETCH ... (CHANGEDSINCE <modseq> VANISHED) round trip.
+        Requires QRESYNC to be enabled.
+
+        Returns
+        -------
+        (dict, list)
+            Mapping of `uid` : Flags for the changed messages, and the
+            expunged UIDs as a list of inclusive (first, last) ranges. Servers
+            may report UIDs which never existed in the folder.
+
+        """
+        assert self.qresync_enabled, 'QRESYNC is not enabled'
+        changed_flags = self.conn.fetch(
+            '1:*', ['FLAGS'],
+            modifiers=['CHANGEDSINCE {}'.format(modseq), 'VANISHED'])
+        changed_flags = {uid: Flags(ret['FLAGS'], ret['MODSEQ'][0]
+                                    if 'MODSEQ' in ret else None)
+                         for uid, ret in changed_flags.items()}
+        return changed_flags, self._pop_vanished_uids()
+
+    def _pop_vanished_uids(self):
+        # IMAPClient only returns the FETCH responses, leaving the
+        # `* VANISHED (EARLIER) 300:310,405` responses in the underlying
+        # imaplib connection. Unsolicited VANISHED responses received since
+        # the folder was selected are expunges too, so consume them all.
+        responses = self.conn._imap.untagged_responses.pop('VANISHED', [])
+        uid_ranges = []
+        for response in responses:
+            uid_set = response.split()[-1]
+            for item in uid_set.split(','):
+                first, _, last = item.partition(':')
+                first, last = long(first), long(last or first)
+                uid_ranges.append((min(first, last), max(first, last)))
+        return uid_ranges
+
 
 class GmailCrispinClient(CrispinClient):
     PROVIDER = 'gmail'
 
+    def qresync_supported(self):
+        # Gmail doesn't advertise QRESYNC, and qresync_changes() doesn't
+        # fetch labels.
+        return False
+
     def sync_folders(self):
         """
         Gmail-specific list of folders to sync.
@@ -1043,16 +1231,22 @@ class GmailCrispinClient(CrispinClient):
             if uid not in uid_set:
                 continue
             msg = raw_messages[uid]
-            messages.append(
-                RawMessage(uid=long(uid),
-                           internaldate=msg['INTERNALDATE'],
-                           flags=msg['FLAGS'],
-                           body=msg['BODY[]'],
-                           g_thrid=long(msg['X-GM-THRID']),
-                           g_msgid=long(msg['X-GM-MSGID']),
-                           g_labels=self._decode_labels(msg['X-GM-LABELS'])))
+            messages.append(self._raw_message(uid, msg, msg['BODY[]']))
         return messages
 
+    RAW_MESSAGE_ITEMS = ['INTERNALDATE', 'FLAGS', 'X-GM-THRID', 'X-GM-MSGID',
+                         'X-GM-LABELS']
+
+    def _raw_message(self, uid, msg, body, deferred_sections=None):
+        return RawMessage(uid=long(uid),
+                          internaldate=msg['INTERNALDATE'],
+                          flags=msg['FLAGS'],
+                          body=body,
+                          g_thrid=long(msg['X-GM-THRID']),
+                          g_msgid=long(msg['X-GM-MSGID']),
+                          g_labels=self._decode_labels(msg['X-GM-LABELS']),
+                          deferred_sections=deferred_sections)
+
     def g_metadata(self, uids):
         """
         Download Gmail MSGIDs, THRIDs, and message sizes for the given uids.
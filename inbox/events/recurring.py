@@ -1,9 +1,14 @@
+from array import array
+from bisect import bisect_left, bisect_right
+
 import arrow
 from dateutil.rrule import (rrulestr, rrule, rruleset,
                             MO, TU, WE, TH, FR, SA, SU)
 
+from inbox.config import config
 from inbox.models.event import RecurringEvent, RecurringEventOverride
 from inbox.events.util import parse_rrule_datetime
+from inbox.util.lru import LRUCache
 from timezones import timezones_table
 
 from nylas.logging import get_logger
@@ -12,6 +17,22 @@ log = get_logger()
 # How far in the future to expand recurring events
 EXPAND_RECURRING_YEARS = 1
 
+# Occurrence indexes are materialised from this far in the past to this far
+# beyond the default expansion horizon, so that they keep answering the
+# usual queries as time passes.
+OCCURRENCE_INDEX_LOOKBACK_YEARS = 1
+OCCURRENCE_INDEX_MARGIN_DAYS = 31
+# Upper bound on the number of occurrences materialised per event; queries
+# outside a truncated index are expanded directly.
+MAX_INDEXED_OCCURRENCES = 5000
+
+# The cache is bounded by the total number of occurrences it holds
+# (8 bytes each).
+_occurrence_cache = LRUCache(
+    config.get('RECURRING_EVENT_CACHE_MAX_EVENTS', 10000),
+    max_size=config.get('RECURRING_EVENT_CACHE_MAX_OCCURRENCES', 2000000),
+    sizeof=len)
+
 
 def link_events(db_session, event):
     if isinstance(event, RecurringEvent):
@@ -52,6 +73,55 @@ def link_master(db_session, event):
     return event.master  # This may be None.
 
 
+def link_event_batch(db_session, events):
+    """
+    Link the given recurring events and overrides, which must all belong to
+    the same namespace and calendar, like link_events does for each of them,
+    with one query per kind of event.
+
+    """
+    masters = {}
+    overrides = []
+    for event in events:
+        if isinstance(event, RecurringEvent):
+            masters.setdefault((event.uid, event.source), event)
+        elif isinstance(event, RecurringEventOverride) and \
+                event.master_event_uid and event.master_event_id is None:
+            overrides.append(event)
+    if not masters and not overrides:
+        return
+    namespace_id = events[0].namespace_id
+    calendar_id = events[0].calendar_id
+
+    # Find the overrides of the masters which aren't linked yet.
+    if masters:
+        unlinked = db_session.query(RecurringEventOverride).filter(
+            RecurringEventOverride.namespace_id == namespace_id,
+            RecurringEventOverride.calendar_id == calendar_id,
+            RecurringEventOverride.master_event_uid.in_(
+                {uid for uid, _ in masters}),
+            RecurringEventOverride.master_event_id.is_(None))
+        for o in unlinked:
+            master = masters.get((o.master_event_uid, o.source))
+            if master is not None:
+                o.master = master
+
+    # Find the masters of the overrides, which may not exist if they haven't
+    # been synced yet.
+    overrides = [o for o in overrides if o.master is None]
+    if overrides:
+        master_uids = {o.master_event_uid for o in overrides}
+        for master in db_session.query(RecurringEvent).filter(
+                RecurringEvent.namespace_id == namespace_id,
+                RecurringEvent.calendar_id == calendar_id,
+                RecurringEvent.uid.in_(master_uids)):
+            masters.setdefault((master.uid, master.source), master)
+        for o in overrides:
+            master = masters.get((o.master_event_uid, o.source))
+            if master is not None:
+                o.master = master
+
+
 def parse_rrule(event):
     # Parse the RRULE string and return a dateutil.rrule.rrule object
     if event.rrule is not None:
@@ -88,6 +158,112 @@ def parse_exdate(event):
     return excl_dates
 
 
+def _parse_rrules(event):
+    # Parse the RRULE and EXDATE of an event into a single rule object.
+    rrules = parse_rrule(event)
+    if not rrules:
+        return None
+
+    excl_dates = parse_exdate(event)
+
+    if len(excl_dates) > 0:
+        if not isinstance(rrules, rruleset):
+            rrules = rruleset().rrule(rrules)
+
+        # We want naive-everything for all-day events.
+        if event.all_day:
+            excl_dates = map(lambda x: x.naive, excl_dates)
+        map(rrules.exdate, excl_dates)
+    return rrules
+
+
+def _rrule_time(event, t):
+    # compare naive times for all-day events, since date handling in
+    # rrulestr is naive when UNTIL takes the form YYYYMMDD
+    if event.all_day:
+        return t.to('utc').naive
+    return t
+
+
+class OccurrenceIndex(object):
+    """
+    The start times of a recurring event's instances within a window,
+    materialised as a sorted array of UTC timestamps.
+
+    `window_start` is None if the window starts with the event itself, and
+    `window_end` is None if the rule has no more occurrences after the
+    window.
+
+    """
+
+    def __init__(self, starts, window_start, window_end):
+        self.starts = array('d', starts)
+        self.window_start = window_start
+        self.window_end = window_end
+
+    def __len__(self):
+        return len(self.starts)
+
+    def covers(self, start, end):
+        return ((self.window_start is None or
+                 start.float_timestamp >= self.window_start) and
+                (self.window_end is None or
+                 end.float_timestamp <= self.window_end))
+
+    def between(self, start, end):
+        # Inclusive of start and end, like rrule.between(inc=True).
+        lo = bisect_left(self.starts, start.float_timestamp)
+        hi = bisect_right(self.starts, end.float_timestamp)
+        return [arrow.get(ts) for ts in self.starts[lo:hi]]
+
+
+def _occurrence_index_key(event):
+    # Everything the expansion depends on, so that edits to the rule,
+    # exception dates or start time of an event are never served stale
+    # occurrences.
+    return (event.id, event.rrule, event.exdate, event.all_day,
+            event.start_timezone, event.start.timestamp)
+
+
+def build_occurrence_index(event, rrules, start, end):
+    """
+    Expand `rrules`, the parsed rule of `event`, into an OccurrenceIndex
+    covering at least [start, end], unless that takes more than
+    MAX_INDEXED_OCCURRENCES occurrences.
+
+    """
+    now = arrow.utcnow()
+    window_start = min(start,
+                       now.replace(years=-OCCURRENCE_INDEX_LOOKBACK_YEARS))
+    if window_start <= event.start:
+        window_start = None
+    window_end = max(end, now.replace(years=+EXPAND_RECURRING_YEARS)). \
+        replace(days=+OCCURRENCE_INDEX_MARGIN_DAYS)
+
+    lower = _rrule_time(event, window_start) if window_start else None
+    upper = _rrule_time(event, window_end)
+    starts = []
+    for t in rrules:
+        if lower is not None and t < lower:
+            continue
+        if t > upper:
+            break
+        if len(starts) == MAX_INDEXED_OCCURRENCES:
+            # Only the occurrences up to the last materialised one are
+            # known.
+            window_end = arrow.get(starts[-1])
+            break
+        # Timestamps are UTC, which covers daylight savings differences
+        starts.append(arrow.get(t).float_timestamp)
+    else:
+        window_end = None
+
+    return OccurrenceIndex(
+        starts,
+        window_start.float_timestamp if window_start else None,
+        window_end.float_timestamp if window_end else None)
+
+
 def get_start_times(event, start=None, end=None):
     # Expands the rrule on event to return a list of arrow datetimes
     # representing start times for its recurring instances.
@@ -95,6 +271,8 @@ def get_start_times(event, start=None, end=None):
     # otherwise defaults to the event start date and now + 1 year;
     # this can return a lot of instances if the event recurs more frequently
     # than weekly!
+    # Occurrences are served from a cached OccurrenceIndex when possible,
+    # rather than re-parsing and re-expanding the rule on every request.
 
     if isinstance(event, RecurringEvent):
         # Localize first so that expansion covers DST
@@ -117,32 +295,29 @@ def get_start_times(event, start=None, end=None):
         else:
             end = arrow.get(end)
 
-        rrules = parse_rrule(event)
+        # The cache is keyed on the event id, so only persisted events
+        # are cached.
+        key = _occurrence_index_key(event) if event.id is not None else None
+        index = _occurrence_cache.get(key) if key else None
+        if index is not None and index.covers(start, end):
+            return index.between(start, end)
+
+        rrules = _parse_rrules(event)
         if not rrules:
             log.warn('Tried to expand a non-recurring event',
                      event_id=event.id)
             return [event.start]
 
-        excl_dates = parse_exdate(event)
-
-        if len(excl_dates) > 0:
-            if not isinstance(rrules, rruleset):
-                rrules = rruleset().rrule(rrules)
-
-            # We want naive-everything for all-day events.
-            if event.all_day:
-                excl_dates = map(lambda x: x.naive, excl_dates)
-            map(rrules.exdate, excl_dates)
+        if key:
+            index = build_occurrence_index(event, rrules, start, end)
+            _occurrence_cache.set(key, index)
+            if index.covers(start, end):
+                return index.between(start, end)
 
         # Return all start times between start and end, including start and
         # end themselves if they obey the rule.
-        if event.all_day:
-            # compare naive times, since date handling in rrulestr is naive
-            # when UNTIL takes the form YYYYMMDD
-            start = start.to('utc').naive
-            end = end.to('utc').naive
-
-        start_times = rrules.between(start, end, inc=True)
+        start_times = rrules.between(_rrule_time(event, start),
+                                     _rrule_time(event, end), inc=True)
 
         # Convert back to UTC, which covers daylight savings differences
         start_times = [arrow.get(t).to('utc') for t in start_times]
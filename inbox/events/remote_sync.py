@@ -10,11 +10,12 @@ from inbox.sync.base_sync import BaseSyncMonitor
 from inbox.models import Event, Calendar
 from inbox.models.event import RecurringEvent, RecurringEventOverride
 from inbox.util.debug import bind_context
+from inbox.util.itert import chunk
 from inbox.models.session import session_scope
 
 from inbox.models.account import Account
 
-from inbox.events.recurring import link_events
+from inbox.events.recurring import link_event_batch
 from inbox.events.google import GoogleEventsProvider
 
 
@@ -24,6 +25,9 @@ POLL_FREQUENCY = config.get('CALENDAR_POLL_FREQUENCY', 300)
 
 MAX_TIME_WITHOUT_SYNC = timedelta(seconds=3600)
 
+# Number of remote events upserted per database transaction.
+EVENT_BATCH_SIZE = 500
+
 
 class EventSync(BaseSyncMonitor):
     """Per-account event sync engine."""
@@ -106,16 +110,21 @@ def handle_calendar_deletes(namespace_id, deleted_calendar_uids, log,
 
 def handle_calendar_updates(namespace_id, calendars, log, db_session):
     """Persists new or updated Calendar objects to the database."""
-    ids_ = []
     added_count = 0
     updated_count = 0
+    local_calendars = {}
+    uids = {calendar.uid for calendar in calendars}
+    if uids:
+        for local_calendar in db_session.query(Calendar).filter(
+                Calendar.namespace_id == namespace_id,
+                Calendar.uid.in_(uids)):
+            local_calendars.setdefault(local_calendar.uid, local_calendar)
+
+    synced_calendars = []
     for calendar in calendars:
         assert calendar.uid is not None, 'Got remote item with null uid'
 
-        local_calendar = db_session.query(Calendar).filter(
-            Calendar.namespace_id == namespace_id,
-            Calendar.uid == calendar.uid).first()
-
+        local_calendar = local_calendars.get(calendar.uid)
         if local_calendar is not None:
             local_calendar.update(calendar)
             updated_count += 1
@@ -123,10 +132,13 @@ def handle_calendar_updates(namespace_id, calendars, log, db_session):
             local_calendar = Calendar(namespace_id=namespace_id)
             local_calendar.update(calendar)
             db_session.add(local_calendar)
+            local_calendars[calendar.uid] = local_calendar
             added_count += 1
+        synced_calendars.append(local_calendar)
 
-        db_session.commit()
-        ids_.append((local_calendar.uid, local_calendar.id))
+    db_session.flush()
+    ids_ = [(c.uid, c.id) for c in synced_calendars]
+    db_session.commit()
 
     log.info('synced added and updated calendars', added=added_count,
              updated=updated_count)
@@ -134,56 +146,71 @@ def handle_calendar_updates(namespace_id, calendars, log, db_session):
 
 
 def handle_event_updates(namespace_id, calendar_id, events, log, db_session):
-    """Persists new or updated Event objects to the database."""
+    """Persists new or updated Event objects to the database.
+
+    Events are upserted in pages of EVENT_BATCH_SIZE: the local events of a
+    page are looked up by uid at once, and recurring events and overrides are
+    linked together once the page is flushed, before committing it.
+    """
     added_count = 0
     updated_count = 0
     existing_event_query = db_session.query(Event).filter(
         Event.namespace_id == namespace_id,
         Event.calendar_id == calendar_id).exists()
     events_exist = db_session.query(existing_event_query).scalar()
-    for event in events:
-        assert event.uid is not None, 'Got remote item with null uid'
-
-        local_event = None
+    for page in chunk(events, EVENT_BATCH_SIZE):
+        local_events = {}
         if events_exist:
             # Skip this lookup if there are no local events at all, for faster
             # first sync.
-            local_event = db_session.query(Event).filter(
-                Event.namespace_id == namespace_id,
-                Event.calendar_id == calendar_id,
-                Event.uid == event.uid).first()
-
-        if local_event is not None:
-            # We also need to mark all overrides as cancelled if we're
-            # cancelling a recurring event. However, note the original event
-            # may not itself be recurring (recurrence may have been added).
-            if isinstance(local_event, RecurringEvent) and \
-                    event.status == 'cancelled' and \
-                    local_event.status != 'cancelled':
-                for override in local_event.overrides:
-                    override.status = 'cancelled'
-
-            local_event.update(event)
-            local_event.participants = event.participants
-
-            updated_count += 1
-        else:
-            local_event = event
-            local_event.namespace_id = namespace_id
-            local_event.calendar_id = calendar_id
-            db_session.add(local_event)
-            added_count += 1
-
-        # If we just updated/added a recurring event or override, make sure
-        # we link it to the right master event.
-        if isinstance(event, RecurringEvent) or \
-                isinstance(event, RecurringEventOverride):
+            uids = {event.uid for event in page}
+            for local_event in db_session.query(Event).filter(
+                    Event.namespace_id == namespace_id,
+                    Event.calendar_id == calendar_id,
+                    Event.uid.in_(uids)):
+                local_events.setdefault(local_event.uid, local_event)
+
+        recurring_events = []
+        for event in page:
+            assert event.uid is not None, 'Got remote item with null uid'
+
+            local_event = local_events.get(event.uid)
+            if local_event is not None:
+                # We also need to mark all overrides as cancelled if we're
+                # cancelling a recurring event. However, note the original
+                # event may not itself be recurring (recurrence may have been
+                # added).
+                if isinstance(local_event, RecurringEvent) and \
+                        event.status == 'cancelled' and \
+                        local_event.status != 'cancelled':
+                    for override in local_event.overrides:
+                        override.status = 'cancelled'
+
+                local_event.update(event)
+                local_event.participants = event.participants
+
+                updated_count += 1
+            else:
+                local_event = event
+                local_event.namespace_id = namespace_id
+                local_event.calendar_id = calendar_id
+                db_session.add(local_event)
+                local_events[event.uid] = local_event
+                added_count += 1
+
+            # If we just updated/added a recurring event or override, make
+            # sure we link it to the right master event.
+            if isinstance(local_event, RecurringEvent) or \
+                    isinstance(local_event, RecurringEventOverride):
+                recurring_events.append(local_event)
+
+        if recurring_events:
             db_session.flush()
-            link_events(db_session, event)
+            link_event_batch(db_session, recurring_events)
 
-        # Batch commits to avoid long transactions that may lock calendar rows.
-        if (added_count + updated_count) % 10 == 0:
-            db_session.commit()
+        # Commit per page to avoid long transactions that may lock calendar
+        # rows.
+        db_session.commit()
 
     log.info('synced added and updated events',
              calendar_id=calendar_id,
@@ -1,5 +1,6 @@
 import time
 import weakref
+from collections import Counter
 import gevent
 from socket import gethostname
 from urllib import quote_plus as urlquote
@@ -19,10 +20,19 @@ DB_POOL_SIZE = config.get_required('DB_POOL_SIZE')
 # Sane default of max overflow=5 if value missing in config.
 DB_POOL_MAX_OVERFLOW = config.get('DB_POOL_MAX_OVERFLOW') or 5
 DB_POOL_TIMEOUT = config.get('DB_POOL_TIMEOUT') or 60
+# If set, the shards on each MySQL host share one connection pool (see
+# EngineManager), sized by the DB_HOST_POOL_* options.
+DB_POOL_PER_HOST = config.get('DB_POOL_PER_HOST', False)
+DB_HOST_POOL_SIZE = config.get('DB_HOST_POOL_SIZE') or DB_POOL_SIZE
+DB_HOST_POOL_MAX_OVERFLOW = config.get('DB_HOST_POOL_MAX_OVERFLOW') or \
+    DB_POOL_MAX_OVERFLOW
 
 
 pool_tracker = weakref.WeakKeyDictionary()
 
+# Number of connections checked out of shared pools, by shard schema.
+shard_checkouts = Counter()
+
 
 # See
 # https://github.com/PyMySQL/mysqlclient-python/blob/master/samples/waiter_gevent.py
@@ -91,15 +101,79 @@ def engine(database_name, database_uri, pool_size=DB_POOL_SIZE,
     def receive_checkin(dbapi_connection, connection_record):
         if dbapi_connection in pool_tracker:
             del pool_tracker[dbapi_connection]
+        if connection_record is not None:
+            schema_name = connection_record.info.pop('shard_checkout', None)
+            if schema_name is not None:
+                shard_checkouts[schema_name] -= 1
+
+    @event.listens_for(engine, 'connect')
+    def receive_connect(dbapi_connection, connection_record):
+        # A new connection (e.g. after a reconnect) starts out in the default
+        # schema of the engine, whichever shard it was last used for.
+        connection_record.info.pop('schema', None)
+
+    return engine
+
+
+def shard_engine(schema_name, host_engine):
+    """
+    An engine for the shard schema `schema_name` which uses the connection
+    pool of `host_engine`, shared with the other shards on the same host.
+    Connections switch to the shard's schema when they're checked out, if
+    they were last used for another one.
+
+    """
+    engine = host_engine.execution_options()
+    # The URL of the host engine doesn't name a database.
+    engine.schema_name = schema_name
+
+    @event.listens_for(engine, 'engine_connect')
+    def receive_engine_connect(connection, branch):
+        if branch:
+            # Uses the same DBAPI connection as its parent.
+            return
+        connection_fairy = connection.connection
+        info = connection_fairy.info
+        if info.get('schema') != schema_name:
+            cursor = connection_fairy.cursor()
+            cursor.execute('USE `{}`'.format(schema_name))
+            cursor.close()
+            info['schema'] = schema_name
+
+        info['shard_checkout'] = schema_name
+        shard_checkouts[schema_name] += 1
+        if config.get('ENABLE_DB_TXN_METRICS', False):
+            hostname = gethostname().replace(".", "-")
+            process_name = str(config.get("PROCESS_NAME", "main_process"))
+            statsd_client.gauge(".".join(
+                ["dbconn", schema_name, hostname, process_name,
+                 "checkedout"]),
+                                shard_checkouts[schema_name])
 
     return engine
 
 
 class EngineManager(object):
+    """
+    Creates and keeps track of the engines of every shard.
+
+    By default, each shard gets an engine with its own connection pool. With
+    `pool_per_host` (DB_POOL_PER_HOST in the config), the shards on each
+    MySQL host share the connection pool of a single host engine instead,
+    which bounds the number of connections a process opens to a host
+    regardless of how many shards it holds.
+
+    """
 
-    def __init__(self, databases, users, include_disabled=False):
+    def __init__(self, databases, users, include_disabled=False,
+                 pool_per_host=None):
+        if pool_per_host is None:
+            pool_per_host = DB_POOL_PER_HOST
+        self.pool_per_host = pool_per_host
         self.engines = {}
+        self.host_engines = {}
         self._engine_zones = {}
+        self._schema_names = {}
         keys = set()
         schema_names = set()
         use_proxysql = config.get('USE_PROXYSQL', False)
@@ -109,6 +183,7 @@ class EngineManager(object):
             username = users[hostname]['USER']
             password = users[hostname]['PASSWORD']
             zone = database.get('ZONE')
+            host_engine = None
             for shard in database['SHARDS']:
                 schema_name = shard['SCHEMA_NAME']
                 key = shard['ID']
@@ -128,13 +203,60 @@ class EngineManager(object):
                              key=key)
                     continue
 
-                uri = build_uri(username=username,
-                                password=password,
-                                database_name=schema_name,
-                                hostname=hostname,
-                                port=port)
-                self.engines[key] = engine(schema_name, uri)
+                if pool_per_host:
+                    if host_engine is None:
+                        host_engine = self._host_engine(
+                            database['HOSTNAME'], hostname, port, username,
+                            password)
+                    self.engines[key] = shard_engine(schema_name,
+                                                     host_engine)
+                else:
+                    uri = build_uri(username=username,
+                                    password=password,
+                                    database_name=schema_name,
+                                    hostname=hostname,
+                                    port=port)
+                    self.engines[key] = engine(schema_name, uri)
                 self._engine_zones[key] = zone
+                self._schema_names[key] = schema_name
+
+    def _host_engine(self, name, hostname, port, username, password):
+        pool_name = 'host-{}-{}'.format(name, port).replace('.', '-')
+        if pool_name not in self.host_engines:
+            # Connections have no default schema, shard engines select theirs.
+            uri = build_uri(username=username,
+                            password=password,
+                            database_name='',
+                            hostname=hostname,
+                            port=port)
+            self.host_engines[pool_name] = engine(
+                pool_name, uri, pool_size=DB_HOST_POOL_SIZE,
+                max_overflow=DB_HOST_POOL_MAX_OVERFLOW)
+        return self.host_engines[pool_name]
+
+    def pool_status(self):
+        """
+        Connection pool usage of each shard, as a dict of
+        {shard key: {...}}. `pool_*` values are those of the pool the shard
+        uses, which may be shared with other shards.
+
+        """
+        status = {}
+        for key, engine in self.engines.iteritems():
+            schema_name = self._schema_names[key]
+            pool = engine.pool
+            if self.pool_per_host:
+                checked_out = shard_checkouts[schema_name]
+            else:
+                checked_out = pool.checkedout()
+            status[key] = {
+                'schema_name': schema_name,
+                'checked_out': checked_out,
+                'pool_size': pool.size(),
+                'pool_checked_out': pool.checkedout(),
+                'pool_overflow': pool.overflow()
+            }
+        return status
 
     def shard_key_for_id(self, id_):
         return id_ >> 48
@@ -6,6 +6,7 @@ import socket
 import sys
 import time
 import traceback
+from contextlib import contextmanager
 import gevent.hub
 import gevent._threading  # This is a clone of the *real* threading module
 import greenlet
@@ -258,3 +259,65 @@ class KillerGreenletTracer(GreenletTracer):
             context=getattr(active_greenlet, 'context', None),
             blocking_greenlet_id=id(active_greenlet))
         thread.interrupt_main()
+
+
+class SyncPhaseTimer(object):
+    """Keep track of the time mail sync spends in each phase of downloading
+    and saving messages (IMAP fetch, message creation, MIME parsing,
+    blockstore writes, threading, contact extraction, commit...).
+
+    Each measurement is reported as a statsd timer, both overall and per
+    provider, and aggregated in-process so that the sync process' HTTP
+    frontend can show where time goes. Phases may be nested (e.g.
+    'threading' is part of 'create_message'), so phase totals don't add up
+    to the elapsed time."""
+
+    def __init__(self):
+        self.statsd_client = get_statsd_client()
+        self.reset()
+
+    def reset(self):
+        self.start_time = time.time()
+        # phase -> [count, total seconds, max seconds]
+        self._phases = collections.defaultdict(lambda: [0, 0.0, 0.0])
+
+    @contextmanager
+    def time(self, phase, provider_name=None):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(phase, time.time() - start, provider_name)
+
+    def record(self, phase, seconds, provider_name=None):
+        stats = self._phases[phase]
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+
+        providers = ['overall']
+        if provider_name is not None:
+            providers.append(provider_name)
+        for provider in providers:
+            self.statsd_client.timing(
+                '.'.join(['mailsync', 'providers', provider, 'phases', phase]),
+                seconds * 1000)
+
+    def stats(self):
+        phases = {}
+        # The frontend calls this from another thread, so iterate over a
+        # copy.
+        for phase, (count, total, max_) in list(self._phases.items()):
+            phases[phase] = {
+                'count': count,
+                'total_seconds': total,
+                'mean_ms': total * 1000 / count,
+                'max_ms': max_ * 1000
+            }
+        return {
+            'total_time': time.time() - self.start_time,
+            'phases': phases
+        }
+
+
+sync_phase_timer = SyncPhaseTimer()
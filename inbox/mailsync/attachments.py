@@ -0,0 +1,99 @@
+import gevent
+from sqlalchemy import desc
+
+from nylas.logging import get_logger
+log = get_logger()
+from inbox.models import Block
+from inbox.models.session import session_scope
+from inbox.s3.exc import EmailFetchException
+from inbox.util.concurrency import retry_with_logging
+from inbox.util.debug import bind_context
+
+# Number of pending blocks looked up at once.
+BATCH_SIZE = 100
+# Seconds to wait between two downloads, to leave the account's connections
+# and the provider's rate limits to sync and the API.
+DOWNLOAD_INTERVAL = 2
+# Seconds to wait between two passes over the account's blocks.
+PASS_INTERVAL = 30 * 60
+
+
+class PendingAttachmentDownloader(gevent.Greenlet):
+    """
+    Downloads, one at a time, the attachments which initial sync left
+    pending (see DEFER_ATTACHMENT_DOWNLOAD in
+    inbox.mailsync.backends.imap.generic). Attachments accessed through the
+    API in the meantime are downloaded on demand instead, see Blob.data.
+
+    Each pass walks the account's blocks from the most recent one down,
+    so the attachments of recent mail are downloaded first. Blocks which
+    can't be downloaded are retried on the next pass.
+
+    """
+
+    def __init__(self, account_id, namespace_id, provider_name,
+                 download_interval=DOWNLOAD_INTERVAL,
+                 pass_interval=PASS_INTERVAL):
+        bind_context(self, 'attachmentdownloader', account_id)
+        self.account_id = account_id
+        self.namespace_id = namespace_id
+        self.provider_name = provider_name
+        self.download_interval = download_interval
+        self.pass_interval = pass_interval
+        self.log = log.new(account_id=account_id)
+        gevent.Greenlet.__init__(self)
+
+    def _run(self):
+        while True:
+            retry_with_logging(self._run_impl, account_id=self.account_id,
+                               provider=self.provider_name)
+
+    def _run_impl(self):
+        self.download_pending()
+        gevent.sleep(self.pass_interval)
+
+    def download_pending(self):
+        """ Make one pass over the account's pending blocks. """
+        downloaded = 0
+        before_id = None
+        while True:
+            block_ids = self._pending_block_ids(before_id)
+            if not block_ids:
+                break
+            for block_id in block_ids:
+                if self.download(block_id):
+                    downloaded += 1
+                gevent.sleep(self.download_interval)
+            before_id = block_ids[-1]
+        if downloaded:
+            self.log.info('Downloaded pending attachments',
+                          count=downloaded)
+        return downloaded
+
+    def _pending_block_ids(self, before_id):
+        with session_scope(self.namespace_id) as db_session:
+            query = db_session.query(Block.id).filter(
+                Block.namespace_id == self.namespace_id,
+                Block.data_sha256.is_(None),
+                Block.size > 0,
+                Block.deleted_at.is_(None))
+            if before_id is not None:
+                query = query.filter(Block.id < before_id)
+            return [id_ for id_, in
+                    query.order_by(desc(Block.id)).limit(BATCH_SIZE)]
+
+    def download(self, block_id):
+        with session_scope(self.namespace_id) as db_session:
+            block = db_session.query(Block).get(block_id)
+            if block is None or not block.is_pending:
+                return False
+            try:
+                data = block.data
+            except EmailFetchException:
+                self.log.warning('Error downloading pending attachment',
+                                 block_id=block_id, exc_info=True)
+                return False
+            if data is None:
+                return False
+            db_session.commit()
+            return True
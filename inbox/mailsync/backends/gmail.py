@@ -23,10 +23,12 @@ from __future__ import division
 from collections import OrderedDict
 from datetime import datetime, timedelta
 import gevent
-from sqlalchemy.orm import joinedload, load_only
+from sqlalchemy.orm import joinedload, load_only, subqueryload
 
+from inbox.instrumentation import sync_phase_timer
 from inbox.util.itert import chunk
 from inbox.util.debug import bind_context
+from inbox.util.uidset import UidSet
 
 from nylas.logging import get_logger
 from gevent.lock import Semaphore
@@ -205,10 +207,6 @@ class GmailSyncMonitor(ImapSyncMonitor):
 
 class GmailFolderSyncEngine(FolderSyncEngine):
 
-    def __init__(self, *args, **kwargs):
-        FolderSyncEngine.__init__(self, *args, **kwargs)
-        self.saved_uids = set()
-
     def is_all_mail(self, crispin_client):
         if not hasattr(self, '_is_all_mail'):
             self._is_all_mail = (self.folder_name in
@@ -223,15 +221,11 @@ class GmailFolderSyncEngine(FolderSyncEngine):
         # change_poller need to be killed when this greenlet is interrupted
         change_poller = None
         try:
-            remote_uids = sorted(crispin_client.all_uids(), key=int)
+            remote_uids = UidSet(crispin_client.all_uids())
             with self.syncmanager_lock:
-                with session_scope(self.namespace_id) as db_session:
-                    local_uids = common.local_uids(self.account_id, db_session,
-                                                   self.folder_id)
-                common.remove_deleted_uids(
-                    self.account_id, self.folder_id,
-                    set(local_uids) - set(remote_uids))
-                unknown_uids = set(remote_uids) - local_uids
+                self.remove_deleted_uids(
+                    self.local_uids.difference(remote_uids))
+                unknown_uids = set(remote_uids.difference(self.local_uids))
                 with session_scope(self.namespace_id) as db_session:
                     self.update_uid_counts(
                         db_session, remote_uid_count=len(remote_uids),
@@ -267,7 +261,7 @@ class GmailFolderSyncEngine(FolderSyncEngine):
                 # They may also have been preemptively downloaded by thread
                 # expansion. We can omit such UIDs.
                 uids = [u for u in uids if u in g_metadata and u not in
-                        self.saved_uids]
+                        self.local_uids]
                 self.batch_download_uids(crispin_client, uids, g_metadata)
         finally:
             if change_poller is not None:
@@ -316,6 +310,7 @@ class GmailFolderSyncEngine(FolderSyncEngine):
             imap_folder_info_entry.uidvalidity = uidvalidity
             imap_folder_info_entry.highestmodseq = None
             db_session.commit()
+        self._local_uids = None
 
     def __deduplicate_message_object_creation(self, db_session, raw_messages,
                                               account):
@@ -332,8 +327,8 @@ class GmailFolderSyncEngine(FolderSyncEngine):
 
         """
         new_g_msgids = {msg.g_msgid for msg in raw_messages}
-        existing_g_msgids = g_msgids(self.namespace_id, db_session,
-                                     in_=new_g_msgids)
+        existing_g_msgids = set(g_msgids(self.namespace_id, db_session,
+                                         in_=new_g_msgids))
         brand_new_messages = [m for m in raw_messages if m.g_msgid not in
                               existing_g_msgids]
         previously_synced_messages = [m for m in raw_messages if m.g_msgid in
@@ -343,10 +338,28 @@ class GmailFolderSyncEngine(FolderSyncEngine):
                      count=len(previously_synced_messages))
             account = Account.get(self.account_id, db_session)
             folder = Folder.get(self.folder_id, db_session)
+
+            # Load the existing messages together with their UIDs and
+            # categories across all folders in one go, so that checking for
+            # existing UIDs and recomputing message metadata happens in
+            # memory.
+            existing_messages = {}
+            messages = db_session.query(Message).filter(
+                Message.namespace_id == self.namespace_id,
+                Message.g_msgid.in_(
+                    {m.g_msgid for m in previously_synced_messages})). \
+                options(subqueryload(Message.imapuids).
+                        subqueryload('labelitems').joinedload('label').
+                        joinedload('category'),
+                        subqueryload(Message.messagecategories).
+                        joinedload('category')). \
+                order_by(Message.id)
+            for message_obj in messages:
+                existing_messages.setdefault(message_obj.g_msgid, message_obj)
+
+            changed_messages = {}
             for raw_message in previously_synced_messages:
-                message_obj = db_session.query(Message).filter(
-                    Message.namespace_id == self.namespace_id,
-                    Message.g_msgid == raw_message.g_msgid).first()
+                message_obj = existing_messages.get(raw_message.g_msgid)
                 if message_obj is None:
                     log.warning(
                         'Message disappeared while saving new uid',
@@ -368,9 +381,14 @@ class GmailFolderSyncEngine(FolderSyncEngine):
                               message=message_obj)
                 uid.update_flags(raw_message.flags)
                 uid.update_labels(raw_message.g_labels)
+                changed_messages[message_obj.id] = (message_obj, uid.is_draft)
+
+            # Recompute the metadata of each message once, even if several
+            # of its UIDs are in the batch.
+            for message_obj, is_draft in changed_messages.itervalues():
                 common.update_message_metadata(
-                    db_session, account, message_obj, uid.is_draft)
-                db_session.commit()
+                    db_session, account, message_obj, is_draft)
+            db_session.commit()
 
         return brand_new_messages
 
@@ -389,7 +407,8 @@ class GmailFolderSyncEngine(FolderSyncEngine):
 
     def download_and_commit_uids(self, crispin_client, uids):
         start = datetime.utcnow()
-        raw_messages = crispin_client.uids(uids)
+        with sync_phase_timer.time('fetch', self.provider_name):
+            raw_messages = self.fetch_messages(crispin_client, uids)
         if not raw_messages:
             return
         new_uids = set()
@@ -397,21 +416,33 @@ class GmailFolderSyncEngine(FolderSyncEngine):
             with session_scope(self.namespace_id) as db_session:
                 account = Account.get(self.account_id, db_session)
                 folder = Folder.get(self.folder_id, db_session)
-                raw_messages = self.__deduplicate_message_object_creation(
-                    db_session, raw_messages, account)
-                if not raw_messages:
+                brand_new_messages = \
+                    self.__deduplicate_message_object_creation(
+                        db_session, raw_messages, account)
+                # UIDs of previously synced messages have been saved now.
+                self.local_uids.update(msg.uid for msg in raw_messages
+                                       if msg not in brand_new_messages)
+                if not brand_new_messages:
                     return 0
 
-                for msg in raw_messages:
-                    uid = self.create_message(db_session, account, folder,
-                                              msg)
+                for msg in brand_new_messages:
+                    with sync_phase_timer.time('create_message',
+                                               self.provider_name):
+                        uid = self.create_message(db_session, account,
+                                                  folder, msg)
                     if uid is not None:
                         db_session.add(uid)
-                        db_session.commit()
+                        with sync_phase_timer.time('commit',
+                                                   self.provider_name):
+                            db_session.commit()
                         new_uids.add(uid)
+                        self.local_uids.add(msg.uid)
 
         log.debug('Committed new UIDs',
                   new_committed_message_count=len(new_uids))
+        sync_phase_timer.record('download_and_commit',
+                                (datetime.utcnow() - start).total_seconds(),
+                                self.provider_name)
         # If we downloaded uids, record message velocity (#uid / latency)
         if self.state == "initial" and len(new_uids):
             self._report_message_velocity(datetime.utcnow() - start,
@@ -421,8 +452,6 @@ class GmailFolderSyncEngine(FolderSyncEngine):
             self._report_first_message()
             self.is_first_message = False
 
-        self.saved_uids.update(new_uids)
-
     def expand_uids_to_download(self, crispin_client, uids, metadata):
         # During Gmail initial sync, we expand threads: given a UID to
         # download, we want to also download other UIDs on the same thread, so
@@ -14,19 +14,27 @@ accounts.
 from datetime import datetime
 
 from sqlalchemy import bindparam, desc
+from sqlalchemy.orm import joinedload, subqueryload
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.sql.expression import func
 
 from inbox.contacts.process_mail import update_contacts_from_message
+from inbox.instrumentation import sync_phase_timer
 from inbox.models import Account, Message, Folder, ActionLog
 from inbox.models.backends.imap import ImapUid, ImapFolderInfo
 from inbox.models.session import session_scope
 from inbox.models.util import reconcile_message
 from inbox.sqlalchemy_ext.util import bakery
+from inbox.util.itert import chunk
 from nylas.logging import get_logger
 
 log = get_logger()
 
+# Number of expunged UIDs to process per database transaction.
+EXPUNGE_BATCH_SIZE = 200
+# Number of UIDs whose flags are reconciled per database transaction.
+UPDATE_METADATA_BATCH_SIZE = 200
+
 
 def local_uids(account_id, session, folder_id, limit=None):
     q = bakery(lambda session: session.query(ImapUid.msg_uid))
@@ -90,10 +98,38 @@ def update_metadata(account_id, folder_id, folder_role, new_flags, session):
 
     account = Account.get(account_id, session)
     change_count = 0
-    for item in session.query(ImapUid).filter(
-            ImapUid.account_id == account_id,
-            ImapUid.msg_uid.in_(new_flags.keys()),
-            ImapUid.folder_id == folder_id):
+    for uid_batch in chunk(sorted(new_flags), UPDATE_METADATA_BATCH_SIZE):
+        change_count += _update_metadata_batch(
+            account, folder_id, folder_role,
+            {uid: new_flags[uid] for uid in uid_batch}, session)
+        session.commit()
+    log.info('Updated UID metadata', changed=change_count,
+             out_of=len(new_flags))
+
+
+def _update_metadata_batch(account, folder_id, folder_role, new_flags,
+                           session):
+    # Load the batch's UIDs together with their messages, and the messages'
+    # UIDs and categories across all folders, up front. That way diffing
+    # flags and recomputing message metadata happens in memory instead of
+    # lazy-loading relationships row by row.
+    imapuids = session.query(ImapUid).filter(
+        ImapUid.account_id == account.id,
+        ImapUid.msg_uid.in_(new_flags.keys()),
+        ImapUid.folder_id == folder_id).options(
+            subqueryload('labelitems').joinedload('label').
+            joinedload('category'),
+            joinedload(ImapUid.message).
+            subqueryload(Message.imapuids).
+            subqueryload('labelitems').joinedload('label').
+            joinedload('category'),
+            joinedload(ImapUid.message).
+            subqueryload(Message.messagecategories).
+            joinedload('category')).all()
+
+    change_count = 0
+    changed_messages = {}
+    for item in imapuids:
         flags = new_flags[item.msg_uid].flags
         labels = getattr(new_flags[item.msg_uid], 'labels', None)
 
@@ -107,10 +143,11 @@ def update_metadata(account_id, folder_id, folder_role, new_flags, session):
             change_count += 1
             is_draft = item.is_draft and (folder_role == 'drafts' or
                                           folder_role == 'all')
-            update_message_metadata(session, account, item.message, is_draft)
-            session.commit()
-    log.info('Updated UID metadata', changed=change_count,
-             out_of=len(new_flags))
+            changed_messages[item.message_id] = (item.message, is_draft)
+
+    for message, is_draft in changed_messages.itervalues():
+        update_message_metadata(session, account, message, is_draft)
+    return change_count
 
 
 def remove_deleted_uids(account_id, folder_id, uids):
@@ -123,48 +160,66 @@ def remove_deleted_uids(account_id, folder_id, uids):
     if not uids:
         return
     deleted_uid_count = 0
-    for uid in uids:
-        # We do this one-uid-at-a-time because issuing many deletes within a
-        # single database transaction is problematic. But loading many
-        # objects into a session and then frequently calling commit() is also
-        # bad, because expiring objects and checking for revisions is O(number
-        # of objects in session), resulting in quadratic runtimes.
-        # Performance could perhaps be additionally improved by choosing a
-        # sane balance, e.g., operating on 10 or 100 uids or something at once.
+    # Issuing many deletes within a single database transaction is
+    # problematic, but so is committing once per UID: a UIDVALIDITY reset on
+    # a large folder would then take hundreds of thousands of tiny
+    # transactions. So we work through the UIDs in bounded batches, with a
+    # fresh session and a single commit for each.
+    for uid_batch in chunk(sorted(uids), EXPUNGE_BATCH_SIZE):
         with session_scope(account_id) as db_session:
-            imapuid = db_session.query(ImapUid).filter(
-                ImapUid.account_id == account_id,
-                ImapUid.folder_id == folder_id,
-                ImapUid.msg_uid == uid).first()
-            if imapuid is None:
-                continue
-            deleted_uid_count += 1
-            message = imapuid.message
-
-            db_session.delete(imapuid)
-
-            if message is not None:
-                if not message.imapuids and message.is_draft:
-                    # Synchronously delete drafts.
-                    thread = message.thread
-                    if thread is not None:
-                        thread.messages.remove(message)
-                    db_session.delete(message)
-                    if thread is not None and not thread.messages:
-                        db_session.delete(thread)
-                else:
-                    account = Account.get(account_id, db_session)
-                    update_message_metadata(db_session, account, message,
-                                            message.is_draft)
-                    if not message.imapuids:
-                        # But don't outright delete messages. Just mark them as
-                        # 'deleted' and wait for the asynchronous
-                        # dangling-message-collector to delete them.
-                        message.mark_for_deletion()
+            deleted_uid_count += _remove_deleted_uid_batch(
+                db_session, account_id, folder_id, uid_batch)
             db_session.commit()
     log.info('Deleted expunged UIDs', count=deleted_uid_count)
 
 
+def _remove_deleted_uid_batch(db_session, account_id, folder_id, uids):
+    rows = db_session.query(ImapUid.id, ImapUid.message_id).filter(
+        ImapUid.account_id == account_id,
+        ImapUid.folder_id == folder_id,
+        ImapUid.msg_uid.in_(uids)).all()
+    if not rows:
+        return 0
+
+    # LabelItems go away with their ImapUid through the ON DELETE CASCADE
+    # foreign key, so a single bulk delete suffices here.
+    db_session.query(ImapUid).filter(
+        ImapUid.id.in_([imapuid_id for imapuid_id, _ in rows])). \
+        delete(synchronize_session=False)
+
+    # Now recompute metadata once for each affected message, loading the
+    # remaining UIDs and their categories for the whole batch up front.
+    message_ids = {message_id for _, message_id in rows}
+    messages = db_session.query(Message).filter(
+        Message.id.in_(message_ids)).options(
+            subqueryload(Message.imapuids).
+            subqueryload('labelitems').
+            joinedload('label').
+            joinedload('category'),
+            subqueryload(Message.messagecategories).
+            joinedload('category')).all()
+
+    account = Account.get(account_id, db_session)
+    for message in messages:
+        if not message.imapuids and message.is_draft:
+            # Synchronously delete drafts.
+            thread = message.thread
+            if thread is not None:
+                thread.messages.remove(message)
+            db_session.delete(message)
+            if thread is not None and not thread.messages:
+                db_session.delete(thread)
+        else:
+            update_message_metadata(db_session, account, message,
+                                    message.is_draft)
+            if not message.imapuids:
+                # But don't outright delete messages. Just mark them as
+                # 'deleted' and wait for the asynchronous
+                # dangling-message-collector to delete them.
+                message.mark_for_deletion()
+    return len(rows)
+
+
 def get_folder_info(account_id, session, folder_name):
     try:
         # using .one() here may catch duplication bugs
@@ -175,9 +230,11 @@ def get_folder_info(account_id, session, folder_name):
         return None
 
 
-def create_imap_message(db_session, account, folder, msg):
+def create_imap_message(db_session, account, folder, msg,
+                        provider_name=None):
     """
-    IMAP-specific message creation logic.
+    IMAP-specific message creation logic. `provider_name` is the one the
+    sync engine reports its phase timings under.
 
     Returns
     -------
@@ -186,10 +243,11 @@ def create_imap_message(db_session, account, folder, msg):
         relationships. All new objects are uncommitted.
 
     """
-    new_message = Message.create_from_synced(account=account, mid=msg.uid,
-                                             folder_name=folder.name,
-                                             received_date=msg.internaldate,
-                                             body_string=msg.body)
+    new_message = Message.create_from_synced(
+        account=account, mid=msg.uid, folder_name=folder.name,
+        received_date=msg.internaldate, body_string=msg.body,
+        deferred_sections=msg.deferred_sections,
+        provider_name=provider_name)
 
     # Check to see if this is a copy of a message that was first created
     # by the Nylas API. If so, don't create a new object; just use the old one.
@@ -209,7 +267,9 @@ def create_imap_message(db_session, account, folder, msg):
                                          folder.canonical_name == 'all')
         update_message_metadata(db_session, account, new_message, is_draft)
 
-    update_contacts_from_message(db_session, new_message, account.namespace)
+    with sync_phase_timer.time('contacts', provider_name):
+        update_contacts_from_message(db_session, new_message,
+                                     account.namespace)
 
     return imapuid
 
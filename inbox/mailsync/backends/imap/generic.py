@@ -72,12 +72,15 @@ from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
 
 from inbox.basicauth import ValidationError
+from inbox.config import config
+from inbox.instrumentation import sync_phase_timer
 from inbox.util.concurrency import retry_with_logging
 from inbox.util.debug import bind_context
 from inbox.util.itert import chunk
 from inbox.util.misc import or_none
 from inbox.util.threading import fetch_corresponding_thread, MAX_THREAD_LENGTH
 from inbox.util.stats import statsd_client
+from inbox.util.uidset import UidSet
 from nylas.logging import get_logger
 log = get_logger()
 from inbox.crispin import connection_pool, retry_crispin, FolderMissingError
@@ -109,6 +112,20 @@ MAX_UIDINVALID_RESYNCS = 5
 
 CONDSTORE_FLAGS_REFRESH_BATCH_SIZE = 200
 
+# Initial sync download batching. How well generic IMAP servers cope with
+# multi-message FETCHes varies a lot, so by default we still download one
+# message at a time. Raising IMAP_MAX_DOWNLOAD_COUNT enables batched
+# downloads, with each batch capped at IMAP_MAX_DOWNLOAD_BYTES worth of
+# RFC822.SIZE and committed in a single transaction.
+MAX_DOWNLOAD_COUNT = config.get('IMAP_MAX_DOWNLOAD_COUNT', 1)
+MAX_DOWNLOAD_BYTES = config.get('IMAP_MAX_DOWNLOAD_BYTES', 2 ** 20)
+# Number of UIDs to request message sizes for at once.
+SIZE_FETCH_CHUNK_SIZE = 1024
+# Whether initial sync downloads messages without their attachments, which
+# are then fetched in the background by PendingAttachmentDownloader or on
+# first download through the API.
+DEFER_ATTACHMENT_DOWNLOAD = config.get('DEFER_ATTACHMENT_DOWNLOAD', False)
+
 
 class FolderSyncEngine(Greenlet):
     """Base class for a per-folder IMAP sync engine."""
@@ -148,6 +165,9 @@ class FolderSyncEngine(Greenlet):
         self.last_fast_refresh = None
         self.flags_fetch_results = {}
         self.conn_pool = connection_pool(self.account_id)
+        # Loaded from the database on first use, then kept up to date as we
+        # save and expunge UIDs. See `local_uids`.
+        self._local_uids = None
 
         self.state_handlers = {
             'initial': self.initial_sync,
@@ -337,16 +357,12 @@ class FolderSyncEngine(Greenlet):
         change_poller = None
         try:
             assert crispin_client.selected_folder_name == self.folder_name
-            remote_uids = crispin_client.all_uids()
+            remote_uids = UidSet(crispin_client.all_uids())
             with self.syncmanager_lock:
-                with session_scope(self.namespace_id) as db_session:
-                    local_uids = common.local_uids(self.account_id, db_session,
-                                                   self.folder_id)
-                common.remove_deleted_uids(
-                    self.account_id, self.folder_id,
-                    set(local_uids).difference(remote_uids))
+                self.remove_deleted_uids(
+                    self.local_uids.difference(remote_uids))
 
-            new_uids = set(remote_uids).difference(local_uids)
+            new_uids = remote_uids.difference(self.local_uids)
             with session_scope(self.namespace_id) as db_session:
                 account = db_session.query(Account).get(self.account_id)
                 throttled = account.throttled
@@ -360,13 +376,16 @@ class FolderSyncEngine(Greenlet):
             bind_context(change_poller, 'changepoller', self.account_id,
                          self.folder_id)
             uids = sorted(new_uids, reverse=True)
+            # Throttled accounts are rate-limited per message anyway, so
+            # there's no point in batching their downloads.
+            max_download_count = 1 if throttled else MAX_DOWNLOAD_COUNT
             count = 0
-            for uid in uids:
-                # The speedup from batching appears to be less clear for
-                # non-Gmail accounts, so for now just download one-at-a-time.
-                self.download_and_commit_uids(crispin_client, [uid])
+            for batch in self.download_batches(crispin_client, uids,
+                                               MAX_DOWNLOAD_BYTES,
+                                               max_download_count):
+                self.download_and_commit_uids(crispin_client, batch)
                 self.heartbeat_status.publish()
-                count += 1
+                count += len(batch)
                 if throttled and count >= THROTTLE_COUNT:
                     # Throttled accounts' folders sync at a rate of
                     # 1 message/ minute, after the first approx. THROTTLE_COUNT
@@ -441,6 +460,7 @@ class FolderSyncEngine(Greenlet):
             }
         common.remove_deleted_uids(self.account_id, self.folder_id,
                                    invalid_uids)
+        self._local_uids = None
         self.uidvalidity = remote_uidvalidity
         self.highestmodseq = None
         self.uidnext = remote_uidnext
@@ -472,8 +492,10 @@ class FolderSyncEngine(Greenlet):
             log.warning('Server returned a message with an empty body.')
             return None
 
-        new_uid = common.create_imap_message(db_session, acct, folder, msg)
-        self.add_message_to_thread(db_session, new_uid.message, msg)
+        new_uid = common.create_imap_message(db_session, acct, folder, msg,
+                                             self.provider_name)
+        with sync_phase_timer.time('threading', self.provider_name):
+            self.add_message_to_thread(db_session, new_uid.message, msg)
 
         db_session.flush()
 
@@ -529,27 +551,71 @@ class FolderSyncEngine(Greenlet):
             else:
                 parent_thread.messages.append(message_obj)
 
+    def download_batches(self, crispin_client, uids, max_download_bytes,
+                         max_download_count):
+        """
+        Split `uids` into download batches, preserving their order.
+
+        Each batch holds at most `max_download_count` UIDs and, where the
+        server reports RFC822.SIZE, at most `max_download_bytes` of message
+        data; a single message larger than that is downloaded on its own.
+        UIDs which have been expunged since we listed the folder are dropped.
+
+        """
+        if max_download_count <= 1:
+            for uid in uids:
+                yield [uid]
+            return
+
+        for uid_chunk in chunk(uids, SIZE_FETCH_CHUNK_SIZE):
+            sizes = crispin_client.uid_sizes(uid_chunk)
+            batch = []
+            batch_bytes = 0
+            for uid in uid_chunk:
+                if uid not in sizes:
+                    continue
+                if batch and (len(batch) >= max_download_count or
+                              batch_bytes + sizes[uid] > max_download_bytes):
+                    yield batch
+                    batch = []
+                    batch_bytes = 0
+                batch.append(uid)
+                batch_bytes += sizes[uid]
+            if batch:
+                yield batch
+
+    def fetch_messages(self, crispin_client, uids):
+        if self.state == 'initial' and DEFER_ATTACHMENT_DOWNLOAD:
+            return crispin_client.uids_without_attachments(uids)
+        return crispin_client.uids(uids)
+
     def download_and_commit_uids(self, crispin_client, uids):
         start = datetime.utcnow()
-        raw_messages = crispin_client.uids(uids)
+        with sync_phase_timer.time('fetch', self.provider_name):
+            raw_messages = self.fetch_messages(crispin_client, uids)
         if not raw_messages:
             return 0
 
-        new_uids = set()
         with self.syncmanager_lock:
-            with session_scope(self.namespace_id) as db_session:
-                account = Account.get(self.account_id, db_session)
-                folder = Folder.get(self.folder_id, db_session)
+            try:
+                new_uids = self._commit_raw_messages(raw_messages)
+            except Exception:
+                if len(raw_messages) == 1:
+                    raise
+                # Don't let one bad message hold back the rest of the batch:
+                # retry committing one message at a time, so that only the
+                # offending message raises.
+                log.warning('Error committing downloaded batch, retrying '
+                            'one message at a time',
+                            batch_size=len(raw_messages), exc_info=True)
+                new_uids = set()
                 for msg in raw_messages:
-                    uid = self.create_message(db_session, account,
-                                              folder, msg)
-                    if uid is not None:
-                        db_session.add(uid)
-                        db_session.flush()
-                        new_uids.add(uid)
-                db_session.commit()
+                    new_uids.update(self._commit_raw_messages([msg]))
 
         log.debug('Committed new UIDs', new_committed_message_count=len(new_uids))
+        sync_phase_timer.record('download_and_commit',
+                                (datetime.utcnow() - start).total_seconds(),
+                                self.provider_name)
         # If we downloaded uids, record message velocity (#uid / latency)
         if self.state == 'initial' and len(new_uids):
             self._report_message_velocity(datetime.utcnow() - start,
@@ -560,6 +626,26 @@ class FolderSyncEngine(Greenlet):
 
         return len(new_uids)
 
+    def _commit_raw_messages(self, raw_messages):
+        new_uids = set()
+        with session_scope(self.namespace_id) as db_session:
+            account = Account.get(self.account_id, db_session)
+            folder = Folder.get(self.folder_id, db_session)
+            for msg in raw_messages:
+                with sync_phase_timer.time('create_message',
+                                           self.provider_name):
+                    uid = self.create_message(db_session, account, folder,
+                                              msg)
+                if uid is not None:
+                    db_session.add(uid)
+                    db_session.flush()
+                    new_uids.add(uid)
+            with sync_phase_timer.time('commit', self.provider_name):
+                db_session.commit()
+        self.local_uids.update(msg.uid for msg in raw_messages
+                               if msg.body is not None)
+        return new_uids
+
     def _report_first_message(self):
         # Only record the "time to first message" in the inbox. Because users
         # can add more folders at any time, "initial sync"-style metrics for
@@ -626,9 +712,7 @@ class FolderSyncEngine(Greenlet):
                   remote_uidnext=remote_uidnext, saved_uidnext=self.uidnext)
 
         crispin_client.select_folder(self.folder_name, self.uidvalidity_cb)
-        with session_scope(self.namespace_id) as db_session:
-            lastseenuid = common.lastseenuid(self.account_id, db_session,
-                                             self.folder_id)
+        lastseenuid = self.local_uids.max() or 0
         latest_uids = crispin_client.conn.fetch('{}:*'.format(lastseenuid + 1),
                                                 ['UID']).keys()
         new_uids = set(latest_uids) - {lastseenuid}
@@ -661,9 +745,16 @@ class FolderSyncEngine(Greenlet):
                   new_highestmodseq=new_highestmodseq,
                   saved_highestmodseq=self.highestmodseq)
         crispin_client.select_folder(self.folder_name, self.uidvalidity_cb)
-        changed_flags = crispin_client.condstore_changed_flags(
-            self.highestmodseq)
-        remote_uids = crispin_client.all_uids()
+        if crispin_client.qresync_enabled:
+            # The server tells us which UIDs were expunged, so we don't need
+            # to list every UID in the folder and diff it against ours.
+            changed_flags, vanished_uid_ranges = \
+                crispin_client.qresync_changes(self.highestmodseq)
+            remote_uids = None
+        else:
+            changed_flags = crispin_client.condstore_changed_flags(
+                self.highestmodseq)
+            remote_uids = UidSet(crispin_client.all_uids())
 
         # In order to be able to sync changes to tens of thousands of flags at
         # once, we commit updates in batches. We do this in ascending order by
@@ -685,24 +776,27 @@ class FolderSyncEngine(Greenlet):
                 interim_highestmodseq = max(v.modseq for k, v in flag_batch)
                 self.highestmodseq = interim_highestmodseq
 
-        with session_scope(self.namespace_id) as db_session:
-            local_uids = common.local_uids(self.account_id, db_session,
-                                           self.folder_id)
-            expunged_uids = set(local_uids).difference(remote_uids)
+        if remote_uids is None:
+            expunged_uids = self.local_uids.in_ranges(vanished_uid_ranges)
+        else:
+            expunged_uids = self.local_uids.difference(remote_uids)
 
         if expunged_uids:
             # If new UIDs have appeared since we last checked in
             # get_new_uids, save them first. We want to always have the
             # latest UIDs before expunging anything, in order to properly
             # capture draft revisions.
-            with session_scope(self.namespace_id) as db_session:
-                lastseenuid = common.lastseenuid(self.account_id, db_session,
-                                                 self.folder_id)
-            if remote_uids and lastseenuid < max(remote_uids):
+            lastseenuid = self.local_uids.max() or 0
+            if remote_uids is None:
+                uidnext = crispin_client.selected_uidnext
+                has_new_uids = uidnext is None or lastseenuid + 1 < uidnext
+            else:
+                has_new_uids = (remote_uids.max() is not None and
+                                lastseenuid < remote_uids.max())
+            if has_new_uids:
                 log.info('Downloading new UIDs before expunging')
                 self.get_new_uids(crispin_client)
-            common.remove_deleted_uids(self.account_id, self.folder_id,
-                                       expunged_uids)
+            self.remove_deleted_uids(expunged_uids)
         self.highestmodseq = new_highestmodseq
 
     def generic_refresh_flags(self, crispin_client):
@@ -724,11 +818,7 @@ class FolderSyncEngine(Greenlet):
 
     def refresh_flags_impl(self, crispin_client, max_uids):
         crispin_client.select_folder(self.folder_name, self.uidvalidity_cb)
-        with session_scope(self.namespace_id) as db_session:
-            local_uids = common.local_uids(account_id=self.account_id,
-                                           session=db_session,
-                                           folder_id=self.folder_id,
-                                           limit=max_uids)
+        local_uids = self.local_uids.largest(max_uids)
 
         flags = crispin_client.flags(local_uids)
         if (max_uids in self.flags_fetch_results and
@@ -741,13 +831,33 @@ class FolderSyncEngine(Greenlet):
         log.debug('Changed flags refresh response, persisting changes',
                   max_uids=max_uids)
         expunged_uids = set(local_uids).difference(flags.keys())
-        common.remove_deleted_uids(self.account_id, self.folder_id,
-                                   expunged_uids)
+        self.remove_deleted_uids(expunged_uids)
         with session_scope(self.namespace_id) as db_session:
             common.update_metadata(self.account_id, self.folder_id,
                                    self.folder_role, flags, db_session)
         self.flags_fetch_results[max_uids] = (local_uids, flags)
 
+    @property
+    def local_uids(self):
+        """
+        The UIDs of this folder that we've saved, as a UidSet.
+
+        Loaded from the database the first time it's needed, e.g. when the
+        sync engine starts and after a UIDVALIDITY change. From then on,
+        the engine keeps it up to date itself, rather than listing the
+        folder's ImapUids on every poll.
+
+        """
+        if self._local_uids is None:
+            with session_scope(self.namespace_id) as db_session:
+                self._local_uids = UidSet(common.local_uids(
+                    self.account_id, db_session, self.folder_id))
+        return self._local_uids
+
+    def remove_deleted_uids(self, uids):
+        common.remove_deleted_uids(self.account_id, self.folder_id, uids)
+        self.local_uids.difference_update(uids)
+
     def check_uid_changes(self, crispin_client):
         self.get_new_uids(crispin_client)
         if crispin_client.condstore_supported():
@@ -8,8 +8,10 @@ from inbox.models import Account, Folder
 from inbox.models.category import Category, sanitize_name
 from inbox.models.session import session_scope
 from inbox.mailsync.backends.base import BaseMailSyncMonitor
-from inbox.mailsync.backends.imap.generic import FolderSyncEngine
-from inbox.mailsync.gc import DeleteHandler
+from inbox.mailsync.backends.imap.generic import (FolderSyncEngine,
+                                                  DEFER_ATTACHMENT_DOWNLOAD)
+from inbox.mailsync.gc import DeleteHandler, THROTTLE_DELETION
+from inbox.mailsync.attachments import PendingAttachmentDownloader
 log = get_logger()
 
 
@@ -35,6 +37,7 @@ class ImapSyncMonitor(BaseMailSyncMonitor):
 
         self.folder_monitors = Group()
         self.delete_handler = None
+        self.attachment_downloader = None
 
         BaseMailSyncMonitor.__init__(self, account, heartbeat)
 
@@ -150,12 +153,22 @@ class ImapSyncMonitor(BaseMailSyncMonitor):
                 account_id=self.account_id,
                 namespace_id=self.namespace_id,
                 provider_name=self.provider_name,
-                uid_accessor=lambda m: m.imapuids)
+                uid_accessor=lambda m: m.imapuids,
+                throttle=THROTTLE_DELETION)
             self.delete_handler.start()
 
+    def start_attachment_downloader(self):
+        if self.attachment_downloader is None and DEFER_ATTACHMENT_DOWNLOAD:
+            self.attachment_downloader = PendingAttachmentDownloader(
+                account_id=self.account_id,
+                namespace_id=self.namespace_id,
+                provider_name=self.provider_name)
+            self.attachment_downloader.start()
+
     def sync(self):
         try:
             self.start_delete_handler()
+            self.start_attachment_downloader()
             self.start_new_folder_sync_engines()
             while True:
                 sleep(self.refresh_frequency)
@@ -4,7 +4,7 @@ from pympler import muppy, summary
 from werkzeug.serving import run_simple, WSGIRequestHandler
 from flask import Flask, jsonify, request
 from inbox.instrumentation import (GreenletTracer, KillerGreenletTracer,
-                                   ProfileCollector)
+                                   ProfileCollector, sync_phase_timer)
 
 
 class HTTPFrontend(object):
@@ -98,6 +98,13 @@ class SyncHTTPFrontend(ProfilingHTTPFrontend):
             else:
                 return 'Account not assigned to this process', 409
 
+        @app.route('/sync-phases')
+        def sync_phases():
+            resp = jsonify(sync_phase_timer.stats())
+            if request.args.get('reset') in ('1', 'true'):
+                sync_phase_timer.reset()
+            return resp
+
         @app.route('/build-metadata', methods=['GET'])
         def build_metadata():
             filename = '/usr/share/python/cloud-core/metadata.txt'
@@ -1,17 +1,21 @@
 import datetime
+from collections import defaultdict
 
 import gevent
 from sqlalchemy import func
-from sqlalchemy.orm import load_only
+from sqlalchemy.orm import load_only, subqueryload
 from nylas.logging import get_logger
 log = get_logger()
-from inbox.models import Message, Thread
+from inbox.config import config
+from inbox.models import (Message, Thread, Block, Part, Transaction,
+                          MessageContactAssociation)
 from inbox.models.category import Category, EPOCH
 from inbox.models.message import MessageCategory
 from inbox.models.folder import Folder
 from inbox.models.session import session_scope
 from inbox.util.concurrency import retry_with_logging
 from inbox.util.itert import chunk
+from inbox.util.throttle import get_throttle
 from inbox.mailsync.backends.imap import common
 from inbox.util.debug import bind_context
 from inbox.mailsync.backends.imap.generic import uidvalidity_cb
@@ -20,7 +24,11 @@ from imapclient.imap_utf7 import encode as utf7_encode
 
 DEFAULT_MESSAGE_TTL = 2 * 60            # 2 minutes
 DEFAULT_THREAD_TTL = 60 * 60 * 24 * 7   # 7 days
+# Number of messages or threads garbage-collected per database transaction.
 MAX_FETCH = 1000
+# Whether sync's DeleteHandlers pace bulk garbage collection (e.g. of a
+# freshly emptied Trash) by the shard's AdaptiveThrottle.
+THROTTLE_DELETION = config.get('THROTTLE_DELETION', False)
 
 
 class DeleteHandler(gevent.Greenlet):
@@ -36,6 +44,11 @@ class DeleteHandler(gevent.Greenlet):
 
     It also periodically deletes categories which have no associated messages.
 
+    Messages and threads are collected in id-ordered windows of at most
+    MAX_FETCH, with bulk SQL statements and one commit per window, writing
+    the Transactions API clients need directly rather than through the ORM's
+    versioning hooks.
+
     Parameters
     ----------
     account_id, namespace_id: int
@@ -47,11 +60,14 @@ class DeleteHandler(gevent.Greenlet):
     message_ttl: int
         Number of seconds to wait after a message is marked for deletion before
         deleting it for good.
+    throttle: bool
+        Whether to size and pace windows by the shard's AdaptiveThrottle.
 
     """
 
     def __init__(self, account_id, namespace_id, provider_name, uid_accessor,
-                 message_ttl=DEFAULT_MESSAGE_TTL, thread_ttl=DEFAULT_THREAD_TTL):
+                 message_ttl=DEFAULT_MESSAGE_TTL, thread_ttl=DEFAULT_THREAD_TTL,
+                 throttle=False):
         bind_context(self, 'deletehandler', account_id)
         self.account_id = account_id
         self.namespace_id = namespace_id
@@ -60,6 +76,7 @@ class DeleteHandler(gevent.Greenlet):
         self.log = log.new(account_id=account_id)
         self.message_ttl = datetime.timedelta(seconds=message_ttl)
         self.thread_ttl = datetime.timedelta(seconds=thread_ttl)
+        self.throttle = throttle
         gevent.Greenlet.__init__(self)
 
     def _run(self):
@@ -74,60 +91,169 @@ class DeleteHandler(gevent.Greenlet):
         self.gc_deleted_threads(current_time)
         gevent.sleep(self.message_ttl.total_seconds())
 
+    def _wait_for_throttle(self):
+        # Returns the size of the next window.
+        throttle = get_throttle(self.namespace_id, self.throttle, MAX_FETCH)
+        throttle.wait()
+        return min(MAX_FETCH, throttle.batch_size)
+
+    def _write_transactions(self, db_session, entries):
+        # entries: (object_type, record_id, object_public_id, command)
+        if not entries:
+            return
+        db_session.execute(Transaction.__table__.insert(), [
+            dict(namespace_id=self.namespace_id, object_type=object_type,
+                 record_id=record_id, object_public_id=public_id,
+                 command=command)
+            for object_type, record_id, public_id, command in entries],
+            mapper=Transaction)
+
     def check(self, current_time):
-        with session_scope(self.namespace_id) as db_session:
-            dangling_messages = db_session.query(Message).filter(
-                Message.namespace_id == self.namespace_id,
-                Message.deleted_at <= current_time - self.message_ttl
-            ).limit(MAX_FETCH)
-            for message in dangling_messages:
-                # If the message isn't *actually* dangling (i.e., it has
-                # imapuids associated with it), undelete it.
-                if self.uids_for_message(message):
-                    message.deleted_at = None
-                    continue
-
-                thread = message.thread
-
-                if not thread or message not in thread.messages:
-                    self.log.warning("Running delete handler check but message"
-                                     " is not part of referenced thread: {}",
-                                     thread_id=thread.id)
-                    # Nothing to check
-                    continue
-
-                # Remove message from thread, so that the change to the thread
-                # gets properly versioned.
-                thread.messages.remove(message)
-                # Also need to explicitly delete, so that message shows up in
-                # db_session.deleted.
-                db_session.delete(message)
-                if not thread.messages:
-                    # We don't eagerly delete empty Threads because there's a
-                    # race condition between deleting a Thread and creating a
-                    # new Message that refers to the old deleted Thread.
-                    thread.mark_for_deletion()
-                else:
-                    # TODO(emfree): This is messy. We need better
-                    # abstractions for recomputing a thread's attributes
-                    # from messages, here and in mail sync.
-                    non_draft_messages = [m for m in thread.messages if not
-                                          m.is_draft]
-                    if not non_draft_messages:
-                        continue
-                    # The value of thread.messages is ordered oldest-to-newest.
+        last_id = 0
+        while True:
+            window_size = self._wait_for_throttle()
+            # Deletions happen outside the ORM, so the session isn't
+            # versioned; _delete_messages writes the Transactions instead.
+            with session_scope(self.namespace_id, versioned=False) as \
+                    db_session:
+                messages = db_session.query(Message).filter(
+                    Message.namespace_id == self.namespace_id,
+                    Message.deleted_at <= current_time - self.message_ttl,
+                    Message.id > last_id
+                ).options(
+                    load_only('id', 'public_id', 'thread_id', 'is_draft',
+                              'deleted_at'),
+                    subqueryload('imapuids')
+                ).order_by(Message.id).limit(window_size).all()
+                if not messages:
+                    return
+                last_id = messages[-1].id
+
+                dangling_messages = []
+                transactions = []
+                for message in messages:
+                    # If the message isn't *actually* dangling (i.e., it has
+                    # imapuids associated with it), undelete it.
+                    if self.uids_for_message(message):
+                        message.deleted_at = None
+                        transactions.append((message.API_OBJECT_NAME,
+                                             message.id, message.public_id,
+                                             'update'))
+                    else:
+                        dangling_messages.append(message)
+
+                if dangling_messages:
+                    transactions.extend(
+                        self._delete_messages(db_session, dangling_messages))
+                self._write_transactions(db_session, transactions)
+                db_session.commit()
+                self.log.info('Garbage collected messages',
+                              deleted=len(dangling_messages),
+                              undeleted=len(messages) -
+                              len(dangling_messages))
+
+            if len(messages) < window_size:
+                return
+
+    def _delete_messages(self, db_session, messages):
+        """
+        Delete the given messages along with their parts, categories, contact
+        associations and blocks not used by other messages, and update their
+        threads. Returns the Transactions to write.
+
+        """
+        message_ids = [message.id for message in messages]
+        transactions = [(message.API_OBJECT_NAME, message.id,
+                         message.public_id, 'delete') for message in messages]
+
+        parts = db_session.query(Part.block_id, Part.content_disposition). \
+            filter(Part.message_id.in_(message_ids)).all()
+        block_ids = {block_id for block_id, _ in parts
+                     if block_id is not None}
+        # Only attachments are versioned, see
+        # Block.should_suppress_transaction_creation
+        attachment_block_ids = {block_id for block_id, disposition in parts
+                                if disposition is not None}
+
+        for cls, column in [(MessageCategory, MessageCategory.message_id),
+                            (MessageContactAssociation,
+                             MessageContactAssociation.message_id),
+                            (Part, Part.message_id)]:
+            db_session.query(cls).filter(column.in_(message_ids)). \
+                delete(synchronize_session=False)
+
+        if block_ids:
+            used_block_ids = {block_id for block_id, in
+                              db_session.query(Part.block_id).filter(
+                                  Part.block_id.in_(block_ids))}
+            orphaned_blocks = db_session.query(Block.id, Block.public_id). \
+                filter(Block.namespace_id == self.namespace_id,
+                       Block.id.in_(block_ids - used_block_ids)).all()
+            if orphaned_blocks:
+                transactions.extend(
+                    ('file', block_id, public_id, 'delete')
+                    for block_id, public_id in orphaned_blocks
+                    if block_id in attachment_block_ids)
+                db_session.query(Block).filter(
+                    Block.id.in_([block_id for block_id, _ in
+                                  orphaned_blocks])). \
+                    delete(synchronize_session=False)
+
+        # Drafts which were replies to these messages, as the
+        # reply_to_message relationship does for ORM deletes.
+        db_session.query(Message).filter(
+            Message.namespace_id == self.namespace_id,
+            Message.is_created == True,  # noqa
+            Message.reply_to_message_id.in_(message_ids)). \
+            update({'reply_to_message_id': None}, synchronize_session=False)
+
+        # Remaining rows referencing the messages (e.g. search terms or
+        # events) go away through ON DELETE CASCADE foreign keys.
+        db_session.query(Message).filter(Message.id.in_(message_ids)). \
+            delete(synchronize_session=False)
+        for message in messages:
+            db_session.expunge(message)
+
+        thread_ids = {message.thread_id for message in messages}
+        transactions.extend(self._update_threads(db_session, thread_ids))
+        return transactions
+
+    def _update_threads(self, db_session, thread_ids):
+        remaining_messages = defaultdict(list)
+        # Ordered oldest-to-newest, like thread.messages.
+        for message in db_session.query(Message).filter(
+                Message.thread_id.in_(thread_ids)).options(
+                    load_only('thread_id', 'is_draft', 'subject',
+                              'received_date', 'snippet')). \
+                order_by(Message.received_date):
+            remaining_messages[message.thread_id].append(message)
+
+        transactions = []
+        threads = db_session.query(Thread).filter(Thread.id.in_(thread_ids))
+        for thread in threads:
+            messages = remaining_messages[thread.id]
+            if not messages:
+                # We don't eagerly delete empty Threads because there's a
+                # race condition between deleting a Thread and creating a
+                # new Message that refers to the old deleted Thread.
+                thread.mark_for_deletion()
+            else:
+                # TODO(emfree): This is messy. We need better
+                # abstractions for recomputing a thread's attributes
+                # from messages, here and in mail sync.
+                non_draft_messages = [m for m in messages if not m.is_draft]
+                if non_draft_messages:
                     first_message = non_draft_messages[0]
                     last_message = non_draft_messages[-1]
                     thread.subject = first_message.subject
                     thread.subjectdate = first_message.received_date
                     thread.recentdate = last_message.received_date
                     thread.snippet = last_message.snippet
-                # YES this is at the right indentation level. Delete statements
-                # may cause InnoDB index locks to be acquired, so we opt to
-                # simply commit after each delete in order to prevent bulk
-                # delete scenarios from creating a long-running, blocking
-                # transaction.
-                db_session.commit()
+            # The thread's messages changed.
+            thread.version = Thread.version + 1
+            transactions.append(('thread', thread.id, thread.public_id,
+                                 'update'))
+        return transactions
 
     def gc_deleted_categories(self):
         # Delete categories which have been deleted on the backend.
@@ -149,19 +275,49 @@ class DeleteHandler(gevent.Greenlet):
                     db_session.commit()
 
     def gc_deleted_threads(self, current_time):
-        with session_scope(self.namespace_id) as db_session:
-            deleted_threads = db_session.query(Thread).filter(
-                Thread.namespace_id == self.namespace_id,
-                Thread.deleted_at <= current_time - self.thread_ttl
-            ).limit(MAX_FETCH)
-            for thread in deleted_threads:
-                if thread.messages:
-                    thread.deleted_at = None
-                    db_session.commit()
-                    continue
-                db_session.delete(thread)
+        last_id = 0
+        while True:
+            window_size = self._wait_for_throttle()
+            with session_scope(self.namespace_id, versioned=False) as \
+                    db_session:
+                threads = db_session.query(Thread.id, Thread.public_id). \
+                    filter(Thread.namespace_id == self.namespace_id,
+                           Thread.deleted_at <= current_time - self.thread_ttl,
+                           Thread.id > last_id). \
+                    order_by(Thread.id).limit(window_size).all()
+                if not threads:
+                    return
+                last_id = threads[-1].id
+
+                thread_ids = [thread_id for thread_id, _ in threads]
+                # Threads which got new messages since they were marked.
+                live_thread_ids = {thread_id for thread_id, in
+                                   db_session.query(Message.thread_id).filter(
+                                       Message.thread_id.in_(thread_ids)).
+                                   distinct()}
+                deleted_thread_ids = [thread_id for thread_id in thread_ids
+                                      if thread_id not in live_thread_ids]
+
+                if live_thread_ids:
+                    db_session.query(Thread).filter(
+                        Thread.id.in_(live_thread_ids)). \
+                        update({'deleted_at': None},
+                               synchronize_session=False)
+                if deleted_thread_ids:
+                    # Provider-specific thread rows go away through ON DELETE
+                    # CASCADE foreign keys.
+                    db_session.query(Thread).filter(
+                        Thread.id.in_(deleted_thread_ids)). \
+                        delete(synchronize_session=False)
+                self._write_transactions(db_session, [
+                    ('thread', thread_id, public_id,
+                     'update' if thread_id in live_thread_ids else 'delete')
+                    for thread_id, public_id in threads])
                 db_session.commit()
 
+            if len(threads) < window_size:
+                return
+
 
 class LabelRenameHandler(gevent.Greenlet):
     """
@@ -17,6 +17,7 @@ from inbox.models.session import session_scope, global_session_scope
 from inbox.models import Account
 from inbox.scheduling.event_queue import EventQueue, EventQueueGroup
 from inbox.util.concurrency import retry_with_logging
+from inbox.util.mime_parsing import start_parser_pool
 from inbox.util.stats import statsd_client
 
 from inbox.mailsync.backends import module_registry
@@ -31,6 +32,10 @@ PENDING_AVGS_THRESHOLD = 10
 
 MAX_ACCOUNTS_PER_PROCESS = config.get('MAX_ACCOUNTS_PER_PROCESS', 150)
 
+# Number of worker processes used to parse synced messages. If 0, messages
+# are parsed inline in the sync greenlets.
+MIME_PARSER_PROCESSES = config.get('MIME_PARSER_PROCESSES', 0)
+
 SYNC_EVENT_QUEUE_NAME = 'sync:event_queue:{}'
 SHARED_SYNC_EVENT_QUEUE_NAME = 'sync:shared_event_queue:{}'
 
@@ -98,6 +103,7 @@ class SyncService(object):
         ])
 
         self.stealing_enabled = config.get('SYNC_STEAL_ACCOUNTS', True)
+        start_parser_pool(MIME_PARSER_PROCESSES)
         self._pending_avgs_provider = None
         self.last_unloaded_account = time.time()
 
@@ -315,6 +315,11 @@ class Account(MailSyncBase, HasPublicID, HasEmailAddress, HasRunState,
         # account class.
         raise NotImplementedError
 
+    def get_raw_part_contents(self, message, part):
+        # Get the decoded contents of a single MIME part of a message, without
+        # fetching the whole message. Returns None if the backend can't.
+        return None
+
     discriminator = Column('type', String(16))
     __mapper_args__ = {'polymorphic_identity': 'account',
                        'polymorphic_on': discriminator}
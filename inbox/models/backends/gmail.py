@@ -320,6 +320,11 @@ class GmailAccount(OAuthAccount, ImapAccount):
         from inbox.s3.backends.gmail import get_gmail_raw_contents
         return get_gmail_raw_contents(message)
 
+    def get_raw_part_contents(self, message, part):
+        # Like raw messages, fetch through the API rather than use up one of
+        # the account's IMAP connections.
+        return None
+
 
 class GmailAuthCredentials(MailSyncBase, UpdatedAtMixin, DeletedAtMixin):
     """
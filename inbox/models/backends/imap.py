@@ -71,6 +71,10 @@ class ImapAccount(Account):
         from inbox.s3.backends.imap import get_imap_raw_contents
         return get_imap_raw_contents(message)
 
+    def get_raw_part_contents(self, message, part):
+        from inbox.s3.backends.imap import get_imap_part_contents
+        return get_imap_part_contents(message, part)
+
     __mapper_args__ = {'polymorphic_identity': 'imapaccount'}
 
 
@@ -1,7 +1,7 @@
 from sqlalchemy import (Column, Integer, String, Boolean, Enum, ForeignKey,
                         event)
 from sqlalchemy.orm import reconstructor, relationship, backref
-from sqlalchemy.schema import UniqueConstraint
+from sqlalchemy.schema import Index, UniqueConstraint
 from sqlalchemy.sql.expression import false
 
 from inbox.models.roles import Blob
@@ -68,6 +68,11 @@ class Block(Blob, MailSyncBase, HasRevisions, HasPublicID,
             self.content_type = self._content_type_other
 
 
+# Used to check whether blobs are still referenced before garbage collecting
+# them, see inbox.util.blockstore_gc.
+Index('ix_block_data_sha256', Block.data_sha256)
+
+
 @event.listens_for(Block, 'before_insert', propagate=True)
 def serialize_before_insert(mapper, connection, target):
     if target.content_type in COMMON_CONTENT_TYPES:
@@ -100,6 +105,10 @@ class Part(MailSyncBase, UpdatedAtMixin, DeletedAtMixin):
     # https://www.ietf.org/rfc/rfc2183.txt
     content_disposition = Column(Enum('inline', 'attachment'), nullable=True)
     content_id = Column(String(255))  # For attachments
+    # IMAP section (RFC 3501) and Content-Transfer-Encoding of the part in
+    # the raw message, used to fetch just this part from the provider.
+    section = Column(String(64), nullable=True)
+    transfer_encoding = Column(String(32), nullable=True)
 
     is_inboxapp_attachment = Column(Boolean, server_default=false())
 
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, ForeignKey
+from sqlalchemy import BigInteger, Column, ForeignKey
 from sqlalchemy.schema import UniqueConstraint
 from sqlalchemy.dialects.mysql import MEDIUMBLOB
 from sqlalchemy import DateTime
@@ -21,6 +21,12 @@ class DataProcessingCache(MailSyncBase, UpdatedAtMixin, DeletedAtMixin):
     _contact_groups = Column('contact_groups', MEDIUMBLOB)
     contact_rankings_last_updated = Column(DateTime)
     contact_groups_last_updated = Column(DateTime)
+    # Sent message counts the rankings and groups are computed from, see
+    # inbox.contacts.scores.
+    _contact_score_state = Column('contact_score_state', MEDIUMBLOB)
+    # Id of the last message counted in contact_score_state.
+    contact_score_state_message_id = Column(BigInteger)
+    contact_score_state_rebuilt_at = Column(DateTime)
 
     @property
     def contact_rankings(self):
@@ -47,4 +53,16 @@ class DataProcessingCache(MailSyncBase, UpdatedAtMixin, DeletedAtMixin):
         self._contact_groups = zlib.compress(json.dumps(value).encode('utf-8'))
         self.contact_groups_last_updated = datetime.datetime.now()
 
+    @property
+    def contact_score_state(self):
+        if self._contact_score_state is None:
+            return None
+        else:
+            return json.loads(zlib.decompress(self._contact_score_state))
+
+    @contact_score_state.setter
+    def contact_score_state(self, value):
+        self._contact_score_state = \
+            zlib.compress(json.dumps(value).encode('utf-8'))
+
     __table_args__ = (UniqueConstraint('namespace_id'),)
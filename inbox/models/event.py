@@ -420,24 +420,34 @@ class RecurringEvent(Event):
             elif item.startswith('EXDATE'):
                 self.exdate = item
 
-    def all_events(self, start=None, end=None):
+    def all_events(self, start=None, end=None, overrides=None):
         # Returns all inflated events along with overrides that match the
         # provided time range.
-        overrides = self.overrides
-        if start:
-            overrides = overrides.filter(RecurringEventOverride.start > start)
-        if end:
-            overrides = overrides.filter(RecurringEventOverride.end < end)
-
-        # Google calendar events have the same uid __globally_. This means
-        # that if I created an event, shared it with you and that I also
-        # shared my calendar with you, override to this events for calendar B
-        # may show up in a query for calendar A.
-        # (https://phab.nylas.com/T3420)
-        overrides = overrides.filter(
-            RecurringEventOverride.calendar_id == self.calendar_id)
-
-        events = list(overrides)
+        # `overrides` may be passed in by callers which loaded the overrides
+        # of many recurring events at once; they're filtered the same way
+        # as the query below.
+        if overrides is not None:
+            events = [o for o in overrides
+                      if (not start or o.start > start) and
+                      (not end or (o.end is not None and o.end < end)) and
+                      o.calendar_id == self.calendar_id]
+        else:
+            overrides = self.overrides
+            if start:
+                overrides = overrides.filter(
+                    RecurringEventOverride.start > start)
+            if end:
+                overrides = overrides.filter(RecurringEventOverride.end < end)
+
+            # Google calendar events have the same uid __globally_. This
+            # means that if I created an event, shared it with you and that I
+            # also shared my calendar with you, override to this events for
+            # calendar B may show up in a query for calendar A.
+            # (https://phab.nylas.com/T3420)
+            overrides = overrides.filter(
+                RecurringEventOverride.calendar_id == self.calendar_id)
+
+            events = list(overrides)
         overridden_starts = [e.original_start_time for e in events]
         # Remove cancellations from the override set
         events = filter(lambda e: not e.cancelled, events)
@@ -1,11 +1,8 @@
 import os
-import binascii
 import datetime
 import itertools
-from hashlib import sha256
 from collections import defaultdict
 
-from flanker import mime
 from sqlalchemy import (Column, Integer, BigInteger, String, DateTime,
                         Boolean, Enum, Index, bindparam)
 from sqlalchemy.dialects.mysql import LONGBLOB
@@ -18,9 +15,9 @@ from nylas.logging import get_logger
 log = get_logger()
 from inbox.util.html import plaintext2html, strip_tags
 from inbox.sqlalchemy_ext.util import JSON, json_field_too_long, bakery
-from inbox.util.addr import parse_mimepart_address_header
 from inbox.util.misc import parse_references, get_internaldate
 from inbox.util.blockstore import save_to_blockstore
+from inbox.util.mime_parsing import parse_message
 from inbox.security.blobstorage import encode_blob, decode_blob
 from inbox.models.mixins import (HasPublicID, HasRevisions, UpdatedAtMixin,
                                  DeletedAtMixin)
@@ -221,7 +218,8 @@ class Message(MailSyncBase, HasRevisions, HasPublicID, UpdatedAtMixin,
 
     @classmethod
     def create_from_synced(cls, account, mid, folder_name, received_date,
-                           body_string):
+                           body_string, deferred_sections=None,
+                           provider_name=None):
         """
         Parses message data and writes out db metadata and MIME blocks.
 
@@ -239,7 +237,21 @@ class Message(MailSyncBase, HasRevisions, HasPublicID, UpdatedAtMixin,
         raw_message : str
             The full message including headers (encoded).
 
+        deferred_sections : dict, optional
+            If body_string is a message downloaded without its attachments
+            (see CrispinClient.uids_without_attachments), maps the IMAP
+            sections of the parts left out to their approximate size. Their
+            blocks are saved as pending, and the incomplete message isn't
+            persisted.
+
+        provider_name : str, optional
+            Provider under which to report the time spent parsing and
+            saving the message, see inbox.instrumentation.SyncPhaseTimer.
+
         """
+        # Imported here, inbox.instrumentation depending on inbox.models.
+        from inbox.instrumentation import sync_phase_timer
+
         _rqd = [account, mid, folder_name, body_string]
         if not all([v is not None for v in _rqd]):
             raise ValueError(
@@ -251,45 +263,44 @@ class Message(MailSyncBase, HasRevisions, HasPublicID, UpdatedAtMixin,
 
         msg = Message()
 
-        msg.data_sha256 = sha256(body_string).hexdigest()
+        # Hashing and MIME parsing may happen in a worker process; only the
+        # ORM objects are built here.
+        with sync_phase_timer.time('parse', provider_name):
+            parsed, parsed_body = parse_message(body_string)
+        if deferred_sections is None:
+            msg.data_sha256 = parsed.data_sha256
 
-        # Persist the raw MIME message to disk/ S3
-        save_to_blockstore(msg.data_sha256, body_string)
+            # Persist the raw MIME message to disk/ S3
+            with sync_phase_timer.time('blockstore', provider_name):
+                save_to_blockstore(msg.data_sha256, body_string)
 
         # Persist the processed message to the database
         msg.namespace_id = account.namespace.id
 
-        try:
-            parsed = mime.from_string(body_string)
-            # Non-persisted instance attribute used by EAS.
-            msg.parsed_body = parsed
-            msg._parse_metadata(parsed, body_string, received_date, account.id,
-                                folder_name, mid)
-        except (mime.DecodingError, AttributeError, RuntimeError,
-                TypeError) as e:
-            parsed = None
-            # Non-persisted instance attribute used by EAS.
+        # Non-persisted instance attribute used by EAS. Only available if the
+        # message was parsed in this process.
+        msg.parsed_body = parsed_body
+        error = parsed.error
+        if error is None:
+            try:
+                msg._parse_metadata(parsed.headers, body_string,
+                                    received_date, account.id, folder_name,
+                                    mid)
+            except (AttributeError, RuntimeError, TypeError) as e:
+                error = e
+        if error is not None:
             msg.parsed_body = ''
             log.error('Error parsing message metadata',
-                      folder_name=folder_name, account_id=account.id, error=e)
+                      folder_name=folder_name, account_id=account.id,
+                      error=error)
             msg._mark_error()
-
-        if parsed is not None:
+        else:
             plain_parts = []
             html_parts = []
-            for mimepart in parsed.walk(
-                    with_self=parsed.content_type.is_singlepart()):
-                try:
-                    if mimepart.content_type.is_multipart():
-                        continue  # TODO should we store relations?
-                    msg._parse_mimepart(mid, mimepart, account.namespace.id,
-                                        html_parts, plain_parts)
-                except (mime.DecodingError, AttributeError, RuntimeError,
-                        TypeError, binascii.Error, UnicodeDecodeError) as e:
-                    log.error('Error parsing message MIME parts',
-                              folder_name=folder_name, account_id=account.id,
-                              error=e)
-                    msg._mark_error()
+            for part in parsed.parts:
+                msg._add_parsed_part(mid, part, account.namespace.id,
+                                     html_parts, plain_parts, folder_name,
+                                     account.id, deferred_sections)
             msg.calculate_body(html_parts, plain_parts)
 
             # Occasionally people try to send messages to way too many
@@ -307,37 +318,36 @@ class Message(MailSyncBase, HasRevisions, HasPublicID, UpdatedAtMixin,
 
         return msg
 
-    def _parse_metadata(self, parsed, body_string, received_date,
+    def _parse_metadata(self, headers, body_string, received_date,
                         account_id, folder_name, mid):
-        mime_version = parsed.headers.get('Mime-Version')
+        mime_version = headers['mime_version']
         # sometimes MIME-Version is '1.0 (1.0)', hence the .startswith()
         if mime_version is not None and not mime_version.startswith('1.0'):
             log.warning('Unexpected MIME-Version',
                         account_id=account_id, folder_name=folder_name,
                         mid=mid, mime_version=mime_version)
 
-        self.subject = parsed.subject
-        self.from_addr = parse_mimepart_address_header(parsed, 'From')
-        self.sender_addr = parse_mimepart_address_header(parsed, 'Sender')
-        self.reply_to = parse_mimepart_address_header(parsed, 'Reply-To')
-        self.to_addr = parse_mimepart_address_header(parsed, 'To')
-        self.cc_addr = parse_mimepart_address_header(parsed, 'Cc')
-        self.bcc_addr = parse_mimepart_address_header(parsed, 'Bcc')
+        self.subject = headers['subject']
+        self.from_addr = headers['from_addr']
+        self.sender_addr = headers['sender_addr']
+        self.reply_to = headers['reply_to']
+        self.to_addr = headers['to_addr']
+        self.cc_addr = headers['cc_addr']
+        self.bcc_addr = headers['bcc_addr']
 
-        self.in_reply_to = parsed.headers.get('In-Reply-To')
+        self.in_reply_to = headers['in_reply_to']
 
         # The RFC mandates that the Message-Id header must be at most 998
         # characters. Sadly, not everybody follows specs.
-        self.message_id_header = parsed.headers.get('Message-Id')
+        self.message_id_header = headers['message_id_header']
         if self.message_id_header and len(self.message_id_header) > 998:
             self.message_id_header = self.message_id_header[:998]
             log.warning('Message-Id header too long. Truncating',
-                        parsed.headers.get('Message-Id'),
+                        headers['message_id_header'],
                         logstash_tag='truncated_message_id')
 
         self.received_date = received_date if received_date else \
-            get_internaldate(parsed.headers.get('Date'),
-                             parsed.headers.get('Received'))
+            get_internaldate(headers['date'], headers['received'])
 
         # It seems MySQL rounds up fractional seconds in a weird way,
         # preventing us from reconciling messages correctly. See:
@@ -346,73 +356,46 @@ class Message(MailSyncBase, HasRevisions, HasPublicID, UpdatedAtMixin,
         self.received_date = self.received_date.replace(microsecond=0)
 
         # Custom Nylas header
-        self.nylas_uid = parsed.headers.get('X-INBOX-ID')
+        self.nylas_uid = headers['nylas_uid']
 
         # In accordance with JWZ (http://www.jwz.org/doc/threading.html)
-        self.references = parse_references(
-            parsed.headers.get('References', ''),
-            parsed.headers.get('In-Reply-To', ''))
+        self.references = parse_references(headers['references'],
+                                           headers['in_reply_to'] or '')
 
         self.size = len(body_string)  # includes headers text
 
-    def _parse_mimepart(self, mid, mimepart, namespace_id, html_parts,
-                        plain_parts):
-        disposition, _ = mimepart.content_disposition
-        content_id = mimepart.headers.get('Content-Id')
-        content_type, params = mimepart.content_type
-
-        filename = mimepart.detected_file_name
-        if filename == '':
-            filename = None
-
-        data = mimepart.body
-
-        is_text = content_type.startswith('text')
-        if disposition not in (None, 'inline', 'attachment'):
+    def _add_parsed_part(self, mid, part, namespace_id, html_parts,
+                         plain_parts, folder_name, account_id,
+                         deferred_sections=None):
+        if part.kind == 'error':
+            log.error('Error parsing message MIME parts',
+                      folder_name=folder_name, account_id=account_id,
+                      error=part.data)
+            self._mark_error()
+        elif part.kind == 'bad_disposition':
             log.error('Unknown Content-Disposition',
                       message_public_id=self.public_id,
-                      bad_content_disposition=mimepart.content_disposition)
+                      bad_content_disposition=part.content_disposition)
             self._mark_error()
-            return
-
-        if disposition == 'attachment':
-            self._save_attachment(data, disposition, content_type,
-                                  filename, content_id, namespace_id, mid)
-            return
-
-        if (disposition == 'inline' and
-                not (is_text and filename is None and content_id is None)):
-            # Some clients set Content-Disposition: inline on text MIME parts
-            # that we really want to treat as part of the text body. Don't
-            # treat those as attachments.
-            self._save_attachment(data, disposition, content_type,
-                                  filename, content_id, namespace_id, mid)
-            return
-
-        if is_text:
-            if data is None:
-                return
-            normalized_data = data.encode('utf-8', 'strict')
-            normalized_data = normalized_data.replace('\r\n', '\n'). \
-                replace('\r', '\n')
-            if content_type == 'text/html':
-                html_parts.append(normalized_data)
-            elif content_type == 'text/plain':
-                plain_parts.append(normalized_data)
-            else:
+        elif part.kind == 'html':
+            html_parts.append(part.data)
+        elif part.kind == 'plain':
+            plain_parts.append(part.data)
+        else:
+            if part.kind == 'text_attachment':
                 log.info('Saving other text MIME part as attachment',
-                         content_type=content_type, namespace_id=namespace_id)
-                self._save_attachment(data, 'attachment', content_type,
-                                      filename, content_id, namespace_id, mid)
-            return
-
-        # Finally, if we get a non-text MIME part without Content-Disposition,
-        # treat it as an attachment.
-        self._save_attachment(data, 'attachment', content_type,
-                              filename, content_id, namespace_id, mid)
+                         content_type=part.content_type,
+                         namespace_id=namespace_id)
+            self._save_attachment(part.data, part.content_disposition,
+                                  part.content_type, part.filename,
+                                  part.content_id, namespace_id, mid,
+                                  part.section, part.transfer_encoding,
+                                  (deferred_sections or {}).get(part.section))
 
     def _save_attachment(self, data, content_disposition, content_type,
-                         filename, content_id, namespace_id, mid):
+                         filename, content_id, namespace_id, mid,
+                         section=None, transfer_encoding=None,
+                         deferred_size=None):
         from inbox.models import Part, Block
         block = Block()
         block.namespace_id = namespace_id
@@ -423,6 +406,14 @@ class Message(MailSyncBase, HasRevisions, HasPublicID, UpdatedAtMixin,
             content_id = content_id[:255]
         part.content_id = content_id
         part.content_disposition = content_disposition
+        if section is not None and len(section) <= 64:
+            part.section = section
+            part.transfer_encoding = (transfer_encoding or '')[:32] or None
+            if deferred_size:
+                # The attachment wasn't downloaded: save a pending block,
+                # whose data is fetched on first access (see Blob.data).
+                block.size = deferred_size
+                return
         data = data or ''
         if isinstance(data, unicode):
             data = data.encode('utf-8', 'strict')
@@ -620,6 +611,11 @@ Index('ix_message_namespace_id_message_id_header_subject',
       Message.namespace_id, Message.subject, Message.message_id_header,
       mysql_length={'subject': 191, 'message_id_header': 191})
 
+# For threading on Message-Id/In-Reply-To/References.
+Index('ix_message_namespace_id_message_id_header',
+      Message.namespace_id, Message.message_id_header,
+      mysql_length={'message_id_header': 191})
+
 
 class MessageCategory(MailSyncBase):
     """ Mapping between messages and categories. """
@@ -15,7 +15,9 @@ def load_models():
     from inbox.models.folder import Folder
     from inbox.models.message import Message, MessageCategory
     from inbox.models.namespace import Namespace
-    from inbox.models.search import ContactSearchIndexCursor
+    from inbox.models.search import (ContactSearchIndexCursor,
+                                     MessageSearchIndexCursor,
+                                     MessageSearchTerm)
     from inbox.models.secret import Secret
     from inbox.models.thread import Thread
     from inbox.models.transaction import Transaction, AccountTransaction
@@ -28,5 +30,6 @@ def load_models():
                DataProcessingCache, Event, Folder,
                Message, Namespace, ContactSearchIndexCursor, Secret,
                Thread, Transaction, When, Time, TimeSpan, Date, DateSpan,
-               Label, Category, MessageCategory, Metadata, AccountTransaction]
+               Label, Category, MessageCategory, Metadata, AccountTransaction,
+               MessageSearchIndexCursor, MessageSearchTerm]
     return exports
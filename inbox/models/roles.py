@@ -6,7 +6,8 @@ from nylas.logging import get_logger
 log = get_logger()
 from inbox.config import config
 from inbox.util import blockstore
-from inbox.s3.base import get_raw_from_provider
+from inbox.util.mime_parsing import parse_message
+from inbox.s3.base import get_raw_from_provider, get_raw_part_from_provider
 from inbox.util.stats import statsd_client
 
 # TODO: store AWS credentials in a better way.
@@ -14,10 +15,22 @@ STORE_MSG_ON_S3 = config.get('STORE_MESSAGES_ON_S3', None)
 
 
 class Blob(object):
-    """ A blob of data that can be saved to local or remote (S3) disk. """
+    """
+    A blob of data that can be saved to local or remote (S3) disk.
+
+    Attachments synced without their data (see
+    CrispinClient.uids_without_attachments) are pending: they have no
+    data_sha256 yet and only an approximate size, until their data is
+    fetched from the provider on first access.
+
+    """
     size = Column(Integer, default=0)
     data_sha256 = Column(String(64))
 
+    @property
+    def is_pending(self):
+        return self.data_sha256 is None and bool(self.size)
+
     @property
     def data(self):
         if self.size == 0:
@@ -26,6 +39,8 @@ class Blob(object):
         elif hasattr(self, '_data'):
             # On initial download we temporarily store data in memory
             value = self._data
+        elif self.is_pending:
+            return self._fetch_pending_data()
         else:
             value = blockstore.get_from_blockstore(self.data_sha256)
 
@@ -40,7 +55,8 @@ class Blob(object):
                     # deleted. We will attempt to fetch the raw
                     # message and parse out the needed attachment.
 
-                    message = self.parts[0].message  # only grab one
+                    part = self.parts[0]  # only grab one
+                    message = part.message
                     account = message.namespace.account
 
                     statsd_string = 'api.direct_fetching.{}.{}'.format(
@@ -55,6 +71,13 @@ class Blob(object):
                     if raw_mime is None:
                         statsd_client.incr('{}.cache_misses'.format(statsd_string))
 
+                        # Fetch just this part if we know where it is in the
+                        # message, rather than the whole message.
+                        data = self._get_part_from_provider(message, part,
+                                                            statsd_string)
+                        if data is not None:
+                            return data
+
                         with statsd_client.timer('{}.provider_latency'.format(
                                                  statsd_string)):
                             raw_mime = get_raw_from_provider(message)
@@ -110,6 +133,97 @@ class Blob(object):
             "Returned data doesn't match stored hash!"
         return value
 
+    def _get_part_from_provider(self, message, part, statsd_string):
+        if part.section is None:
+            return None
+        with statsd_client.timer('{}.provider_part_latency'.format(
+                                 statsd_string)):
+            data = get_raw_part_from_provider(message, part)
+        if data is None:
+            return None
+        if sha256(data).hexdigest() != self.data_sha256:
+            # E.g. text parts, which were saved after charset decoding.
+            log.warning("Fetched part doesn't match block hash",
+                        message_id=message.id, section=part.section)
+            statsd_client.incr('{}.part_mismatches'.format(statsd_string))
+            return None
+
+        log.info('Fetched part with hash {}'.format(self.data_sha256),
+                 section=part.section)
+        with statsd_client.timer('{}.blockstore_save_latency'.format(
+                                 statsd_string)):
+            blockstore.save_to_blockstore(self.data_sha256, data)
+        return data
+
+    def _fetch_pending_data(self):
+        from inbox.models.block import Block
+        if not isinstance(self, Block) or not self.parts:
+            log.error('Pending blob without a message part')
+            return None
+
+        part = self.parts[0]
+        message = part.message
+        account = message.namespace.account
+        statsd_string = 'api.direct_fetching.{}.{}'.format(
+            account.provider, account.id)
+        statsd_client.incr('{}.pending_downloads'.format(statsd_string))
+
+        data = None
+        if part.section is not None:
+            with statsd_client.timer('{}.provider_part_latency'.format(
+                                     statsd_string)):
+                data = get_raw_part_from_provider(message, part)
+
+        if data is None:
+            # The backend can't fetch single parts: find the attachment in the
+            # full message.
+            with statsd_client.timer('{}.provider_latency'.format(
+                                     statsd_string)):
+                raw_mime = get_raw_from_provider(message)
+            if raw_mime is not None:
+                parsed, _ = parse_message(raw_mime)
+                for parsed_part in parsed.parts:
+                    if parsed_part.section == part.section and \
+                            parsed_part.kind != 'error':
+                        data = parsed_part.data
+                        break
+
+        if data is None:
+            log.error("Couldn't download pending attachment",
+                      message_id=message.id, section=part.section)
+            return None
+
+        log.info('Downloaded pending attachment', message_id=message.id,
+                 section=part.section, size=len(data))
+        # Sets the exact size and hash, and saves to the blockstore.
+        self.data = data
+        return data
+
+    def stream_data(self, start=0, stop=None,
+                    chunk_size=blockstore.STREAM_CHUNK_SIZE):
+        """
+        Returns an iterator over the bytes [start, stop) of the data in chunks
+        of at most `chunk_size` bytes, without loading the whole blob into
+        memory if it's in the blockstore. Otherwise falls back to `data` (and
+        thus to fetching it from the provider). Returns None if the data
+        can't be found.
+
+        """
+        if self.size == 0:
+            return iter([])
+        if not hasattr(self, '_data') and not self.is_pending:
+            stream = blockstore.stream_from_blockstore(
+                self.data_sha256, start, stop, chunk_size)
+            if stream is not None:
+                return stream
+
+        value = self.data
+        if value is None:
+            return None
+        value = value[start:stop]
+        return (value[i:i + chunk_size]
+                for i in xrange(0, len(value), chunk_size))
+
     @data.setter
     def data(self, value):
         assert value is not None
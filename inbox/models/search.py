@@ -1,6 +1,7 @@
-from sqlalchemy import Column, ForeignKey
+from sqlalchemy import BigInteger, Column, ForeignKey, Index, Integer, String
 
 from inbox.models.base import MailSyncBase
+from inbox.models.message import Message
 from inbox.models.mixins import UpdatedAtMixin, DeletedAtMixin
 from inbox.models.transaction import Transaction
 
@@ -14,3 +15,35 @@ class ContactSearchIndexCursor(MailSyncBase, UpdatedAtMixin,
     """
     transaction_id = Column(ForeignKey(Transaction.id), nullable=True,
                             index=True)
+
+
+class MessageSearchIndexCursor(MailSyncBase, UpdatedAtMixin,
+                               DeletedAtMixin):
+    """
+    Store the id of the last Transaction indexed into the local message
+    search index. Is namespace-agnostic.
+
+    """
+    transaction_id = Column(ForeignKey(Transaction.id), nullable=True,
+                            index=True)
+
+
+class MessageSearchTerm(MailSyncBase):
+    """
+    Inverted index of the words in a message's subject, participants and
+    body, used to search messages locally. There's one row per distinct
+    term of a message; `weight` is the term's frequency in the message,
+    weighted by the fields it appears in.
+
+    """
+    MAX_TERM_LENGTH = 64
+
+    namespace_id = Column(BigInteger, nullable=False)
+    term = Column(String(MAX_TERM_LENGTH), nullable=False)
+    message_id = Column(ForeignKey(Message.id, ondelete='CASCADE'),
+                        nullable=False)
+    weight = Column(Integer, nullable=False)
+
+Index('ix_messagesearchterm_namespace_id_term_message_id',
+      MessageSearchTerm.namespace_id, MessageSearchTerm.term,
+      MessageSearchTerm.message_id, unique=True)
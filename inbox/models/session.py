@@ -50,8 +50,10 @@ def new_session(engine, versioned=True):
                      'contextlib'])
         funcname = frame.f_code.co_name
         modname = modname.replace(".", "-")
-        metric_name = 'db.{}.{}.{}'.format(engine.url.database, modname,
-                                           funcname)
+        # Shard engines which share their host's connection pool don't
+        # have the schema in their URL.
+        schema_name = getattr(engine, 'schema_name', engine.url.database)
+        metric_name = 'db.{}.{}.{}'.format(schema_name, modname, funcname)
 
         @event.listens_for(session, 'after_begin')
         def after_begin(session, transaction, connection):
@@ -83,13 +85,15 @@ def new_session(engine, versioned=True):
 
 
 def configure_versioning(session):
-    from inbox.models.transaction import (create_revisions, propagate_changes,
+    from inbox.models.transaction import (RevisionRecorder, create_revisions,
+                                          propagate_changes,
                                           increment_versions)
+    recorder = RevisionRecorder()
 
     @event.listens_for(session, 'before_flush')
     def before_flush(session, flush_context, instances):
-        propagate_changes(session)
-        increment_versions(session)
+        propagate_changes(session, recorder)
+        increment_versions(session, recorder)
 
     @event.listens_for(session, 'after_flush')
     def after_flush(session, flush_context):
@@ -98,7 +102,18 @@ def configure_versioning(session):
         grab object IDs on new objects.
 
         """
-        create_revisions(session)
+        create_revisions(session, recorder)
+
+    @event.listens_for(session, 'before_commit')
+    def before_commit(session):
+        # Flush any remaining changes first so that their revisions are
+        # written in the same multi-row insert.
+        session.flush()
+        recorder.write(session)
+
+    @event.listens_for(session, 'after_rollback')
+    def after_rollback(session):
+        recorder.clear()
 
     return session
 
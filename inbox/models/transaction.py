@@ -1,3 +1,6 @@
+import itertools
+from collections import OrderedDict
+
 from sqlalchemy import (Column, BigInteger, String, Index, Enum,
                         inspect)
 from sqlalchemy.orm import relationship
@@ -53,13 +56,86 @@ def is_dirty(session, obj):
     return False
 
 
-def create_revisions(session):
-    for obj in session:
-        if (not isinstance(obj, HasRevisions) or
+class RevisionRecorder(object):
+    """
+    Accumulates transaction log entries for a versioned session and writes
+    them out right before the session commits.
+
+    Changes to the same object within a database transaction are coalesced
+    into a single entry (an insert followed by updates stays an insert, and
+    a delete supersedes anything before it), and all entries are written
+    with one multi-row INSERT per table.
+
+    """
+
+    def __init__(self):
+        # (object class, record id) -> entry dict, in order of first change.
+        self.pending = OrderedDict()
+        # Objects manually marked as dirty since the last flush.
+        self.marked_dirty = set()
+
+    def mark_dirty(self, obj):
+        obj.dirty = True
+        self.marked_dirty.add(obj)
+
+    def record(self, obj, revision_type):
+        assert revision_type in ('insert', 'update', 'delete')
+        key = (type(obj), obj.id)
+        entry = self.pending.get(key)
+        if entry is not None and entry['command'] == 'insert' and \
+                revision_type == 'update':
+            revision_type = 'insert'
+        # Message objects change their API object name when they become
+        # drafts, so always use the latest one.
+        self.pending[key] = dict(command=revision_type, record_id=obj.id,
+                                 object_type=obj.API_OBJECT_NAME,
+                                 object_public_id=obj.public_id,
+                                 namespace_id=obj.namespace.id)
+
+    def write(self, session):
+        if not self.pending:
+            return
+        entries = self.pending.values()
+        self.clear()
+
+        # Always create a Transaction record -- this maintains a total
+        # ordering over all events for an account.
+        session.execute(Transaction.__table__.insert(), entries,
+                        mapper=Transaction)
+
+        # Additionally, record account-level events in the
+        # AccountTransaction -- this is an optimization needed so these
+        # sparse events can be still be retrieved efficiently for webhooks
+        # etc.
+        account_entries = [e for e in entries if e['object_type'] == 'account']
+        if account_entries:
+            session.execute(AccountTransaction.__table__.insert(),
+                            account_entries, mapper=AccountTransaction)
+
+    def clear(self):
+        self.pending.clear()
+        self.marked_dirty.clear()
+
+
+def create_revisions(session, recorder):
+    """
+    Record revisions for the objects changed by a flush. Must be called from
+    an after_flush hook, while the session's new, dirty and deleted
+    collections still reflect the flushed changes.
+
+    """
+    changed = itertools.chain(session.new, session.deleted, session.dirty,
+                              recorder.marked_dirty)
+    seen = set()
+    for obj in changed:
+        if (obj in seen or not isinstance(obj, HasRevisions) or
                 obj.should_suppress_transaction_creation):
             continue
+        seen.add(obj)
         if obj in session.new:
-            create_revision(obj, session, 'insert')
+            recorder.record(obj, 'insert')
+        elif obj in session.deleted:
+            recorder.record(obj, 'delete')
         elif is_dirty(session, obj):
             # Need to unmark the object as 'dirty' to prevent an infinite loop
             # (the pre-flush hook may be called again before a commit
@@ -67,34 +143,11 @@ def create_revisions(session):
             # in that they are no longer present in the set during the next
             # invocation of the pre-flush hook.
             obj.dirty = False
-            create_revision(obj, session, 'update')
-        elif obj in session.deleted:
-            create_revision(obj, session, 'delete')
-
-
-def create_revision(obj, session, revision_type):
-    assert revision_type in ('insert', 'update', 'delete')
-
-    # Always create a Transaction record -- this maintains a total ordering over
-    # all events for an account.
-    revision = Transaction(command=revision_type, record_id=obj.id,
-                           object_type=obj.API_OBJECT_NAME,
-                           object_public_id=obj.public_id,
-                           namespace_id=obj.namespace.id)
-    session.add(revision)
-
-    # Additionally, record account-level events in the AccountTransaction --
-    # this is an optimization needed so these sparse events can be still be
-    # retrieved efficiently for webhooks etc.
-    if obj.API_OBJECT_NAME == 'account':
-        revision = AccountTransaction(command=revision_type, record_id=obj.id,
-                                      object_type=obj.API_OBJECT_NAME,
-                                      object_public_id=obj.public_id,
-                                      namespace_id=obj.namespace.id)
-        session.add(revision)
+            recorder.record(obj, 'update')
+    recorder.marked_dirty.clear()
 
 
-def propagate_changes(session):
+def propagate_changes(session, recorder):
     """
     Mark an object's related object as dirty when certain attributes of the
     object (its `propagated_attributes`) change.
@@ -109,13 +162,13 @@ def propagate_changes(session):
             for attr in obj.propagated_attributes:
                 if getattr(obj_state.attrs, attr).history.has_changes():
                     if obj.thread:
-                        obj.thread.dirty = True
+                        recorder.mark_dirty(obj.thread)
 
 
-def increment_versions(session):
+def increment_versions(session, recorder):
     from inbox.models.thread import Thread
     from inbox.models.metadata import Metadata
-    for obj in session:
+    for obj in set(session.dirty) | recorder.marked_dirty:
         if isinstance(obj, Thread) and is_dirty(session, obj):
             # This issues SQL for an atomic increment.
             obj.version = Thread.version + 1
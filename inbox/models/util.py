@@ -1,14 +1,14 @@
 import time
-import math
 import gevent
-import requests
-import datetime
 from collections import OrderedDict
+from gevent.lock import BoundedSemaphore
+from gevent.pool import Pool
 from sqlalchemy.orm.exc import NoResultFound
 
 from inbox.config import config
 from inbox.models import Account, Namespace
 from inbox.util.stats import statsd_client
+from inbox.util.throttle import get_throttle, get_shard_throttle
 from inbox.models.session import session_scope
 from nylas.logging.sentry import log_uncaught_errors
 from inbox.heartbeat.status import clear_heartbeat_status
@@ -17,6 +17,8 @@ from inbox.models.session import session_scope_by_shard_id
 from nylas.logging import get_logger
 
 CHUNK_SIZE = 1000
+# Number of accounts batch_delete_namespaces() deletes concurrently.
+DELETION_CONCURRENCY = config.get('ACCOUNT_DELETION_CONCURRENCY', 1)
 
 log = get_logger()
 
@@ -32,6 +34,10 @@ def reconcile_message(new_message, session):
     from inbox.models.message import Message
 
     if new_message.nylas_uid is None:
+        if new_message.data_sha256 is None:
+            # Downloaded without its attachments, so there's no hash to
+            # match on.
+            return None
         # try to reconcile using other means
         q = session.query(Message).filter(
             Message.namespace_id == new_message.namespace_id,
@@ -106,32 +112,109 @@ class AccountDeletionErrror(Exception):
     pass
 
 
-def batch_delete_namespaces(ids_to_delete, throttle=False,
-                                           dry_run=False):
+def batch_delete_namespaces(ids_to_delete, throttle=False, dry_run=False,
+                            concurrency=DELETION_CONCURRENCY, budget=None):
+    """
+    Delete the given (account_id, namespace_id) pairs, `concurrency` accounts
+    at a time. `budget` is an optional WriteBudget shared by the deletions.
 
+    """
     start = time.time()
 
-    deleted_count = 0
-    for account_id, namespace_id in ids_to_delete:
-        # try:
+    def delete(account_id, namespace_id):
         try:
             delete_namespace(namespace_id,
                              throttle=throttle,
-                             dry_run=dry_run)
+                             dry_run=dry_run,
+                             budget=budget)
         except AccountDeletionErrror as e:
             log.critical('AccountDeletionErrror', error_message=e.message)
         except Exception:
             log_uncaught_errors(log, account_id=account_id)
 
-        deleted_count += 1
+    pool = Pool(concurrency)
+    for account_id, namespace_id in ids_to_delete:
+        pool.spawn(delete, account_id, namespace_id)
+    pool.join()
 
     end = time.time()
     log.info('All data deleted successfully for ids',
              ids_to_delete=ids_to_delete,
-             time=end - start, count=deleted_count)
+             time=end - start, count=len(ids_to_delete))
+
+
+def delete_marked_accounts(shard_id, throttle=False, dry_run=False,
+                           concurrency=DELETION_CONCURRENCY, budget=None):
+    ids_to_delete = get_accounts_to_delete(shard_id)
+    if ids_to_delete:
+        batch_delete_namespaces(ids_to_delete, throttle=throttle,
+                                dry_run=dry_run, concurrency=concurrency,
+                                budget=budget)
+
+
+class WriteBudget(object):
+    """
+    Caps the number of rows deleted per second across concurrent deletions
+    (a token bucket). Deletions wait in turn once the budget is spent.
+
+    """
+
+    def __init__(self, rows_per_second):
+        self.rows_per_second = float(rows_per_second)
+        self._available = self.rows_per_second
+        self._updated_at = time.time()
+        self._lock = BoundedSemaphore(1)
+
+    def spend(self, rows):
+        with self._lock:
+            now = time.time()
+            self._available = min(
+                self.rows_per_second,
+                self._available +
+                (now - self._updated_at) * self.rows_per_second)
+            self._updated_at = now
+            self._available -= rows
+            if self._available < 0:
+                gevent.sleep(-self._available / self.rows_per_second)
+
+
+class DeletionCheckpoint(object):
+    """
+    The smallest id deleted so far from each table, saved in the account's
+    sync status so that an interrupted deletion resumes where it left off
+    rather than rescanning the rows it already deleted. Not saved for dry
+    runs.
+
+    """
+
+    def __init__(self, account_id, dry_run=False):
+        self.account_id = account_id
+        self.dry_run = dry_run
+        self.ids = {}
+        if not dry_run:
+            with session_scope(account_id) as db_session:
+                account = db_session.query(Account).get(account_id)
+                sync_status = account._sync_status or {}
+                self.ids = dict(sync_status.get('deletion_checkpoint') or {})
+
+    def get(self, table):
+        return self.ids.get(table)
+
+    def set(self, table, id_):
+        self.ids[table] = id_
+        if self.dry_run:
+            return
+        # Don't create Transactions for the account being deleted.
+        with session_scope(self.account_id, versioned=False) as db_session:
+            account = db_session.query(Account).get(self.account_id)
+            if account._sync_status is None:
+                account._sync_status = {}
+            account._sync_status['deletion_checkpoint'] = dict(self.ids)
+            db_session.commit()
 
 
-def delete_namespace(namespace_id, throttle=False, dry_run=False):
+def delete_namespace(namespace_id, throttle=False, dry_run=False,
+                     budget=None):
     """
     Delete all the data associated with a namespace from the database.
     USE WITH CAUTION.
@@ -139,6 +222,9 @@ def delete_namespace(namespace_id, throttle=False, dry_run=False):
     NOTE: This function is only called from bin/delete-account-data.
     It prints to stdout.
 
+    The biggest tables are deleted in batches of ids, see _batch_delete.
+    `budget` is an optional WriteBudget capping the rate of deletions.
+
     Raises AccountDeletionErrror with message if there are problems
     """
 
@@ -184,9 +270,10 @@ def delete_namespace(namespace_id, throttle=False, dry_run=False):
     # so this is okay.
     engine = engine_manager.get_for_id(namespace_id)
 
+    checkpoint = DeletionCheckpoint(account_id, dry_run)
     for cls in filters:
         _batch_delete(engine, cls, filters[cls], throttle=throttle,
-                      dry_run=dry_run)
+                      dry_run=dry_run, checkpoint=checkpoint, budget=budget)
 
     # Use a single delete for the other tables. Rows from tables which contain
     # cascade-deleted foreign keys to other tables deleted here (or above)
@@ -204,13 +291,12 @@ def delete_namespace(namespace_id, throttle=False, dry_run=False):
         filters[table] = ('account_id', account_id)
     filters['namespace'] = ('id', namespace_id)
 
+    throttle = get_throttle(namespace_id, throttle)
     for table, (column, id_) in filters.iteritems():
         log.info('Performing bulk deletion', table=table)
         start = time.time()
 
-        if throttle and check_throttle():
-            log.info("Throttling deletion")
-            gevent.sleep(60)
+        throttle.wait()
 
         if not dry_run:
             engine.execute(query.format(table, column, id_))
@@ -236,101 +322,75 @@ def delete_namespace(namespace_id, throttle=False, dry_run=False):
                          time.time() - start_time)
 
 
+# Tables whose rows are deleted along with each batch of ids of another
+# table, by (table, foreign key column), rather than one row's worth at a time
+# through a cascading foreign key.
+BATCH_DELETE_CHILDREN = {
+    'message': [('messagesearchterm', 'message_id')],
+}
+
+
 def _batch_delete(engine, table, column_id_filters, throttle=False,
-                  dry_run=False):
-    (column, id_) = column_id_filters
-    count = engine.execute(
-        'SELECT COUNT(*) FROM {} WHERE {}={};'.format(table, column, id_)).\
-        scalar()
+                  dry_run=False, checkpoint=None, budget=None):
+    """
+    Delete the rows of `table` matching `column_id_filters` by batches of
+    primary keys, walking down the table's ids from the top: each batch of
+    ids is selected through the (column, id) index from where the previous
+    one stopped, then deleted by primary key. Unlike repeated
+    `DELETE ... LIMIT` statements, this never rescans the rows deleted so
+    far, and deleting newest rows first respects self-references such as
+    message.reply_to_message_id.
 
-    if count == 0:
-        log.info('Completed batch deletion', table=table)
-        return
+    With `throttle`, batches are sized and paced by the shard's
+    AdaptiveThrottle, otherwise they're of CHUNK_SIZE ids.
 
-    batches = int(math.ceil(float(count) / CHUNK_SIZE))
+    """
+    (column, id_) = column_id_filters
+    throttle = get_throttle(id_, throttle, CHUNK_SIZE)
+    children = BATCH_DELETE_CHILDREN.get(table, [])
+    last_id = checkpoint.get(table) if checkpoint is not None else None
+    deleted = 0
 
-    log.info('Starting batch deletion', table=table, count=count,
-             batches=batches)
+    log.info('Starting batch deletion', table=table, start_id=last_id)
     start = time.time()
 
-    query = 'DELETE FROM {} WHERE {}={} LIMIT 2000;'.format(table, column, id_)
-    log.info('Deletion query', query=query)
-
-    for i in range(0, batches):
-        if throttle and check_throttle():
-            log.info("Throttling deletion")
-            gevent.sleep(60)
+    while True:
+        throttle.wait()
+
+        query = 'SELECT id FROM {} WHERE {}={}'.format(table, column, id_)
+        if last_id is not None:
+            query += ' AND id < {}'.format(last_id)
+        query += ' ORDER BY id DESC LIMIT {};'.format(throttle.batch_size)
+        ids = [row[0] for row in engine.execute(query)]
+
+        if not ids:
+            if last_id is None or dry_run:
+                break
+            # Rows may have been created above the starting point, e.g. by
+            # a sync which was still running; make a final pass from the top.
+            last_id = None
+            continue
+
+        if budget is not None:
+            budget.spend(len(ids))
+        id_list = ','.join(str(i) for i in ids)
         if dry_run is False:
-            if table == "message":
-                # messages must be order by the foreign key `received_date`
-                # otherwise MySQL will raise an error when deleting
-                # from the message table
-                query = ('DELETE FROM message WHERE {}={} '
-                         'ORDER BY received_date desc LIMIT 2000;'
-                         .format(column, id_))
-            engine.execute(query)
+            for child_table, child_column in children:
+                engine.execute('DELETE FROM {} WHERE {} IN ({});'.format(
+                    child_table, child_column, id_list))
+            engine.execute('DELETE FROM {} WHERE id IN ({});'.format(
+                table, id_list))
         else:
-            log.debug(query)
+            log.debug('Would delete batch', table=table,
+                      first_id=ids[-1], last_id=ids[0])
+        deleted += len(ids)
+        last_id = ids[-1]
+        if checkpoint is not None:
+            checkpoint.set(table, last_id)
 
     end = time.time()
-    log.info('Completed batch deletion', time=end - start, table=table)
-
-
-def check_throttle():
-    """
-    Returns True if deletions should be throttled and False otherwise.
-
-    The current logic throttles deletions if any production sync-mysql-node
-    slaves are over 10 seconds behind their master, or if the average CPU load
-    across the production sync-mysql-node fleet is above 70%.
-
-    check_throttle is ignored entirely if the separate `throttle` flag is False
-    (meaning that throttling is not done at all), but if throttling is enabled,
-    this method determines when.
-
-    """
-    # Ensure replica lag is not spiking
-    base_url = config["UMPIRE_BASE_URL"]
-    replica_lag_url = ("https://{}/check?metric=maxSeries(servers.prod."
-                       "sync-mysql-node.*.mysql.Seconds_Behind_Master)"
-                       "&max=10&min=0&range=300".format(base_url))
-
-    cpu_url = ('https://{}/check?metric=maxSeries(offset(scale(groupByNode('
-               'servers.prod.sync-mysql-node.*.cpu.cpu*.idle,3,'
-               '"averageSeries"),-1),100))&max=70&min=0&range=300'.
-               format(base_url))
-
-    replica_lag_status_code = requests.get(replica_lag_url).status_code
-    cpu_status_code = requests.get(cpu_url).status_code
-    if replica_lag_status_code != 200 or cpu_status_code != 200:
-        return True
-
-    # Stop deletion before backups are scheduled to start and resume
-    # when backups complete (~8.5 hours later but allow 9h just in case)
-    #
-    # Unifying this with the actual backup timing is tracked in
-    # https://phab.nylas.com/T6786
-    backup_start_hour_utc = 8  # CHANGE THIS if backups get rescheduled
-    backup_duration_hours = 9  # CHANGE THIS if backup length changes much
-    backup_end_hour_utc = (backup_start_hour_utc + backup_duration_hours) % 24
-    now = datetime.datetime.utcnow()
-    # We are trying to throttle during a specific backup window of
-    # <backup_duration_hours> hours, but the window may wrap around from one
-    # day to the next, making it difficult to do a naive hour comparison.
-    #
-    # Therefore we have to compare the current hour to the backup window in
-    # multiple chunks. First we compare to the part of the window in the same
-    # day as when the backup started, and then we compare to the part of the
-    # window in the next day.
-    if (now.hour >= backup_start_hour_utc and
-            now.hour < min(backup_start_hour_utc + backup_duration_hours, 24)):
-        return True
-    elif (backup_end_hour_utc <= backup_start_hour_utc and
-          now.hour < backup_end_hour_utc and
-          now.hour >= (backup_end_hour_utc - backup_duration_hours)):
-        return True
-    else:
-        return False
+    log.info('Completed batch deletion', time=end - start, table=table,
+             count=deleted)
 
 
 def purge_transactions(shard_id, days_ago=60, limit=1000, throttle=False,
@@ -340,32 +400,33 @@ def purge_transactions(shard_id, days_ago=60, limit=1000, throttle=False,
         start = "'{}'".format(now.strftime('%Y-%m-%d %H:%M:%S'))
 
     # Delete all items from the transaction table that are older than
-    # `days_ago` days.
+    # `days_ago` days, by batches of at most `limit` rows, fewer while the
+    # shard's throttle says so.
     if dry_run:
         offset = 0
         query = ("SELECT id FROM transaction where created_at < "
-                 "DATE_SUB({}, INTERVAL {} day) LIMIT {}".
-                 format(start, days_ago, limit))
+                 "DATE_SUB({}, INTERVAL {} day) LIMIT {}")
     else:
         query = ("DELETE FROM transaction where created_at < DATE_SUB({},"
-                 " INTERVAL {} day) LIMIT {}".format(start, days_ago, limit))
+                 " INTERVAL {} day) LIMIT {}")
+    throttle = get_shard_throttle(shard_id, throttle, limit)
     try:
         # delete from rows until there are no more rows affected
         rowcount = 1
         while rowcount > 0:
-            while throttle and check_throttle():
-                log.info("Throttling deletion")
-                gevent.sleep(60)
+            throttle.wait()
+            batch_size = min(limit, throttle.batch_size)
+            batch_query = query.format(start, days_ago, batch_size)
             with session_scope_by_shard_id(shard_id, versioned=False) as \
                     db_session:
                 if dry_run:
                     rowcount = db_session.execute(
-                        "{} OFFSET {}".format(query, offset)).rowcount
+                        "{} OFFSET {}".format(batch_query, offset)).rowcount
                     offset += rowcount
                 else:
-                    rowcount = db_session.execute(query).rowcount
-            log.info("Deleted batch from transaction table", batch_size=limit,
-                     rowcount=rowcount)
+                    rowcount = db_session.execute(batch_query).rowcount
+            log.info("Deleted batch from transaction table",
+                     batch_size=batch_size, rowcount=rowcount)
         log.info("Finished purging transaction table for shard",
                  shard_id=shard_id, date_delta=days_ago)
     except Exception as e:
@@ -1,3 +1,6 @@
+import quopri
+import binascii
+
 import imapclient
 from inbox.s3.exc import EmailFetchException, EmailDeletedException
 from inbox.crispin import connection_pool
@@ -30,3 +33,47 @@ def get_imap_raw_contents(message):
                       logstash_tag='fetching_error')
             raise EmailFetchException("Couldn't get message from server. "
                                       "Please try again in a few minutes.")
+
+
+def get_imap_part_contents(message, part):
+    """
+    Fetch and decode just the given part of a message, using the IMAP
+    section recorded when the message was parsed. Returns None if the part
+    can't be fetched on its own.
+
+    """
+    if part.section is None:
+        return None
+    if len(message.imapuids) == 0:
+        raise EmailDeletedException("Message was deleted on the backend server.")
+
+    account = message.namespace.account
+    uid = message.imapuids[0]
+    folder = uid.folder
+
+    with connection_pool(account.id).get() as crispin_client:
+        crispin_client.select_folder(folder.name, uidvalidity_cb)
+
+        try:
+            data = crispin_client.fetch_section(uid.msg_uid, part.section)
+        except imapclient.IMAPClient.Error:
+            log.error("Error while fetching part contents", exc_info=True,
+                      section=part.section, logstash_tag='fetching_error')
+            raise EmailFetchException("Couldn't get message from server. "
+                                      "Please try again in a few minutes.")
+    if data is None:
+        raise EmailDeletedException("Message was deleted on the backend server.")
+
+    return _decode_transfer_encoding(data, part.transfer_encoding)
+
+
+def _decode_transfer_encoding(data, transfer_encoding):
+    if transfer_encoding == 'base64':
+        try:
+            return binascii.a2b_base64(data)
+        except binascii.Error:
+            return None
+    elif transfer_encoding == 'quoted-printable':
+        return quopri.decodestring(data)
+    # 7bit, 8bit and binary parts aren't encoded.
+    return data
@@ -2,3 +2,10 @@ def get_raw_from_provider(message):
     """Get the raw contents of a message from the provider."""
     account = message.account
     return account.get_raw_message_contents(message)
+
+
+def get_raw_part_from_provider(message, part):
+    """Get the decoded contents of a single part of a message from the
+    provider, or None if it can't be fetched on its own."""
+    account = message.account
+    return account.get_raw_part_contents(message, part)
@@ -1,6 +1,15 @@
+from inbox.config import config
 from inbox.search.backends.imap import IMAPSearchClient
+from inbox.search.backends.local import LocalSearchClient
 
-__all__ = ['IMAPSearchClient']
+__all__ = ['IMAPSearchClient', 'LocalSearchClient']
 
 PROVIDER = 'generic'
-SEARCH_CLS = 'IMAPSearchClient'
+
+# Serve searches from the local message search index rather than running
+# IMAP SEARCH against every folder. Requires the message search index
+# service to run, and namespaces to be backfilled.
+if 'LOCAL_MESSAGE_SEARCH' in config.get('FEATURE_FLAGS', []):
+    SEARCH_CLS = 'LocalSearchClient'
+else:
+    SEARCH_CLS = 'IMAPSearchClient'
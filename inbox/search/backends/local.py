@@ -0,0 +1,113 @@
+from sqlalchemy import desc, distinct, func
+
+from inbox.api.kellogs import APIEncoder
+from inbox.models import Message, Thread
+from inbox.models.search import MessageSearchTerm
+from inbox.models.session import session_scope
+from inbox.search.index import tokenize
+
+# Number of results per chunk of a streaming search.
+STREAM_CHUNK_SIZE = 100
+
+
+class LocalSearchClient(object):
+    """
+    Search the messages and threads of an account in the local message
+    search index (see inbox/search/index.py), without connecting to the
+    provider.
+
+    Every term of the query must match. Results are ranked by the summed
+    weights of the matching terms, then by recency.
+
+    """
+
+    def __init__(self, account):
+        self.account_id = account.id
+        self.namespace_id = account.namespace.id
+
+    def _ranked_message_ids(self, db_session, search_query):
+        terms = set(tokenize(search_query))
+        if not terms:
+            return None
+        return db_session.query(
+            MessageSearchTerm.message_id.label('message_id'),
+            func.sum(MessageSearchTerm.weight).label('score')). \
+            filter(MessageSearchTerm.namespace_id == self.namespace_id,
+                   MessageSearchTerm.term.in_(terms)). \
+            group_by(MessageSearchTerm.message_id). \
+            having(func.count(distinct(MessageSearchTerm.term)) ==
+                   len(terms)). \
+            subquery()
+
+    def _message_query(self, db_session, search_query):
+        ranked = self._ranked_message_ids(db_session, search_query)
+        if ranked is None:
+            return None
+        return db_session.query(Message). \
+            join(ranked, ranked.c.message_id == Message.id). \
+            filter(Message.namespace_id == self.namespace_id,
+                   Message.deleted_at.is_(None)). \
+            order_by(desc(ranked.c.score), desc(Message.received_date),
+                     desc(Message.id))
+
+    def _thread_query(self, db_session, search_query):
+        ranked = self._ranked_message_ids(db_session, search_query)
+        if ranked is None:
+            return None
+        ranked_threads = db_session.query(
+            Message.thread_id.label('thread_id'),
+            func.max(ranked.c.score).label('score'),
+            func.max(Message.received_date).label('received_date')). \
+            join(ranked, ranked.c.message_id == Message.id). \
+            filter(Message.namespace_id == self.namespace_id,
+                   Message.deleted_at.is_(None)). \
+            group_by(Message.thread_id). \
+            subquery()
+        return db_session.query(Thread). \
+            join(ranked_threads, ranked_threads.c.thread_id == Thread.id). \
+            filter(Thread.deleted_at.is_(None)). \
+            order_by(desc(ranked_threads.c.score),
+                     desc(ranked_threads.c.received_date),
+                     desc(Thread.id))
+
+    def _paginate(self, query, offset, limit):
+        if query is None:
+            return []
+        if offset:
+            query = query.offset(offset)
+        if limit:
+            query = query.limit(limit)
+        return query.all()
+
+    def search_messages(self, db_session, search_query, offset=0, limit=40):
+        return self._paginate(self._message_query(db_session, search_query),
+                              offset, limit)
+
+    def search_threads(self, db_session, search_query, offset=0, limit=40):
+        return self._paginate(self._thread_query(db_session, search_query),
+                              offset, limit)
+
+    def _stream(self, make_query, search_query):
+        def g():
+            encoder = APIEncoder()
+
+            with session_scope(self.account_id) as db_session:
+                query = make_query(db_session, search_query)
+                offset = 0
+                while query is not None:
+                    results = query.offset(offset). \
+                        limit(STREAM_CHUNK_SIZE).all()
+                    if not results:
+                        break
+                    yield encoder.cereal(results) + '\n'
+                    if len(results) < STREAM_CHUNK_SIZE:
+                        break
+                    offset += len(results)
+
+        return g
+
+    def stream_messages(self, search_query):
+        return self._stream(self._message_query, search_query)
+
+    def stream_threads(self, search_query):
+        return self._stream(self._thread_query, search_query)
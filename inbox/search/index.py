@@ -0,0 +1,145 @@
+"""
+Local full-text index of messages.
+
+Messages are indexed into the MessageSearchTerm table: one row per distinct
+term of a message, weighted by the fields the term appears in. Searches then
+only touch the (namespace_id, term, message_id) index rather than the
+provider, see inbox.search.backends.local.LocalSearchClient.
+
+Indexing is incremental: MessageSearchIndexService
+(inbox/transactions/search.py) indexes the messages created by sync, and
+the drafts created through the API, from the transaction log.
+index_namespace() backfills namespaces synced before the index was enabled.
+
+"""
+import re
+from collections import defaultdict
+
+from sqlalchemy.orm import load_only
+
+from inbox.models import Message
+from inbox.models.search import MessageSearchTerm
+from inbox.models.session import session_scope
+from inbox.sqlalchemy_ext.util import safer_yield_per
+from inbox.util.html import strip_tags
+from inbox.util.throttle import get_throttle
+
+from nylas.logging import get_logger
+log = get_logger()
+
+TERM_RE = re.compile(r'\w+', re.UNICODE)
+MIN_TERM_LENGTH = 2
+# Keep the index bounded for very long messages by only indexing the start
+# of their bodies. Every distinct term of that text is indexed, rare ones
+# (names, order numbers...) being what people search for.
+MAX_INDEXED_BODY_LENGTH = 100000
+
+SUBJECT_WEIGHT = 4
+PARTICIPANT_WEIGHT = 3
+BODY_WEIGHT = 1
+
+STOPWORDS = frozenset([
+    'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'has', 'he',
+    'in', 'is', 'it', 'its', 'of', 'on', 'or', 'that', 'the', 'to', 'was',
+    'were', 'will', 'with'])
+
+INDEX_COLUMNS = ['namespace_id', 'subject', 'from_addr', 'to_addr',
+                 'cc_addr', 'bcc_addr', 'snippet', '_compacted_body']
+
+
+def tokenize(text):
+    """ Split text into the normalized terms stored in the index. """
+    if not text:
+        return []
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    terms = []
+    for term in TERM_RE.findall(text.lower()):
+        if len(term) < MIN_TERM_LENGTH or term in STOPWORDS:
+            continue
+        terms.append(term[:MessageSearchTerm.MAX_TERM_LENGTH])
+    return terms
+
+
+def message_terms(message):
+    """ Return a {term: weight} dict for the given message. """
+    weights = defaultdict(int)
+    for term in tokenize(message.subject):
+        weights[term] += SUBJECT_WEIGHT
+
+    for field in (message.from_addr, message.to_addr, message.cc_addr,
+                  message.bcc_addr):
+        for name, email in field or []:
+            for term in tokenize(name) + tokenize(email):
+                weights[term] += PARTICIPANT_WEIGHT
+
+    body = message.body
+    if body:
+        body = strip_tags(body)
+    else:
+        body = message.snippet
+    for term in tokenize(body[:MAX_INDEXED_BODY_LENGTH] if body else body):
+        weights[term] += BODY_WEIGHT
+    return weights
+
+
+def unindex_messages(db_session, message_ids):
+    if not message_ids:
+        return
+    db_session.execute(MessageSearchTerm.__table__.delete().where(
+        MessageSearchTerm.message_id.in_(message_ids)))
+
+
+def index_messages(db_session, messages):
+    """
+    (Re)index the given messages. Doesn't commit, so that callers can
+    update the index atomically with their own changes.
+
+    """
+    unindex_messages(db_session, [message.id for message in messages])
+    rows = []
+    for message in messages:
+        for term, weight in message_terms(message).iteritems():
+            rows.append({'namespace_id': message.namespace_id,
+                         'term': term,
+                         'message_id': message.id,
+                         'weight': weight})
+    if rows:
+        # Another indexer (the backfill and MessageSearchIndexService can
+        # run at the same time) may have inserted the same rows since we
+        # deleted them; they're identical, so skip the duplicates.
+        db_session.execute(
+            MessageSearchTerm.__table__.insert().prefix_with('IGNORE'), rows)
+    return len(rows)
+
+
+def index_namespace(namespace_id, chunk_size=500, throttle=False):
+    """
+    Backfill function to (re)index all the messages of a namespace. With
+    `throttle`, batches (of at most `chunk_size` messages) are sized and
+    paced by the shard's AdaptiveThrottle.
+
+    """
+    throttle = get_throttle(namespace_id, throttle, chunk_size)
+    indexed = 0
+    with session_scope(namespace_id) as db_session:
+        query = db_session.query(Message).filter(
+            Message.namespace_id == namespace_id).options(
+                load_only(*INDEX_COLUMNS))
+        batch = []
+        for message in safer_yield_per(query, Message.id, 0, chunk_size):
+            batch.append(message)
+            if len(batch) >= min(chunk_size, throttle.batch_size):
+                index_messages(db_session, batch)
+                db_session.commit()
+                indexed += len(batch)
+                batch = []
+                throttle.wait()
+        if batch:
+            index_messages(db_session, batch)
+            db_session.commit()
+            indexed += len(batch)
+
+    log.info('indexed namespace messages', namespace_id=namespace_id,
+             messages=indexed)
+    return indexed
@@ -1,4 +1,10 @@
+import datetime
 import json
+from inbox.contacts.algorithms import (calculate_contact_scores,
+                                       calculate_group_scores,
+                                       group_scores_from_state,
+                                       MIN_MESSAGE_WEIGHT)
+from inbox.contacts.scores import messages_for_contact_scores
 from inbox.models import DataProcessingCache
 from sqlalchemy.orm.exc import NoResultFound
 from inbox.test.util.base import (add_fake_thread,
@@ -9,6 +15,14 @@ from inbox.test.api.base import api_client
 __all__ = ['api_client', 'default_namespace']
 
 
+def update_contact_scores(db, namespace_id):
+    # What the contact scores service does for the namespace.
+    from inbox.transactions.contact_scores import ContactScoreService
+    db.session.commit()
+    ContactScoreService().update_namespace(namespace_id)
+    db.session.expire_all()
+
+
 def test_contact_rankings(db, api_client, default_namespace):
     # Clear cached data (if it exists)
     namespace_id = default_namespace.id
@@ -40,10 +54,15 @@ def test_contact_rankings(db, api_client, default_namespace):
                          to_addr=recipients_list,
                          add_sent_category=True)
 
-    # Check contact rankings
+    # Rankings are computed in the background.
     resp = api_client.get_raw(
         '/contacts/rankings?force_recalculate=true')
     assert resp.status_code == 200
+    update_contact_scores(db, namespace_id)
+
+    # Check contact rankings
+    resp = api_client.get_raw('/contacts/rankings')
+    assert resp.status_code == 200
 
     emails_scores = {e: s for (e, s) in json.loads(resp.data)}
     emails = ['number1@nylas.com', 'number2@nylas.com',
@@ -84,6 +103,7 @@ def test_contact_groups(db, api_client, default_namespace):
             .filter(DataProcessingCache.namespace_id ==
                     namespace_id).one()
         cached_data.contact_groups_last_updated = None
+        cached_data._contact_groups = None
         db.session.add(cached_data)
         db.session.commit()
     except NoResultFound:
@@ -119,9 +139,15 @@ def test_contact_groups(db, api_client, default_namespace):
                          to_addr=recipients_list,
                          add_sent_category=True)
 
-    # Check contact groups
+    # Groups are computed in the background; until then, there are none.
     resp = api_client.get_raw('/groups/intrinsic?force_recalculate=true')
     assert resp.status_code == 200
+    assert json.loads(resp.data) == []
+    update_contact_scores(db, namespace_id)
+
+    # Check contact groups
+    resp = api_client.get_raw('/groups/intrinsic')
+    assert resp.status_code == 200
 
     groups_scores = {g: s for (g, s) in json.loads(resp.data)}
     groups = ['a@nylas.com, b@nylas.com, c@nylas.com, d@nylas.com',
@@ -146,3 +172,53 @@ def test_contact_groups(db, api_client, default_namespace):
         assert cached_data.contact_groups_last_updated is not None
     except (NoResultFound, AssertionError):
         assert False, "Contact groups not cached"
+
+
+def test_contact_rankings_updated_incrementally(db, api_client,
+                                                default_namespace):
+    namespace_id = default_namespace.id
+    me = ('me', default_namespace.email_address)
+
+    def send(recipients_list, received_date=None):
+        fake_thread = add_fake_thread(db.session, namespace_id)
+        add_fake_message(db.session, namespace_id, fake_thread,
+                         subject='Froop', from_addr=[me],
+                         to_addr=recipients_list,
+                         received_date=received_date,
+                         add_sent_category=True)
+
+    for _ in range(3):
+        send([('first', 'incremental1@nylas.com')])
+    # Messages past the lookback time keep the minimum weight.
+    send([('old', 'incremental-old@nylas.com')],
+         received_date=datetime.datetime.now() - datetime.timedelta(days=800))
+
+    api_client.get_raw('/contacts/rankings?force_recalculate=true')
+    update_contact_scores(db, namespace_id)
+    resp = api_client.get_raw('/contacts/rankings')
+    emails_scores = {e: s for (e, s) in json.loads(resp.data)}
+    assert abs(emails_scores['incremental1@nylas.com'] - 3) < 0.01
+    assert emails_scores['incremental-old@nylas.com'] == MIN_MESSAGE_WEIGHT
+    assert 'incremental2@nylas.com' not in emails_scores
+
+    # New sent messages are counted without recalculating from scratch.
+    send([('second', 'incremental2@nylas.com')])
+    resp = api_client.get_raw('/contacts/rankings')
+    emails_scores = {e: s for (e, s) in json.loads(resp.data)}
+    assert abs(emails_scores['incremental1@nylas.com'] - 3) < 0.01
+    assert abs(emails_scores['incremental2@nylas.com'] - 1) < 0.01
+
+    messages = messages_for_contact_scores(db.session, namespace_id)
+    expected = calculate_contact_scores(messages)
+    for email, score in emails_scores.items():
+        assert abs(score - expected[email]) < 0.01
+
+    state = db.session.query(DataProcessingCache).filter(
+        DataProcessingCache.namespace_id == namespace_id).one(). \
+        contact_score_state
+    groups_scores = group_scores_from_state(state)
+    expected = calculate_group_scores(messages,
+                                      default_namespace.email_address)
+    assert set(groups_scores) == set(expected)
+    for group, score in groups_scores.items():
+        assert abs(score - expected[group]) < 0.1
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import os
 import md5
+from hashlib import sha256
 import json
 import mock
 
@@ -151,6 +152,28 @@ def test_download(api_client, uploaded_file_ids, filename):
     assert local_md5 == dl_md5
 
 
+def test_download_range(api_client, uploaded_file_ids):
+    in_file = api_client.get_data('/files?filename=LetMeSendYouEmail.wav')[0]
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                        'data', 'LetMeSendYouEmail.wav')
+    local_data = open(path, 'rb').read()
+    url = '/files/{}/download'.format(in_file['id'])
+
+    resp = api_client.get_raw(url, headers={'Range': 'bytes=10-109'})
+    assert resp.status_code == 206
+    assert resp.headers['Content-Range'] == \
+        'bytes 10-109/{}'.format(len(local_data))
+    assert resp.data == local_data[10:110]
+
+    resp = api_client.get_raw(url, headers={'Range': 'bytes=-10'})
+    assert resp.status_code == 206
+    assert resp.data == local_data[-10:]
+
+    resp = api_client.get_raw(
+        url, headers={'Range': 'bytes={}-'.format(len(local_data))})
+    assert resp.status_code == 416
+
+
 @pytest.fixture(scope='function')
 def fake_attachment(db, default_account, message):
     block = Block()
@@ -174,6 +197,8 @@ def test_direct_fetching(api_client, db, message,
     get_mock = mock.Mock(return_value=None)
     monkeypatch.setattr('inbox.util.blockstore.get_from_blockstore',
                         get_mock)
+    monkeypatch.setattr('inbox.util.blockstore.stream_from_blockstore',
+                        mock.Mock(return_value=None))
 
     save_mock = mock.Mock()
     monkeypatch.setattr('inbox.util.blockstore.save_to_blockstore',
@@ -198,3 +223,65 @@ def test_direct_fetching(api_client, db, message,
     # Check that we got back the right data, with the right headers.
     assert resp.headers['Content-Disposition'] == 'attachment; filename=zambla.txt'
     assert resp.data.decode("utf8") == u'Chuis pas rassur\xe9'
+
+
+def test_direct_fetching_single_part(api_client, db, message,
+                                     fake_attachment, monkeypatch):
+    # If we know where the attachment is in the message, only fetch that
+    # part from the provider.
+    fake_attachment.section = '2'
+    fake_attachment.transfer_encoding = 'base64'
+    db.session.commit()
+    monkeypatch.setattr('inbox.util.blockstore.get_from_blockstore',
+                        mock.Mock(return_value=None))
+    monkeypatch.setattr('inbox.util.blockstore.stream_from_blockstore',
+                        mock.Mock(return_value=None))
+    save_mock = mock.Mock()
+    monkeypatch.setattr('inbox.util.blockstore.save_to_blockstore',
+                        save_mock)
+    data = u'Chuis pas rassur\xe9'.encode('utf-8')
+    part_mock = mock.Mock(return_value=data)
+    monkeypatch.setattr('inbox.models.roles.get_raw_part_from_provider',
+                        part_mock)
+    raw_mock = mock.Mock()
+    monkeypatch.setattr('inbox.s3.backends.gmail.get_gmail_raw_contents',
+                        raw_mock)
+
+    resp = api_client.get_raw('/files/{}/download'.format(
+        fake_attachment.block.public_id))
+
+    assert part_mock.called
+    assert part_mock.call_args[0][1].section == '2'
+    assert not raw_mock.called
+    save_mock.assert_called_with(fake_attachment.block.data_sha256, data)
+    assert resp.data == data
+
+
+def test_pending_attachment_download(api_client, db, message,
+                                     fake_attachment, monkeypatch):
+    # Attachments left out of initial sync are downloaded on first access,
+    # which sets their exact size and hash.
+    block = fake_attachment.block
+    block.data_sha256 = None
+    block.size = 100
+    fake_attachment.section = '2'
+    fake_attachment.transfer_encoding = 'base64'
+    db.session.commit()
+    save_mock = mock.Mock()
+    monkeypatch.setattr('inbox.util.blockstore.save_to_blockstore',
+                        save_mock)
+    data = u'Chuis pas rassur\xe9'.encode('utf-8')
+    part_mock = mock.Mock(return_value=data)
+    monkeypatch.setattr('inbox.models.roles.get_raw_part_from_provider',
+                        part_mock)
+
+    resp = api_client.get_raw('/files/{}/download'.format(block.public_id))
+
+    assert part_mock.called
+    assert resp.data == data
+    assert resp.headers['Content-Length'] == str(len(data))
+    db.session.expire_all()
+    assert not block.is_pending
+    assert block.size == len(data)
+    assert block.data_sha256 == sha256(data).hexdigest()
+    save_mock.assert_called_with(block.data_sha256, data)
@@ -467,3 +467,118 @@ def test_streaming_search_results(db, imap_api_client, generic_account,
     assert len(responses) == 3 and responses[2] == ''
     assert len(json.loads(responses[0])) == 3
     assert len(json.loads(responses[1])) == 2
+
+
+@fixture
+def local_search_messages(db, generic_account):
+    from inbox.search.index import index_messages
+    namespace_id = generic_account.namespace.id
+    specs = [
+        ('Quarterly report', 'Numbers for the quarterly report attached.',
+         datetime.datetime(2015, 7, 9, 23, 50, 7)),
+        ('Lunch?', 'Want to talk about the report over lunch?',
+         datetime.datetime(2014, 7, 9, 23, 50, 7)),
+        ('Report', 'See the report.',
+         datetime.datetime(2013, 7, 9, 23, 50, 7)),
+        ('Unrelated', 'Nothing to see here.',
+         datetime.datetime(2012, 7, 9, 23, 50, 7)),
+    ]
+    messages = []
+    for subject, body, received_date in specs:
+        thread = add_fake_thread(db.session, namespace_id)
+        messages.append(add_fake_message(
+            db.session, namespace_id, thread=thread,
+            from_addr=[('Ben Bitdiddle', 'ben@bitdiddle.com')],
+            to_addr=[('', 'inboxapptest@example.com')],
+            received_date=received_date, subject=subject, body=body))
+    index_messages(db.session, messages)
+    db.session.commit()
+    return messages
+
+
+def test_local_search_ranking_and_pagination(db, generic_account,
+                                             local_search_messages):
+    from inbox.search.backends.local import LocalSearchClient
+    client = LocalSearchClient(generic_account)
+    quarterly, lunch, report, unrelated = local_search_messages
+
+    # Subject matches rank first, then the most recent message.
+    results = client.search_messages(db.session, 'REPORT')
+    assert results == [quarterly, report, lunch]
+    assert client.search_messages(db.session, 'report', offset=1,
+                                  limit=1) == [report]
+
+    # All the terms of the query must match.
+    assert client.search_messages(db.session, 'report lunch') == [lunch]
+    assert client.search_messages(db.session, 'bitdiddle') == \
+        local_search_messages
+    assert client.search_messages(db.session, 'ben@bitdiddle.com') == \
+        local_search_messages
+    assert client.search_messages(db.session, 'nonexistent') == []
+    assert client.search_messages(db.session, 'the') == []
+
+    unrelated.deleted_at = datetime.datetime.utcnow()
+    db.session.commit()
+    assert client.search_messages(db.session, 'nothing') == []
+
+
+def test_local_search_finds_rare_terms_of_long_messages(db, generic_account):
+    from inbox.search.backends.local import LocalSearchClient
+    from inbox.search.index import index_messages
+    namespace_id = generic_account.namespace.id
+    thread = add_fake_thread(db.session, namespace_id)
+    common_words = ' '.join('word{}'.format(i) for i in range(500))
+    body = '{} Order XK42917 shipped. {}'.format(common_words * 3,
+                                                 common_words * 3)
+    message = add_fake_message(db.session, namespace_id, thread=thread,
+                               subject='Your order', body=body)
+    index_messages(db.session, [message])
+    db.session.commit()
+
+    client = LocalSearchClient(generic_account)
+    assert client.search_messages(db.session, 'xk42917') == [message]
+    assert client.search_messages(db.session, 'word499') == [message]
+
+
+def test_local_search_concurrent_indexing(db, generic_account, monkeypatch,
+                                          local_search_messages):
+    from inbox.models.search import MessageSearchTerm
+    from inbox.search.backends.local import LocalSearchClient
+    from inbox.search.index import index_messages
+    quarterly, lunch, report, unrelated = local_search_messages
+    # As if another indexer inserted the terms after we deleted them.
+    monkeypatch.setattr('inbox.search.index.unindex_messages',
+                        lambda db_session, message_ids: None)
+    index_messages(db.session, [lunch])
+    db.session.commit()
+
+    assert db.session.query(MessageSearchTerm).filter(
+        MessageSearchTerm.message_id == lunch.id,
+        MessageSearchTerm.term == 'lunch').count() == 1
+    client = LocalSearchClient(generic_account)
+    assert client.search_messages(db.session, 'report lunch') == [lunch]
+
+@pytest.mark.parametrize('is_streaming', [True, False])
+@pytest.mark.parametrize('endpoint', ['messages', 'threads'])
+def test_local_search_api(imap_api_client, generic_account, monkeypatch,
+                          local_search_messages, endpoint, is_streaming):
+    from inbox.search.backends.local import LocalSearchClient
+    monkeypatch.setattr('inbox.search.backends.generic.SEARCH_CLS',
+                        'LocalSearchClient')
+    assert isinstance(get_search_client(generic_account), LocalSearchClient)
+
+    quarterly, lunch, report, _ = local_search_messages
+    if is_streaming:
+        raw_data = imap_api_client.get_raw(
+            '/{}/search/streaming?q=report'.format(endpoint)).data
+        responses = raw_data.split('\n')
+        assert len(responses) == 2 and responses[1] == ''
+        results = json.loads(responses[0])
+    else:
+        results = imap_api_client.get_data(
+            '/{}/search?q=report'.format(endpoint))
+
+    expected = [quarterly, report, lunch]
+    if endpoint == 'threads':
+        expected = [message.thread for message in expected]
+    assert_search_result(expected, results)
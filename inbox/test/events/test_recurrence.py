@@ -7,8 +7,10 @@ from datetime import timedelta
 from inbox.models.event import Event, RecurringEvent, RecurringEventOverride
 from inbox.models.when import Date, Time, DateSpan, TimeSpan
 from inbox.events.remote_sync import handle_event_updates
+from inbox.events.util import serialize_datetime
 from inbox.events.recurring import (link_events, get_start_times,
-                                    parse_exdate, rrule_to_json)
+                                    parse_exdate, parse_rrule, rrule_to_json,
+                                    _occurrence_cache)
 
 from nylas.logging import get_logger
 log = get_logger()
@@ -290,6 +292,57 @@ def test_inflate_multi_day_event(db, default_account, calendar):
         assert i.end in [arrow.get(2014, 9, 5), arrow.get(2014, 9, 12)]
 
 
+def test_cached_start_times_match_expansion(db, default_account, calendar):
+    _occurrence_cache.clear()
+    start = arrow.utcnow().floor('day').replace(days=-400, hours=+9)
+    event = recurring_event(db, default_account, calendar,
+                            ["RRULE:FREQ=DAILY;BYDAY=MO,WE,FR"],
+                            start=start, end=start.replace(hours=+1))
+
+    windows = [(None, None),
+               (start.replace(days=+100), start.replace(days=+200)),
+               # Earlier than the cached index, then past its horizon.
+               (start, start.replace(days=+30)),
+               (arrow.utcnow(), arrow.utcnow().replace(years=+3))]
+    for window_start, window_end in windows:
+        g = get_start_times(event, window_start, window_end)
+        window_start = window_start or start
+        window_end = window_end or arrow.utcnow().replace(years=+1)
+        # Parsed after get_start_times() has localized the event start.
+        rule = parse_rrule(event)
+        expected = [arrow.get(t).to('utc') for t in
+                    rule.between(window_start.datetime, window_end.datetime,
+                                 inc=True)]
+        assert g == expected
+        # The second call is served from the cache.
+        assert get_start_times(event, window_start, window_end) == expected
+    assert len(_occurrence_cache) == 1
+
+
+def test_start_times_cache_invalidated_by_rrule_change(db, default_account,
+                                                       calendar):
+    _occurrence_cache.clear()
+    start = arrow.utcnow().floor('day').replace(days=-10)
+    event = recurring_event(db, default_account, calendar,
+                            ["RRULE:FREQ=WEEKLY"], start=start,
+                            end=start.replace(hours=+1))
+    # Half a day off any occurrence, so that DST changes don't matter.
+    window_end = start.replace(days=+27, hours=+12)
+    assert len(get_start_times(event, start, window_end)) == 4
+
+    event.rrule = "RRULE:FREQ=DAILY"
+    db.session.commit()
+    start_times = get_start_times(event, start, window_end)
+    assert len(start_times) == 28
+
+    excluded = start_times[1]
+    event.exdate = "EXDATE:{}".format(serialize_datetime(excluded))
+    db.session.commit()
+    start_times = get_start_times(event, start, window_end)
+    assert len(start_times) == 27
+    assert excluded not in start_times
+
+
 def test_invalid_rrule_entry(db, default_account, calendar):
     # If we don't know how to expand the RRULE, we treat the event as if
     # it were a single instance.
@@ -461,6 +514,38 @@ def test_override_cancelled(db, default_account, calendar):
                     for e in all_events])
 
 
+@pytest.mark.parametrize('batch_size', [1, 500])
+def test_override_synced_before_master(db, default_account, calendar,
+                                       monkeypatch, batch_size):
+    # Overrides listed before their master, in the same page or not, get
+    # linked to it.
+    monkeypatch.setattr('inbox.events.remote_sync.EVENT_BATCH_SIZE',
+                        batch_size)
+    master_uid = 'batchmasteruid{}'.format(batch_size)
+    params = dict(description='', location='', busy=False, read_only=False,
+                  reminders='', all_day=False, is_owner=False,
+                  participants=[], provider_name='inbox', raw_data='',
+                  original_start_tz='America/Los_Angeles', source='local')
+    overrides = [
+        Event(title='override', uid='{}_{}'.format(master_uid, i),
+              recurrence=None,
+              start=arrow.get(2014, 8, 14 + 7 * i, 22, 30, 00),
+              end=arrow.get(2014, 8, 14 + 7 * i, 23, 30, 00),
+              original_start_time=arrow.get(2014, 8, 14 + 7 * i, 20, 30, 00),
+              master_event_uid=master_uid, **params)
+        for i in range(2)]
+    master = Event(title='recurring', uid=master_uid, recurrence=TEST_RRULE,
+                   start=arrow.get(2014, 8, 7, 20, 30, 00),
+                   end=arrow.get(2014, 8, 7, 21, 30, 00),
+                   original_start_time=None, master_event_uid=None, **params)
+    handle_event_updates(default_account.namespace.id, calendar.id,
+                         overrides + [master], log, db.session)
+
+    master = db.session.query(RecurringEvent).filter_by(uid=master_uid).one()
+    assert sorted(o.uid for o in master.overrides) == \
+        ['{}_0'.format(master_uid), '{}_1'.format(master_uid)]
+
+
 def test_new_instance_cancelled(db, default_account, calendar):
     # Test that if we receive a cancelled override from Google, we save it
     # as an override with cancelled status rather than deleting it.
@@ -0,0 +1,230 @@
+import os
+import time
+from hashlib import sha256
+
+import pytest
+
+from inbox.models import Block
+from inbox.util import blockstore
+from inbox.util.blockstore import (LocalBlockstoreBackend,
+                                   S3BlockstoreBackend,
+                                   delete_from_blockstore,
+                                   get_from_blockstore,
+                                   get_many_from_blockstore,
+                                   save_many_to_blockstore,
+                                   save_to_blockstore,
+                                   stream_from_blockstore)
+from inbox.util.blockstore_gc import collect_garbage
+from inbox.test.util.base import db, default_account, default_namespace
+
+__all__ = ['db', 'default_account', 'default_namespace']
+
+
+@pytest.yield_fixture
+def local_backend(tmpdir):
+    backend = LocalBlockstoreBackend(str(tmpdir))
+    blockstore.set_blockstore_backend(backend)
+    yield backend
+    blockstore.set_blockstore_backend(None)
+
+
+def test_local_backend_touches_existing_blobs(local_backend):
+    data = 'Hello, world!'
+    data_sha256 = sha256(data).hexdigest()
+    save_to_blockstore(data_sha256, data)
+    path = local_backend._data_file_path(data_sha256)
+    inode = os.stat(path).st_ino
+    mtime = os.stat(path).st_mtime
+
+    os.utime(path, (mtime - 100, mtime - 100))
+    save_to_blockstore(data_sha256, data)
+    # Not rewritten, but its age is reset for garbage collection.
+    assert os.stat(path).st_ino == inode
+    assert os.stat(path).st_mtime >= mtime
+    assert local_backend.exists(data_sha256)
+
+
+class FakeS3Key(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.metadata = {}
+        self.copies = 0
+
+    def copy(self, dst_bucket, dst_key, metadata=None, preserve_acl=False):
+        assert dst_key == self.name and metadata is not None
+        self.copies += 1
+
+
+class FakeS3Bucket(object):
+    name = 'bucket'
+
+    def __init__(self):
+        self.keys = {}
+        self.heads = 0
+
+    def get_key(self, name):
+        self.heads += 1
+        return self.keys.get(name)
+
+
+def test_s3_backend_only_trusts_known_keys_for_a_while(monkeypatch):
+    data_sha256 = sha256('data').hexdigest()
+    backend = S3BlockstoreBackend(known_keys_ttl=60)
+    backend._bucket = bucket = FakeS3Bucket()
+    bucket.keys[data_sha256] = key = FakeS3Key(data_sha256)
+
+    now = [1000000]
+    monkeypatch.setattr('time.time', lambda: now[0])
+    # Deduplicated saves touch the existing key.
+    backend.save(data_sha256, 'data')
+    assert key.copies == 1
+    backend.save(data_sha256, 'data')
+    assert backend.exists(data_sha256)
+    assert (bucket.heads, key.copies) == (1, 1)
+
+    # Garbage collection deleted the key from another process.
+    del bucket.keys[data_sha256]
+    now[0] += 61
+    assert not backend.exists(data_sha256)
+
+
+def test_reads_are_cached(local_backend):
+    data = 'Cached data'
+    data_sha256 = sha256(data).hexdigest()
+    save_to_blockstore(data_sha256, data)
+    assert get_from_blockstore(data_sha256) == data
+
+    os.remove(local_backend._data_file_path(data_sha256))
+    assert get_from_blockstore(data_sha256) == data
+
+
+def test_batch_api(local_backend):
+    blobs = {sha256(data).hexdigest(): data for data in ['a', 'b', 'c']}
+    save_many_to_blockstore(blobs)
+
+    missing_sha256 = sha256('missing').hexdigest()
+    values = get_many_from_blockstore(blobs.keys() + [missing_sha256])
+    assert values.pop(missing_sha256) is None
+    assert values == blobs
+
+
+def test_streaming_reads(local_backend):
+    data = ''.join(chr(i % 256) for i in range(1000))
+    data_sha256 = sha256(data).hexdigest()
+    save_to_blockstore(data_sha256, data)
+    # Don't serve from the cache.
+    blockstore._cache.clear()
+
+    chunks = list(stream_from_blockstore(data_sha256, chunk_size=100))
+    assert len(chunks) == 10
+    assert ''.join(chunks) == data
+
+    blockstore._cache.clear()
+    assert ''.join(stream_from_blockstore(data_sha256, 150, 420,
+                                          chunk_size=100)) == data[150:420]
+    assert stream_from_blockstore(sha256('missing').hexdigest()) is None
+
+
+def test_streaming_reads_verify_hash(local_backend):
+    data = 'Some data'
+    data_sha256 = sha256(data).hexdigest()
+    save_to_blockstore(data_sha256, data)
+    blockstore._cache.clear()
+    with open(local_backend._data_file_path(data_sha256), 'wb') as f:
+        f.write('Corrupted')
+
+    with pytest.raises(AssertionError):
+        list(stream_from_blockstore(data_sha256))
+
+
+def test_list_and_delete_blobs(local_backend):
+    blobs = {sha256(data).hexdigest(): data for data in ['a', 'bc']}
+    save_many_to_blockstore(blobs)
+    listed = {h: size for h, size, _ in local_backend.list_blobs()}
+    assert listed == {h: len(data) for h, data in blobs.items()}
+
+    delete_from_blockstore(blobs.keys() + [sha256('missing').hexdigest()])
+    assert list(local_backend.list_blobs()) == []
+    assert get_from_blockstore(blobs.keys()[0]) is None
+
+
+def test_garbage_collection(db, default_account, local_backend):
+    def save(data, age):
+        data_sha256 = sha256(data).hexdigest()
+        save_to_blockstore(data_sha256, data)
+        path = local_backend._data_file_path(data_sha256)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return data_sha256
+
+    referenced = save('Referenced', age=10 * 86400)
+    unreferenced = save('Unreferenced', age=10 * 86400)
+    recent = save('Recently saved', age=60)
+
+    block = Block(namespace_id=default_account.namespace.id)
+    block.data = 'Referenced'
+    # Pending blocks don't reference anything yet.
+    pending = Block(namespace_id=default_account.namespace.id)
+    pending.size = 10
+    db.session.add_all([block, pending])
+    db.session.commit()
+
+    report = collect_garbage(grace_period=86400, dry_run=True)
+    assert report.stored == 3
+    assert report.recent == 1
+    assert report.collectable == 1
+    assert report.collectable_bytes == len('Unreferenced')
+    assert report.deleted == 0
+    assert local_backend.exists(unreferenced)
+
+    report = collect_garbage(grace_period=86400, dry_run=False)
+    assert report.deleted == 1
+    assert not local_backend.exists(unreferenced)
+    assert local_backend.exists(referenced)
+    assert local_backend.exists(recent)
+
+
+def test_saving_again_protects_blobs_from_collection(db, local_backend):
+    data = 'Saved again'
+    data_sha256 = sha256(data).hexdigest()
+    save_to_blockstore(data_sha256, data)
+    path = local_backend._data_file_path(data_sha256)
+    mtime = time.time() - 10 * 86400
+    os.utime(path, (mtime, mtime))
+
+    # E.g. the same attachment received again, its row not committed yet.
+    save_to_blockstore(data_sha256, data)
+    report = collect_garbage(grace_period=86400, dry_run=False)
+    assert report.recent == 1
+    assert report.deleted == 0
+    assert local_backend.exists(data_sha256)
+
+
+def test_grace_period_must_exceed_known_keys_ttl(db, local_backend):
+    with pytest.raises(ValueError):
+        collect_garbage(grace_period=60, dry_run=False)
+
+
+def test_garbage_collection_throttled(db, local_backend, monkeypatch):
+    from inbox.util.throttle import NoThrottle
+
+    class CountingThrottle(NoThrottle):
+        waits = 0
+
+        def wait(self):
+            CountingThrottle.waits += 1
+
+    monkeypatch.setattr('inbox.util.throttle.throttle_for_shard',
+                        lambda shard_id: CountingThrottle())
+    data = 'Throttled'
+    data_sha256 = sha256(data).hexdigest()
+    save_to_blockstore(data_sha256, data)
+    path = local_backend._data_file_path(data_sha256)
+    mtime = time.time() - 10 * 86400
+    os.utime(path, (mtime, mtime))
+
+    report = collect_garbage(grace_period=86400, dry_run=False,
+                             throttle=True)
+    assert report.deleted == 1
+    assert CountingThrottle.waits > 0
@@ -60,3 +60,31 @@ def test_reset_autoincrements(base_db):
 
     assert len(reset_tables) > 0
     verify_db(engines[key], shard_schemas[key], key)
+
+
+def test_pool_per_host(config):
+    from inbox.ignition import EngineManager
+    engine_manager = EngineManager(config.get_required('DATABASE_HOSTS'),
+                                   config.get_required('DATABASE_USERS'),
+                                   include_disabled=True,
+                                   pool_per_host=True)
+    engines = engine_manager.engines
+    shard_schemas = get_shard_schemas()
+    assert len(engine_manager.host_engines) == 1
+    assert engines[0].pool is engines[1].pool
+    for key in [0, 1]:
+        assert engines[key].schema_name == shard_schemas[key]
+
+    # The same connection is switched between schemas.
+    for key in [0, 1, 0]:
+        with engines[key].connect() as conn:
+            schema = conn.execute('SELECT DATABASE()').scalar()
+            assert schema == shard_schemas[key]
+            status = engine_manager.pool_status()
+            assert status[key]['checked_out'] == 1
+            assert status[1 - key]['checked_out'] == 0
+            assert status[key]['pool_checked_out'] == 1
+    assert engines[0].pool.checkedin() == 1
+
+    status = engine_manager.pool_status()
+    assert status[0]['checked_out'] == status[1]['checked_out'] == 0
@@ -0,0 +1,25 @@
+from inbox.util.lru import LRUCache
+
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert 'b' not in cache
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+def test_lru_bounded_by_size():
+    cache = LRUCache(10, max_size=10, sizeof=len)
+    cache.set('a', 'x' * 6)
+    cache.set('b', 'x' * 6)
+    assert 'a' not in cache
+    assert cache.size == 6
+    # Values bigger than the whole cache are never stored.
+    cache.set('c', 'x' * 11)
+    assert 'c' not in cache
+    assert cache.pop('b') == 'x' * 6
+    assert cache.size == 0
@@ -9,6 +9,8 @@ from flanker import mime
 
 from inbox.models import Message, Block
 from inbox.util.blockstore import get_from_blockstore
+from inbox.util.bodystructure import MessageSkeleton, UnsupportedStructure
+from inbox.util.mime_parsing import start_parser_pool, stop_parser_pool
 
 from inbox.util.addr import parse_mimepart_address_header
 from inbox.test.util.base import (default_account, default_namespace, thread,
@@ -125,6 +127,28 @@ def test_save_attachments(db, default_account):
             Block.namespace_id == default_account.namespace.id).count() == 2)
 
 
+def test_save_attachment_sections(db, default_account):
+    mime_msg = mime.create.multipart('mixed')
+    alternative = mime.create.multipart('alternative')
+    alternative.append(
+        mime.create.text('plain', 'This is a message with attachments'),
+        mime.create.text('html', '<p>This is a message with attachments</p>'))
+    nested = mime.create.multipart('mixed')
+    nested.append(
+        mime.create.attachment('application/pdf', 'nested filler',
+                               'nested_file.pdf', 'attachment'))
+    mime_msg.append(
+        alternative,
+        mime.create.attachment('image/png', 'filler', 'attached_image.png',
+                               'attachment'),
+        nested)
+    msg = create_from_synced(db, default_account, mime_msg.to_string())
+    sections = {part.block.filename: part.section for part in msg.parts}
+    assert sections == {'attached_image.png': '2',
+                        'nested_file.pdf': '3.1'}
+    assert all(part.transfer_encoding for part in msg.parts)
+
+
 def test_save_inline_attachments(db, default_account):
     mime_msg = mime.create.multipart('mixed')
     inline_attachment = mime.create.attachment('image/png', 'filler',
@@ -377,6 +401,34 @@ def test_parse_body_on_bad_attachment(
     assert len(m.parts) == 0
 
 
+def test_parse_in_worker_process(db, default_account,
+                                 raw_message_with_filename_attachment,
+                                 raw_message_with_bad_attachment):
+    inline = create_from_synced(db, default_account,
+                                raw_message_with_filename_attachment)
+    start_parser_pool(1)
+    try:
+        m = create_from_synced(db, default_account,
+                               raw_message_with_filename_attachment)
+        assert m.parsed_body is None
+        assert m.data_sha256 == inline.data_sha256
+        assert m.subject == inline.subject
+        assert m.from_addr == inline.from_addr
+        assert m.body == inline.body
+        assert [(p.block.filename, p.block.data_sha256)
+                for p in m.attachments] == \
+            [(p.block.filename, p.block.data_sha256)
+             for p in inline.attachments]
+
+        m = Message.create_from_synced(default_account, 139219,
+                                       '[Gmail]/All Mail', None,
+                                       raw_message_with_bad_attachment)
+        assert m.decode_error
+        assert 'dingy blue carpet' in m.body
+    finally:
+        stop_parser_pool()
+
+
 def test_calculate_snippet():
     m = Message()
     # Check that we strip contents of title, script, style tags
@@ -478,3 +530,59 @@ def test_long_message_id(db, default_account, thread,
     # Check that no database error is raised.
     db.session.commit()
     assert len(m.message_id_header) <= 998
+
+
+SKELETON_HEADER = ('From: alice@example.com\r\n'
+                   'To: bob@example.com\r\n'
+                   'Subject: Report\r\n'
+                   'MIME-Version: 1.0\r\n'
+                   'Content-Type: multipart/mixed; boundary="b1"\r\n'
+                   '\r\n')
+SKELETON_PART_HEADERS = {
+    '1': 'Content-Type: text/plain; charset="us-ascii"\r\n\r\n',
+    '2': ('Content-Type: application/pdf\r\n'
+          'Content-Transfer-Encoding: base64\r\n'
+          'Content-Disposition: attachment; filename="report.pdf"\r\n'
+          '\r\n'),
+}
+# As parsed by imapclient.
+SKELETON_BODYSTRUCTURE = (
+    [('TEXT', 'PLAIN', ('CHARSET', 'us-ascii'), None, None, '7BIT', 14, 1,
+      None, None, None),
+     ('APPLICATION', 'PDF', None, None, None, 'BASE64', 400, None,
+      ('ATTACHMENT', ('FILENAME', 'report.pdf')), None)],
+    'MIXED', ('BOUNDARY', 'b1'), None, None)
+
+
+def test_save_deferred_attachments(db, default_account):
+    skeleton = MessageSkeleton(SKELETON_BODYSTRUCTURE)
+    assert skeleton.fetch_items == ['BODY.PEEK[1.MIME]', 'BODY.PEEK[2.MIME]',
+                                    'BODY.PEEK[1]']
+    assert skeleton.deferred_sections == {'2': 300}
+
+    fetched = {'BODY[{}.MIME]'.format(section): headers
+               for section, headers in SKELETON_PART_HEADERS.items()}
+    fetched['BODY[1]'] = 'See attached.'
+    body = skeleton.assemble(SKELETON_HEADER, fetched)
+
+    m = Message.create_from_synced(
+        default_account, 22, 'INBOX', datetime.datetime.utcnow(), body,
+        deferred_sections=skeleton.deferred_sections)
+    assert m.subject == 'Report'
+    assert 'See attached.' in m.body
+    assert m.data_sha256 is None
+    assert len(m.parts) == 1
+    part = m.parts[0]
+    assert part.section == '2'
+    assert part.block.filename == 'report.pdf'
+    assert part.block.is_pending
+    assert part.block.size == 300
+
+
+def test_skeleton_unsupported_structures():
+    # Single part messages are downloaded in full.
+    with pytest.raises(UnsupportedStructure):
+        MessageSkeleton(SKELETON_BODYSTRUCTURE[0][0])
+    skeleton = MessageSkeleton(SKELETON_BODYSTRUCTURE)
+    with pytest.raises(UnsupportedStructure):
+        skeleton.assemble(SKELETON_HEADER, {})
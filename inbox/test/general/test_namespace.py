@@ -1,6 +1,5 @@
 import random
-import gevent
-from requests import Response
+import datetime
 from pytest import fixture
 from freezegun import freeze_time
 
@@ -11,26 +10,43 @@ from inbox.test.util.base import (add_generic_imap_account, add_fake_thread, add
                                   add_fake_contact, add_fake_msg_with_calendar_part)
 
 
+class FakeSampler(object):
+
+    def __init__(self, healthy):
+        self.healthy = healthy
+
+    def sample(self):
+        from inbox.util.throttle import HealthSample
+        if self.healthy:
+            return HealthSample(0, 1, 0)
+        return HealthSample(3600, 1, 0)
+
+
 @fixture
-def patch_requests_throttle(monkeypatch):
-    def get(*args, **kwargs):
-        resp = Response()
-        resp.status_code = 500
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr('gevent.sleep', sleeps.append)
+    return sleeps
+
 
-    monkeypatch.setattr(
-        'requests.get',
-        lambda *args, **kwargs: get())
+def patch_throttle(monkeypatch, healthy):
+    from inbox.util.throttle import AdaptiveThrottle
+    throttle = AdaptiveThrottle(FakeSampler(healthy), min_batch_size=1,
+                                initial_batch_size=4, batch_size_step=1,
+                                sample_interval=0)
+    monkeypatch.setattr('inbox.util.throttle.throttle_for_id',
+                        lambda id_: throttle)
+    return throttle
 
 
 @fixture
-def patch_requests_no_throttle(monkeypatch):
-    def get(*args, **kwargs):
-        resp = Response()
-        resp.status_code = 500
+def healthy_throttle(monkeypatch):
+    return patch_throttle(monkeypatch, healthy=True)
+
 
-    monkeypatch.setattr(
-        'requests.get',
-        lambda *args, **kwargs: get())
+@fixture
+def unhealthy_throttle(monkeypatch):
+    return patch_throttle(monkeypatch, healthy=False)
 
 
 def random_range(start, end):
@@ -171,34 +187,7 @@ def test_bulk_namespace_deletion(db):
     assert account_2_id not in alive_accounts
 
 
-@freeze_time("2016-02-02 11:01:34")
-def test_deletion_no_throttle(db, patch_requests_no_throttle):
-    from inbox.models import Account
-    from inbox.models.util import get_accounts_to_delete, batch_delete_namespaces
-
-    new_accounts = set()
-    account_1 = add_completely_fake_account(db)
-    new_accounts.add(account_1.id)
-
-    account_2 = add_completely_fake_account(db, "test2@nylas.com")
-    new_accounts.add(account_2.id)
-
-    account_1.mark_for_deletion()
-    account_2.mark_for_deletion()
-    db.session.commit()
-
-    to_delete = get_accounts_to_delete(0)
-    greenlet = gevent.spawn(batch_delete_namespaces, to_delete, throttle=True)
-    greenlet.join()
-
-    alive_accounts = db.session.query(Account.id).all()
-
-    # Ensure the two accounts we added were deleted
-    assert new_accounts - set(alive_accounts) == new_accounts
-
-
-@freeze_time("2016-02-02 11:01:34")
-def test_deletion_metric_throttle(db, patch_requests_throttle):
+def test_deletion_no_throttle(db, healthy_throttle, sleeps):
     from inbox.models import Account
     from inbox.models.util import get_accounts_to_delete, batch_delete_namespaces
 
@@ -213,40 +202,41 @@ def test_deletion_metric_throttle(db, patch_requests_throttle):
     db.session.commit()
 
     to_delete = get_accounts_to_delete(0)
-    greenlet = gevent.spawn(batch_delete_namespaces, to_delete, throttle=True)
-    greenlet.join()
+    batch_delete_namespaces(to_delete, throttle=True)
 
     alive_accounts = [acc.id for acc in db.session.query(Account).all()]
 
-    # Ensure the two accounts we added are still present
-    assert account_1_id in alive_accounts
-    assert account_2_id in alive_accounts
+    # Ensure the two accounts we added were deleted, without pausing
+    assert account_1_id not in alive_accounts
+    assert account_2_id not in alive_accounts
+    assert sleeps == []
+    assert healthy_throttle.batch_size > 4
 
 
-@freeze_time("2016-02-02 01:01:34")
-def test_deletion_time_throttle(db, patch_requests_no_throttle):
-    from inbox.models import Account
+def test_deletion_throttle(db, unhealthy_throttle, sleeps):
+    from inbox.models import Account, Message
     from inbox.models.util import get_accounts_to_delete, batch_delete_namespaces
 
     account_1 = add_completely_fake_account(db, "test5@nylas.com")
     account_1_id = account_1.id
-
-    account_2 = add_completely_fake_account(db, "test6@nylas.com")
-    account_2_id = account_2.id
+    namespace_id = account_1.namespace.id
 
     account_1.mark_for_deletion()
-    account_2.mark_for_deletion()
     db.session.commit()
 
     to_delete = get_accounts_to_delete(0)
-    greenlet = gevent.spawn(batch_delete_namespaces, to_delete, throttle=True)
-    greenlet.join()
+    batch_delete_namespaces(to_delete, throttle=True)
 
     alive_accounts = [acc.id for acc in db.session.query(Account).all()]
 
-    # Ensure the two accounts we added are still present
-    assert account_1_id in alive_accounts
-    assert account_2_id in alive_accounts
+    # The account is still deleted, in smaller batches with growing pauses
+    # in between.
+    assert account_1_id not in alive_accounts
+    assert db.session.query(Message).filter(
+        Message.namespace_id == namespace_id).count() == 0
+    assert unhealthy_throttle.batch_size == 1
+    assert sleeps[:3] == [0.5, 1, 2]
+    assert max(sleeps) == unhealthy_throttle.max_delay
 
 
 def test_namespace_deletion(db, default_account):
@@ -464,3 +454,49 @@ def test_multiple_fake_accounts(empty_db):
     # check that we didn't delete a secret that wasn't ours.
     assert db.session.query(Secret).count() == secret_count
     assert db.session.query(GmailAuthCredentials).count() == authcredentials_count
+
+
+def test_namespace_deletion_resumes_from_checkpoint(empty_db):
+    from inbox.models import Account, Message, Thread
+    from inbox.models.util import delete_namespace
+
+    db = empty_db
+    account = add_completely_fake_account(db)
+    account_id = account.id
+    namespace_id = account.namespace.id
+    for i in range(4):
+        add_fake_message(db.session, namespace_id,
+                         add_fake_thread(db.session, namespace_id))
+    message_ids = sorted(id_ for id_, in db.session.query(Message.id).filter(
+        Message.namespace_id == namespace_id))
+
+    # Pretend that a previous deletion stopped halfway through the messages.
+    account.mark_for_deletion()
+    account._sync_status['deletion_checkpoint'] = {
+        'message': message_ids[len(message_ids) // 2]}
+    db.session.commit()
+
+    delete_namespace(namespace_id)
+
+    for model in (Message, Thread):
+        assert db.session.query(model).filter(
+            model.namespace_id == namespace_id).count() == 0
+    assert db.session.query(Account).filter(
+        Account.id == account_id).count() == 0
+
+
+def test_write_budget(monkeypatch):
+    from inbox.models.util import WriteBudget
+
+    sleeps = []
+    monkeypatch.setattr('gevent.sleep', sleeps.append)
+    with freeze_time('2016-02-02 11:01:34') as frozen:
+        budget = WriteBudget(1000)
+        budget.spend(1000)
+        assert sleeps == []
+        budget.spend(500)
+        assert sleeps == [0.5]
+
+        frozen.tick(delta=datetime.timedelta(seconds=2))
+        budget.spend(1000)
+        assert sleeps == [0.5]
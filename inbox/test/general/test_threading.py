@@ -77,5 +77,59 @@ def test_self_send(db, default_namespace):
     assert matched_thread is first_thread, "Should match on self-send"
 
 
+def test_threading_on_references(db, default_namespace):
+    first_thread = add_fake_thread(db.session, default_namespace.id)
+    first_thread.subject = 'Lunch?'
+
+    first_msg = add_fake_message(db.session, default_namespace.id,
+                                 thread=first_thread, subject='Lunch?',
+                                 from_addr=[('Alice', 'alice@example.com')],
+                                 to_addr=[('Bob', 'bob@example.com')])
+    first_msg.message_id_header = '<lunch-1@example.com>'
+    db.session.commit()
+
+    # A reply with a different subject and no participants in common is
+    # still matched through its headers.
+    reply = add_fake_message(db.session, default_namespace.id, thread=None,
+                             subject='Change of plans',
+                             from_addr=[('Carol', 'carol@example.com')],
+                             to_addr=[('Dave', 'dave@example.com')])
+    reply.in_reply_to = '<lunch-1@example.com>'
+    reply.references = ['<lunch-0@example.com>', '<lunch-1@example.com>']
+
+    matched_thread = fetch_corresponding_thread(db.session,
+                                                default_namespace.id, reply)
+    assert matched_thread is first_thread
+
+    unrelated = add_fake_message(db.session, default_namespace.id,
+                                 thread=None, subject='Change of plans',
+                                 from_addr=[('Carol', 'carol@example.com')],
+                                 to_addr=[('Dave', 'dave@example.com')])
+    unrelated.references = ['<dinner-1@example.com>']
+    assert fetch_corresponding_thread(db.session, default_namespace.id,
+                                      unrelated) is None
+
+
+def test_threading_on_references_respects_max_thread_length(
+        db, default_namespace, monkeypatch):
+    monkeypatch.setattr('inbox.util.threading.MAX_THREAD_LENGTH', 2)
+    thread = add_fake_thread(db.session, default_namespace.id)
+    for i in range(2):
+        msg = add_fake_message(db.session, default_namespace.id,
+                               thread=thread, subject='Mailing list',
+                               from_addr=[('Alice', 'alice@example.com')],
+                               to_addr=[('List', 'list@example.com')])
+        msg.message_id_header = '<list-{}@example.com>'.format(i)
+    db.session.commit()
+
+    reply = add_fake_message(db.session, default_namespace.id, thread=None,
+                             subject='Re: Mailing list',
+                             from_addr=[('Carol', 'carol@example.com')],
+                             to_addr=[('List', 'list@example.com')])
+    reply.references = ['<list-0@example.com>', '<list-1@example.com>']
+    assert fetch_corresponding_thread(db.session, default_namespace.id,
+                                      reply) is None
+
+
 if __name__ == '__main__':
     pytest.main([__file__])
@@ -0,0 +1,121 @@
+import pytest
+
+from inbox.util.throttle import (AdaptiveThrottle, HealthSample,
+                                 MySQLHealthSampler, NoThrottle, get_throttle)
+from inbox.test.util.base import db
+
+__all__ = ['db']
+
+
+class FakeSampler(object):
+
+    def __init__(self, *samples):
+        self.samples = list(samples)
+
+    def sample(self):
+        return self.samples.pop(0)
+
+
+HEALTHY = HealthSample(replica_lag=0, threads_running=1,
+                       history_list_length=100)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr('gevent.sleep', sleeps.append)
+    return sleeps
+
+
+def make_throttle(*samples):
+    return AdaptiveThrottle(FakeSampler(*samples), min_batch_size=10,
+                            max_batch_size=1000, initial_batch_size=100,
+                            batch_size_step=10, max_delay=4, delay_step=1,
+                            sample_interval=0, max_replica_lag=10,
+                            max_threads_running=32,
+                            max_history_list_length=1000)
+
+
+def test_throttle_grows_additively_while_healthy(sleeps):
+    throttle = make_throttle(HEALTHY, HEALTHY)
+    throttle.wait()
+    throttle.wait()
+    assert throttle.batch_size == 120
+    assert sleeps == []
+
+
+@pytest.mark.parametrize('sample', [
+    HEALTHY._replace(replica_lag=11),
+    HEALTHY._replace(threads_running=33),
+    HEALTHY._replace(history_list_length=1001),
+])
+def test_throttle_backs_off_multiplicatively(sleeps, sample):
+    throttle = make_throttle(sample, sample, sample, sample, HEALTHY)
+    for _ in range(4):
+        throttle.wait()
+    assert throttle.batch_size == 10
+    assert sleeps == [1, 2, 4, 4]
+
+    # Recovers gradually.
+    throttle.wait()
+    assert throttle.batch_size == 20
+    assert sleeps[-1] == 3
+
+
+def test_throttle_ignores_missing_signals(sleeps):
+    throttle = make_throttle(HealthSample(None, None, None))
+    throttle.wait()
+    assert throttle.batch_size == 110
+    assert sleeps == []
+
+
+def test_throttle_samples_at_most_every_interval(sleeps):
+    throttle = make_throttle(HEALTHY)
+    throttle.sample_interval = 3600
+    throttle.wait()
+    # Would raise IndexError if sampled again.
+    throttle.wait()
+    assert throttle.batch_size == 110
+
+
+def test_get_throttle_without_throttling():
+    throttle = get_throttle(1, False, batch_size=42)
+    assert isinstance(throttle, NoThrottle)
+    assert throttle.batch_size == 42
+
+
+def test_mysql_health_sampler(db):
+    sample = MySQLHealthSampler(db).sample()
+    # The test database isn't a replica.
+    assert sample.replica_lag is None
+    assert sample.threads_running >= 1
+
+
+class FakeEngine(object):
+
+    def __init__(self, slave_status):
+        self.slave_status = slave_status
+
+    def execute(self, query):
+        return self
+
+    def first(self):
+        return self.slave_status
+
+
+@pytest.mark.parametrize('slave_status,lag', [
+    (None, None),
+    ({'Seconds_Behind_Master': 3}, 3),
+    # Replication is stopped or broken.
+    ({'Seconds_Behind_Master': None}, float('inf')),
+])
+def test_mysql_health_sampler_replica_lag(slave_status, lag):
+    sampler = MySQLHealthSampler(None)
+    assert sampler._replica_lag(FakeEngine(slave_status)) == lag
+
+
+def test_throttle_backs_off_when_replication_is_broken(sleeps):
+    throttle = make_throttle(HEALTHY._replace(replica_lag=float('inf')))
+    throttle.wait()
+    assert throttle.batch_size == 50
+    assert sleeps == [1]
@@ -0,0 +1,38 @@
+from inbox.util.uidset import UidSet
+
+
+def test_membership_and_updates():
+    uids = UidSet([5, 1, 3, 3])
+    assert list(uids) == [1, 3, 5]
+    assert len(uids) == 3
+    assert 3 in uids and 4 not in uids
+    assert uids.max() == 5
+
+    uids.add(7)
+    uids.add(2)
+    uids.add(3)
+    assert list(uids) == [1, 2, 3, 5, 7]
+
+    uids.discard(3)
+    uids.discard(4)
+    uids.update([10, 8])
+    assert list(uids) == [1, 2, 5, 7, 8, 10]
+
+    uids.difference_update([1, 8, 11])
+    assert list(uids) == [2, 5, 7, 10]
+    uids.difference_update(range(0, 1000, 5))
+    assert list(uids) == [2, 7]
+
+    assert UidSet().max() is None
+
+
+def test_queries():
+    uids = UidSet(range(1, 101))
+    assert uids.difference(set(range(2, 100))) == [1, 100]
+    assert UidSet([1, 2, 3]).difference(UidSet([2])) == [1, 3]
+    assert uids.largest(3) == [100, 99, 98]
+    assert uids.largest(0) == []
+    assert UidSet([1, 2]).largest(5) == [2, 1]
+    assert uids.in_ranges([(0, 2), (50, 51), (100, 200), (300, 400)]) == \
+        {1, 2, 50, 51, 100}
+    assert UidSet([2 ** 32 - 1]).max() == 2 ** 32 - 1
@@ -188,7 +188,8 @@ def test_gmail_body(gmail_client, constants):
                    body=body,
                    g_labels=g_labels,
                    g_thrid=g_thrid,
-                   g_msgid=g_msgid)
+                   g_msgid=g_msgid,
+                   deferred_sections=None)
     ]
 
 
@@ -202,6 +203,40 @@ def test_flags(generic_client, constants):
     assert generic_client.flags([uid]) == {uid: Flags(flags, None)}
 
 
+def test_qresync_changes(generic_client, constants):
+    generic_client.qresync_enabled = True
+    expected_resp = '{seq} (FLAGS {flags} ' \
+                    'UID {uid} MODSEQ ({modseq}))'.format(**constants)
+    patch_imap4(generic_client, [expected_resp])
+    untagged_responses = {'VANISHED': ['(EARLIER) 300:303,405,420:410',
+                                       '411']}
+    generic_client.conn._imap.untagged_responses = untagged_responses
+
+    uid = constants['uid']
+    flags = constants['flags']
+    modseq = constants['modseq']
+    changed_flags, vanished = generic_client.qresync_changes(modseq - 10)
+    assert changed_flags == {uid: Flags(flags, modseq)}
+    assert vanished == [(300, 303), (405, 405), (410, 420), (411, 411)]
+    assert 'VANISHED' not in untagged_responses
+
+
+def test_enable_qresync(generic_client):
+    conn = generic_client.conn
+    conn.capabilities = lambda: ('IMAP4REV1', 'CONDSTORE')
+    conn.enable = mock.Mock(return_value=['QRESYNC'])
+    assert not generic_client.enable_qresync()
+    assert not conn.enable.called
+
+    conn.capabilities = lambda: ('IMAP4REV1', 'CONDSTORE', 'QRESYNC')
+    generic_client.selected_folder = ('INBOX', {})
+    assert not generic_client.enable_qresync()
+
+    generic_client.selected_folder = None
+    assert generic_client.enable_qresync()
+    conn.enable.assert_called_once_with('QRESYNC')
+
+
 def test_body(generic_client, constants):
     expected_resp = ('{seq} (UID {uid} MODSEQ ({modseq}) '
                      'INTERNALDATE "{internaldate}" FLAGS {flags} '
@@ -221,7 +256,8 @@ def test_body(generic_client, constants):
                    body=body,
                    g_labels=None,
                    g_thrid=None,
-                   g_msgid=None)
+                   g_msgid=None,
+                   deferred_sections=None)
     ]
 
 
@@ -252,7 +288,8 @@ def test_internaldate(generic_client, constants):
                        body=constants['body'],
                        g_labels=None,
                        g_thrid=None,
-                       g_msgid=None)
+                       g_msgid=None,
+                       deferred_sections=None)
         ]
 
 
@@ -9,8 +9,9 @@ from inbox.crispin import GmailFlags
 from inbox.mailsync.backends.imap.common import (remove_deleted_uids,
                                                  update_metadata)
 from inbox.mailsync.gc import DeleteHandler, LabelRenameHandler
-from inbox.models import Folder, Message, Transaction
+from inbox.models import Folder, Message, Transaction, Block, Part
 from inbox.models.label import Label
+from inbox.models.backends.imap import ImapUid
 from inbox.util.testutils import mock_imapclient, MockIMAPClient
 from inbox.test.util.base import add_fake_imapuid, add_fake_message
 
@@ -75,6 +76,35 @@ def test_deleting_from_a_message_with_multiple_uids(db, default_account,
         "The message should have only one imapuid."
 
 
+def test_remove_deleted_uids_in_batches(db, default_account, default_namespace,
+                                        thread, folder, monkeypatch):
+    monkeypatch.setattr(
+        'inbox.mailsync.backends.imap.common.EXPUNGE_BATCH_SIZE', 2)
+    inbox_folder = Folder.find_or_create(db.session, default_account, 'inbox',
+                                         'inbox')
+    expunged = []
+    for msg_uid in range(1, 6):
+        message = add_fake_message(db.session, default_namespace.id, thread)
+        add_fake_imapuid(db.session, default_account.id, message, folder,
+                         msg_uid)
+        expunged.append(message)
+    # This one is still present in another folder.
+    kept = add_fake_message(db.session, default_namespace.id, thread)
+    add_fake_imapuid(db.session, default_account.id, kept, folder, 6)
+    add_fake_imapuid(db.session, default_account.id, kept, inbox_folder, 6)
+
+    remove_deleted_uids(default_account.id, folder.id, range(1, 8))
+    db.session.expire_all()
+
+    assert db.session.query(ImapUid).filter(
+        ImapUid.folder_id == folder.id).count() == 0
+    for message in expunged:
+        assert message.deleted_at is not None
+        assert not message.imapuids
+    assert kept.deleted_at is None
+    assert len(kept.imapuids) == 1
+
+
 def test_deletion_with_short_ttl(db, default_account, default_namespace,
                                  marked_deleted_message, thread, folder):
     handler = DeleteHandler(account_id=default_account.id,
@@ -200,6 +230,57 @@ def test_deletion_creates_revision(db, default_account, default_namespace,
     assert latest_thread_transaction.command == 'update'
 
 
+def test_deletion_in_batches(db, default_account, default_namespace,
+                             thread, folder, monkeypatch):
+    monkeypatch.setattr('inbox.mailsync.gc.MAX_FETCH', 2)
+    deleted_at = datetime(2015, 2, 22, 22, 22, 22)
+    shared_block = Block(namespace_id=default_namespace.id,
+                         filename='shared.txt', content_type='text/plain',
+                         size=0, data_sha256='')
+    messages = []
+    for i in range(5):
+        message = add_fake_message(db.session, default_namespace.id, thread,
+                                   add_sent_category=True)
+        block = Block(namespace_id=default_namespace.id,
+                      filename='{}.txt'.format(i), content_type='text/plain',
+                      size=0, data_sha256='')
+        db.session.add(Part(block=block, message=message,
+                            content_disposition='attachment'))
+        db.session.add(Part(block=shared_block, message=message))
+        message.deleted_at = deleted_at
+        messages.append(message)
+    kept = add_fake_message(db.session, default_namespace.id, thread)
+    db.session.add(Part(block=shared_block, message=kept))
+    db.session.commit()
+    message_ids = [m.id for m in messages]
+    block_ids = [m.parts[0].block_id for m in messages]
+
+    handler = DeleteHandler(account_id=default_account.id,
+                            namespace_id=default_namespace.id,
+                            provider_name=default_account.provider,
+                            uid_accessor=lambda m: m.imapuids,
+                            message_ttl=0)
+    handler.check(deleted_at + timedelta(seconds=1))
+    db.session.expire_all()
+
+    assert db.session.query(Message).filter(
+        Message.id.in_(message_ids)).count() == 0
+    assert db.session.query(Part).filter(
+        Part.message_id.in_(message_ids)).count() == 0
+    assert db.session.query(Block).filter(
+        Block.id.in_(block_ids)).count() == 0
+    # Blocks still used by other messages are kept.
+    assert shared_block.id
+    assert kept.parts[0].block_id == shared_block.id
+    assert thread.deleted_at is None
+
+    assert db.session.query(Transaction).filter(
+        Transaction.namespace_id == default_namespace.id,
+        Transaction.object_type == 'file',
+        Transaction.record_id.in_(block_ids),
+        Transaction.command == 'delete').count() == 5
+
+
 def test_deleted_labels_get_gced(empty_db, default_account, thread, message,
                                  imapuid, folder):
     # Check that only the labels without messages attached to them
@@ -1,4 +1,5 @@
 # flake8: noqa: F401, F811
+import mock
 import pytest
 from hashlib import sha256
 from gevent.lock import BoundedSemaphore
@@ -71,6 +72,101 @@ def test_initial_sync(db, generic_account, inbox_folder, mock_imapclient):
                                     uid_dict.values()}
 
 
+def test_batched_initial_sync(db, generic_account, inbox_folder,
+                              mock_imapclient, monkeypatch):
+    monkeypatch.setattr(
+        'inbox.mailsync.backends.imap.generic.MAX_DOWNLOAD_COUNT', 10)
+    uid_dict = uids.example()
+    mock_imapclient.add_folder_data(inbox_folder.name, uid_dict)
+
+    fetched_batches = []
+    original_fetch = mock_imapclient.fetch
+
+    def fetch(items, data, modifiers=None):
+        if 'BODY.PEEK[]' in data:
+            fetched_batches.append(items)
+        return original_fetch(items, data, modifiers)
+    mock_imapclient.fetch = fetch
+
+    folder_sync_engine = FolderSyncEngine(generic_account.id,
+                                          generic_account.namespace.id,
+                                          inbox_folder.name,
+                                          generic_account.email_address,
+                                          'custom',
+                                          BoundedSemaphore(1))
+    folder_sync_engine.initial_sync()
+
+    saved_uids = db.session.query(ImapUid).filter(
+        ImapUid.folder_id == inbox_folder.id)
+    assert {u.msg_uid for u in saved_uids} == set(uid_dict)
+    if len(uid_dict) > 1:
+        assert len(fetched_batches) < len(uid_dict)
+
+
+def test_batched_download_isolates_message_errors(db, generic_account,
+                                                  inbox_folder,
+                                                  mock_imapclient,
+                                                  monkeypatch):
+    monkeypatch.setattr(
+        'inbox.mailsync.backends.imap.generic.MAX_DOWNLOAD_COUNT', 10)
+    uid_dict = uids.example()
+    mock_imapclient.add_folder_data(inbox_folder.name, uid_dict)
+    bad_uid = min(uid_dict)
+
+    original_create_message = FolderSyncEngine.create_message
+
+    def create_message(self, db_session, acct, folder, msg):
+        if msg.uid == bad_uid:
+            raise ValueError('unparseable message')
+        return original_create_message(self, db_session, acct, folder, msg)
+    monkeypatch.setattr(FolderSyncEngine, 'create_message', create_message)
+
+    folder_sync_engine = FolderSyncEngine(generic_account.id,
+                                          generic_account.namespace.id,
+                                          inbox_folder.name,
+                                          generic_account.email_address,
+                                          'custom',
+                                          BoundedSemaphore(1))
+    with pytest.raises(ValueError):
+        folder_sync_engine.initial_sync()
+
+    # UIDs are downloaded newest-first, so everything but the bad UID made it.
+    saved_uids = db.session.query(ImapUid).filter(
+        ImapUid.folder_id == inbox_folder.id)
+    assert {u.msg_uid for u in saved_uids} == set(uid_dict) - {bad_uid}
+
+
+def test_sync_phases_timed(db, generic_account, inbox_folder,
+                          mock_imapclient):
+    from inbox.instrumentation import sync_phase_timer
+    sync_phase_timer.reset()
+    uid_dict = {uid: uid_data.example() for uid in range(1, 6)}
+    mock_imapclient.add_folder_data(inbox_folder.name, uid_dict)
+
+    folder_sync_engine = FolderSyncEngine(generic_account.id,
+                                          generic_account.namespace.id,
+                                          inbox_folder.name,
+                                          generic_account.email_address,
+                                          'custom',
+                                          BoundedSemaphore(1))
+    folder_sync_engine.initial_sync()
+
+    phases = sync_phase_timer.stats()['phases']
+    for phase in ['create_message', 'parse', 'blockstore', 'threading',
+                  'contacts']:
+        assert phases[phase]['count'] == 5
+    for phase in ['fetch', 'commit', 'download_and_commit']:
+        assert phases[phase]['count'] >= 1
+    assert phases['create_message']['total_seconds'] >= \
+        phases['threading']['total_seconds']
+    assert phases['create_message']['total_seconds'] >= \
+        phases['parse']['total_seconds'] + \
+        phases['blockstore']['total_seconds']
+
+    sync_phase_timer.reset()
+    assert sync_phase_timer.stats()['phases'] == {}
+
+
 def test_new_uids_synced_when_polling(db, generic_account, inbox_folder,
                                       mock_imapclient):
     uid_dict = uids.example()
@@ -129,6 +225,48 @@ def test_condstore_flags_refresh(db, default_account, all_mail_folder,
         all_mail_folder.name, ['HIGHESTMODSEQ'])['HIGHESTMODSEQ']
 
 
+def test_qresync_flags_refresh_expunges_vanished_uids(
+        db, generic_account, inbox_folder, mock_imapclient, monkeypatch):
+    uid_dict = uids.example()
+    mock_imapclient.add_folder_data(inbox_folder.name, uid_dict)
+    mock_imapclient.capabilities = lambda: ['CONDSTORE', 'QRESYNC']
+    mock_imapclient.enable = lambda *capabilities: list(capabilities)
+    mock_imapclient._imap = mock.Mock(untagged_responses={})
+    inbox_folder.imapfolderinfo = ImapFolderInfo(account=generic_account,
+                                                 uidvalidity=1,
+                                                 uidnext=1)
+    db.session.commit()
+    folder_sync_engine = FolderSyncEngine(generic_account.id,
+                                          generic_account.namespace.id,
+                                          inbox_folder.name,
+                                          generic_account.email_address,
+                                          'custom',
+                                          BoundedSemaphore(1))
+    folder_sync_engine.initial_sync()
+
+    # Expunge a message on the server, which reports it in a VANISHED
+    # response rather than through the full UID listing.
+    expunged_uid = min(uid_dict)
+    del uid_dict[expunged_uid]
+    for k, v in uid_dict.items():
+        v['MODSEQ'] = (k,)
+    mock_imapclient._imap.untagged_responses['VANISHED'] = [
+        '(EARLIER) {}'.format(expunged_uid)]
+
+    def all_uids(*args):
+        raise AssertionError('Listed all UIDs despite QRESYNC')
+    monkeypatch.setattr('inbox.crispin.CrispinClient.all_uids', all_uids)
+
+    folder_sync_engine.highestmodseq = 0
+    # Don't sleep at the end of poll_impl before returning.
+    folder_sync_engine.poll_frequency = 0
+    folder_sync_engine.poll_impl()
+
+    saved_uids = db.session.query(ImapUid).filter(
+        ImapUid.folder_id == inbox_folder.id)
+    assert {u.msg_uid for u in saved_uids} == set(uid_dict)
+
+
 def test_generic_flags_refresh_expunges_transient_uids(
         db, generic_account, inbox_folder, mock_imapclient, monkeypatch):
     # Check that we delete UIDs which are synced but quickly deleted, so never
@@ -149,12 +287,14 @@ def test_generic_flags_refresh_expunges_transient_uids(
     # Don't sleep at the end of poll_impl before returning.
     folder_sync_engine.poll_frequency = 0
     folder_sync_engine.poll_impl()
-    msg = db.session.query(Message).filter_by(
-        namespace_id=generic_account.namespace.id).first()
-    transient_uid = ImapUid(folder=inbox_folder, account=generic_account,
-                            message=msg, msg_uid=max(uid_dict) + 1)
-    db.session.add(transient_uid)
-    db.session.commit()
+    # A new message arrives and gets synced...
+    transient_msg_uid = max(uid_dict) + 1
+    uid_dict[transient_msg_uid] = uid_dict[min(uid_dict)]
+    folder_sync_engine.poll_impl()
+    transient_uid = db.session.query(ImapUid).filter_by(
+        folder_id=inbox_folder.id, msg_uid=transient_msg_uid).one()
+    # ...then is deleted before the next flags refresh.
+    del uid_dict[transient_msg_uid]
     folder_sync_engine.last_slow_refresh = None
     folder_sync_engine.poll_impl()
     with pytest.raises(ObjectDeletedError):
@@ -291,6 +431,48 @@ def test_gmail_message_deduplication(db, default_account, all_mail_folder,
         Message.g_msgid == uid_values['X-GM-MSGID']).count() == 1
 
 
+def test_gmail_batched_message_deduplication(db, default_account,
+                                             all_mail_folder, trash_folder,
+                                             mock_imapclient):
+    all_mail_uids = {}
+    trash_uids = {}
+    for i in range(5):
+        uid_values = uid_data.example()
+        uid_values['X-GM-MSGID'] = uid_values['X-GM-THRID'] = 1000 + i
+        uid_values['FLAGS'] = ()
+        all_mail_uids[22 + i] = uid_values
+        trash_uids[100 + i] = dict(uid_values, FLAGS=('\\Seen',))
+
+    mock_imapclient.list_folders = lambda: [(('\\All', '\\HasNoChildren',),
+                                             '/', u'[Gmail]/All Mail'),
+                                            (('\\Trash', '\\HasNoChildren',),
+                                             '/', u'[Gmail]/Trash')]
+    mock_imapclient.idle = lambda: None
+    mock_imapclient.add_folder_data(all_mail_folder.name, all_mail_uids)
+    mock_imapclient.add_folder_data(trash_folder.name, trash_uids)
+    mock_imapclient.idle_check = raise_imap_error
+
+    for folder in [all_mail_folder, trash_folder]:
+        folder_sync_engine = GmailFolderSyncEngine(
+            default_account.id, default_account.namespace.id, folder.name,
+            default_account.email_address, 'gmail',
+            BoundedSemaphore(1))
+        folder_sync_engine.initial_sync()
+
+    assert {u for u, in db.session.query(ImapUid.msg_uid).filter(
+        ImapUid.folder_id == trash_folder.id)} == set(trash_uids)
+
+    messages = db.session.query(Message).filter(
+        Message.namespace_id == default_account.namespace.id,
+        Message.g_msgid.in_(range(1000, 1005))).all()
+    assert len(messages) == 5
+    for message in messages:
+        db.session.refresh(message)
+        assert len(message.imapuids) == 2
+        # The metadata of the existing messages was recomputed.
+        assert message.is_read
+
+
 def test_imap_message_deduplication(db, generic_account, inbox_folder,
                                     generic_trash_folder, mock_imapclient):
     uid = 22
@@ -52,6 +52,25 @@ def test_generic_drafts_flag_constrained_by_folder(db, generic_account,
     assert message.is_draft == (folder_role == 'drafts')
 
 
+def test_update_metadata_in_batches(db, generic_account, monkeypatch):
+    monkeypatch.setattr(
+        'inbox.mailsync.backends.imap.common.UPDATE_METADATA_BATCH_SIZE', 2)
+    thread = add_fake_thread(db.session, generic_account.namespace.id)
+    folder = add_fake_folder(db.session, generic_account)
+    messages = {}
+    for msg_uid in range(1, 6):
+        messages[msg_uid] = add_fake_message(
+            db.session, generic_account.namespace.id, thread)
+        add_fake_imapuid(db.session, generic_account.id, messages[msg_uid],
+                         folder, msg_uid)
+
+    new_flags = {msg_uid: Flags(('\\Seen',), None) for msg_uid in messages}
+    update_metadata(generic_account.id, folder.id, 'inbox', new_flags,
+                    db.session)
+    db.session.expire_all()
+    assert all(message.is_read for message in messages.values())
+
+
 def test_update_categories_when_actionlog_entry_missing(
         db, default_account, message, imapuid):
     message.categories_changes = True
@@ -223,3 +223,49 @@ def test_account_delta_for_different_namespace_id(db):
     txns, _ = format_transactions_after_pointer(namespace, 0, db.session, 10,
                                                 exclude_account=False)
     assert txns
+
+
+def test_encoded_objects_cached_across_requests(db, default_namespace, thread,
+                                                monkeypatch):
+    from inbox.transactions import delta_sync
+
+    add_fake_message(db.session, default_namespace.id, thread)
+    deltas, _ = delta_sync.format_transactions_after_pointer(
+        default_namespace, 0, db.session, 100)
+    assert deltas
+
+    def encode(*args, **kwargs):
+        raise AssertionError('object should have been cached')
+    monkeypatch.setattr('inbox.transactions.delta_sync.encode', encode)
+
+    cached_deltas, _ = delta_sync.format_transactions_after_pointer(
+        default_namespace, 0, db.session, 100)
+    assert cached_deltas == deltas
+
+
+def test_cached_objects_not_returned_once_deleted(db, default_namespace,
+                                                  thread):
+    from inbox.transactions import delta_sync
+
+    message = add_fake_message(db.session, default_namespace.id, thread)
+    message_public_id = message.public_id
+    deltas, _ = delta_sync.format_transactions_after_pointer(
+        default_namespace, 0, db.session, 100)
+    assert any(d['event'] == 'create' and d['id'] == message_public_id
+               for d in deltas)
+
+    db.session.delete(message)
+    db.session.commit()
+    deltas, _ = delta_sync.format_transactions_after_pointer(
+        default_namespace, 0, db.session, 100)
+    events = [d['event'] for d in deltas if d['id'] == message_public_id]
+    assert events == ['delete']
+
+
+def test_encoded_object_cache_bounded_by_size():
+    from inbox.transactions.delta_sync import ENCODED_OBJECT_CACHE, _repr_size
+    body = 'x' * (ENCODED_OBJECT_CACHE.max_size + 1)
+    repr_ = {'object': 'message', 'body': body}
+    assert _repr_size(repr_) > len(body)
+    ENCODED_OBJECT_CACHE.set('large', (repr_, _repr_size(repr_)))
+    assert ENCODED_OBJECT_CACHE.get('large') is None
@@ -128,6 +128,52 @@ def test_object_type_distinguishes_messages_and_drafts(db, default_namespace):
         assert transaction.command == 'delete'
 
 
+def test_updates_within_a_transaction_are_coalesced(db, default_namespace):
+    thr = add_fake_thread(db.session, default_namespace.id)
+    msg = add_fake_message(db.session, default_namespace.id, thr)
+    count = db.session.query(Transaction).filter(
+        Transaction.namespace_id == default_namespace.id).count()
+
+    msg.is_read = True
+    db.session.flush()
+    msg.is_starred = True
+    db.session.flush()
+    msg.subject = 'Coalesce me'
+    db.session.commit()
+
+    transactions = db.session.query(Transaction).filter(
+        Transaction.namespace_id == default_namespace.id). \
+        order_by(Transaction.id).all()[count:]
+    assert sorted((t.object_type, t.record_id, t.command)
+                  for t in transactions) == \
+        [('message', msg.id, 'update'), ('thread', thr.id, 'update')]
+
+    # A new object which is updated before the commit is still an insert.
+    new_thr = add_fake_thread(db.session, default_namespace.id)
+    new_msg = add_fake_message(db.session, default_namespace.id, thread=None)
+    new_msg.thread = new_thr
+    db.session.add(new_msg)
+    db.session.flush()
+    new_msg.is_read = True
+    db.session.commit()
+    transactions = db.session.query(Transaction).filter(
+        Transaction.namespace_id == default_namespace.id,
+        Transaction.object_type == 'message',
+        Transaction.record_id == new_msg.id).all()
+    assert [t.command for t in transactions] == ['insert']
+
+
+def test_rolled_back_changes_create_no_transactions(db, default_namespace):
+    thr = add_fake_thread(db.session, default_namespace.id)
+    thr.subject = 'Rolled back'
+    db.session.flush()
+    db.session.rollback()
+    db.session.commit()
+    transaction = get_latest_transaction(db.session, 'thread', thr.id,
+                                         default_namespace.id)
+    assert transaction.command == 'insert'
+
+
 def test_event_insert_creates_transaction(db, default_namespace):
     with db.session.no_autoflush:
         event = add_fake_event(db.session, default_namespace.id)
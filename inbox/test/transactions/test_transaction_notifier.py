@@ -0,0 +1,29 @@
+import gevent
+
+from inbox.transactions.notifier import TransactionNotifier
+from inbox.test.util.base import add_fake_message
+
+
+def test_wait_times_out_without_transactions(db, default_namespace):
+    notifier = TransactionNotifier(poll_interval=0.1)
+    notifier.watch(default_namespace.id)
+    try:
+        seen = notifier.latest_transaction_id(default_namespace.id)
+        assert not notifier.wait(default_namespace.id, seen, 0.5)
+    finally:
+        notifier.unwatch(default_namespace.id)
+
+
+def test_wait_wakes_up_on_new_transaction(db, default_namespace, thread):
+    notifier = TransactionNotifier(poll_interval=0.1)
+    notifier.watch(default_namespace.id)
+    try:
+        # Let the tailer find the end of the log first.
+        gevent.sleep(0.3)
+        seen = notifier.latest_transaction_id(default_namespace.id)
+        add_fake_message(db.session, default_namespace.id, thread)
+        assert notifier.wait(default_namespace.id, seen, 5)
+        assert notifier.latest_transaction_id(default_namespace.id) > seen
+    finally:
+        notifier.unwatch(default_namespace.id)
+    assert default_namespace.id not in notifier.latest
@@ -0,0 +1,111 @@
+from sqlalchemy import asc
+from sqlalchemy.sql import func
+from gevent import Greenlet, sleep
+
+from inbox.ignition import engine_manager
+from inbox.models import Transaction, Namespace, DataProcessingCache
+from inbox.models.session import session_scope, session_scope_by_shard_id
+from inbox.contacts.algorithms import (group_scores_from_state,
+                                       contact_scores_from_state)
+from inbox.contacts.scores import (update_contact_score_state,
+                                   score_state_is_stale, groups_need_refresh,
+                                   namespaces_needing_update)
+from inbox.util.stats import statsd_client
+
+from nylas.logging import get_logger
+from nylas.logging.sentry import log_uncaught_errors
+
+log = get_logger()
+
+
+class ContactScoreService(Greenlet):
+    """
+    Poll the transaction log for new messages and update the contact score
+    states (see inbox/contacts/scores.py) of their namespaces, recomputing
+    their intrinsic groups when they're out of date.
+
+    Only namespaces which already have a DataProcessingCache, i.e. which
+    used the contact rankings or groups endpoints, are kept up to date.
+    Those endpoints only serve cached data: namespaces whose state or groups
+    were never built, or whose rebuild was requested, are (re)built here on
+    every pass. Transaction pointers aren't persisted: score states track
+    the last message they counted themselves, so after a restart the
+    remaining messages get counted on the next new message or API request.
+
+    """
+
+    def __init__(self, poll_interval=30, chunk_size=1000):
+        self.poll_interval = poll_interval
+        self.chunk_size = chunk_size
+        self.transaction_pointers = {}
+
+        self.log = log.new(component='contact-scores')
+        Greenlet.__init__(self)
+
+    def _set_transaction_pointers(self):
+        for key in engine_manager.engines:
+            with session_scope_by_shard_id(key) as db_session:
+                self.transaction_pointers[key] = db_session.query(
+                    func.max(Transaction.id)).scalar() or 0
+
+    def _process_transactions(self):
+        shard_should_sleep = []
+        for key in engine_manager.engines:
+            with session_scope_by_shard_id(key) as db_session:
+                transactions = db_session.query(
+                    Transaction.id, Transaction.namespace_id).filter(
+                        Transaction.id > self.transaction_pointers[key],
+                        Transaction.object_type == 'message',
+                        Transaction.command == 'insert'). \
+                    order_by(asc(Transaction.id)). \
+                    limit(self.chunk_size).all()
+                namespace_ids = {namespace_id for _, namespace_id in
+                                 transactions}
+                if namespace_ids:
+                    namespace_ids = [namespace_id for namespace_id, in
+                                     db_session.query(
+                                         DataProcessingCache.namespace_id).
+                                     filter(DataProcessingCache.namespace_id.
+                                            in_(namespace_ids))]
+                namespace_ids = set(namespace_ids) | \
+                    set(namespaces_needing_update(db_session))
+
+            for namespace_id in namespace_ids:
+                self.update_namespace(namespace_id)
+            if transactions:
+                self.transaction_pointers[key] = transactions[-1].id
+            shard_should_sleep.append(len(transactions) < self.chunk_size)
+        if all(shard_should_sleep):
+            sleep(self.poll_interval)
+
+    def _run(self):
+        try:
+            self._set_transaction_pointers()
+
+            self.log.info('Starting contact scores service',
+                          transaction_pointers=self.transaction_pointers)
+
+            while True:
+                statsd_client.incr('contact_scores.heartbeat')
+                self._process_transactions()
+
+        except Exception:
+            log_uncaught_errors(log)
+
+    def update_namespace(self, namespace_id):
+        with session_scope(namespace_id) as db_session:
+            dpcache = db_session.query(DataProcessingCache).filter(
+                DataProcessingCache.namespace_id == namespace_id).one()
+            user_email = db_session.query(Namespace).get(
+                namespace_id).email_address
+            rebuild = score_state_is_stale(dpcache)
+            state, changed = update_contact_score_state(
+                db_session, dpcache, user_email, rebuild=rebuild)
+            if changed:
+                dpcache.contact_rankings = contact_scores_from_state(state)
+            if rebuild or dpcache.contact_groups is None or \
+                    (changed and groups_need_refresh(dpcache)):
+                dpcache.contact_groups = group_scores_from_state(state)
+            db_session.commit()
+        self.log.info('contact scores updated', namespace_id=namespace_id,
+                      changed=changed)
@@ -1,16 +1,29 @@
 import time
-import gevent
 import collections
 from datetime import datetime
 
 from sqlalchemy import asc, desc, bindparam
 from inbox.api.kellogs import APIEncoder, encode
+from inbox.config import config
 from inbox.models import Transaction, Message, Thread, Account, Namespace
 from inbox.models.session import session_scope
 from inbox.models.util import transaction_objects
+from inbox.transactions.notifier import get_transaction_notifier, MAX_WAIT
 from inbox.sqlalchemy_ext.util import bakery
+from inbox.util.lru import LRUCache
 
 
+# Encoded API representations of objects referenced by transactions. Several
+# clients of the same namespace (and streaming and non-streaming delta
+# requests alike) walk the same stretch of the transaction log, so this saves
+# re-encoding (and fully loading) the same objects for each of them. Values
+# are (representation, approximate size in bytes) pairs, so that expanded
+# messages, bodies included, are bounded by total size too.
+ENCODED_OBJECT_CACHE = LRUCache(
+    config.get('DELTA_ENCODED_OBJECT_CACHE_SIZE', 10000),
+    max_size=config.get('DELTA_ENCODED_OBJECT_CACHE_BYTES', 64 * 2 ** 20),
+    sizeof=lambda value: value[1])
+
 EVENT_NAME_FOR_COMMAND = {
     'insert': 'create',
     'update': 'modify',
@@ -82,6 +95,49 @@ def _get_last_trx_id_for_namespace(namespace_id, db_session):
     return q(db_session).params(namespace_id=namespace_id).one()[0]
 
 
+def _encoded_object_key(namespace, trx, expand, is_n1):
+    # Keying on the transaction which the representation was produced for
+    # makes the cache version-aware: any later change to the object creates
+    # a new transaction, and therefore a new key, so stale entries are never
+    # hit and simply age out of the LRU.
+    return (namespace.id, trx.object_type, trx.record_id, trx.public_id,
+            expand, is_n1)
+
+
+def _repr_size(value):
+    # Approximate size of an encoded representation, dominated by its
+    # strings (e.g. message bodies).
+    if isinstance(value, basestring):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(_repr_size(k) + _repr_size(v)
+                   for k, v in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return sum(_repr_size(v) for v in value)
+    return 8
+
+
+def _existing_ids(db_session, object_cls, namespace, ids):
+    """
+    The subset of `ids` (record ids, i.e. account ids for Account) whose
+    objects still exist, checked on the ids only.
+
+    """
+    if not ids:
+        return set()
+    if object_cls == Account:
+        query = db_session.query(Account.id).join(Namespace).filter(
+            Account.id.in_(ids), Namespace.id == namespace.id)
+    else:
+        query = db_session.query(object_cls.id).filter(
+            object_cls.id.in_(ids),
+            object_cls.namespace_id == namespace.id)
+        if object_cls == Message:
+            # Like the objects query below.
+            query = query.filter(Message.thread_id.isnot(None))
+    return {id_ for id_, in query}
+
+
 def format_transactions_after_pointer(namespace, pointer, db_session,
                                       result_limit, exclude_types=None,
                                       include_types=None, exclude_folders=True,
@@ -170,13 +226,30 @@ def format_transactions_after_pointer(namespace, pointer, db_session,
             # one (which is what we want).
             latest_trxs = {(trx.record_id, trx.command): trx for trx in
                            sorted(trxs, key=lambda t: t.id)}.values()
-            # Load all referenced not-deleted objects.
+            # Reuse cached API representations where we have them, and load
+            # all other referenced not-deleted objects.
+            cached_reprs = {}
+            for trx in latest_trxs:
+                if trx.command != 'delete':
+                    cached = ENCODED_OBJECT_CACHE.get(
+                        _encoded_object_key(namespace, trx, expand, is_n1))
+                    if cached is not None:
+                        cached_reprs[trx.id] = cached[0]
             ids_to_query = [trx.record_id for trx in latest_trxs
-                            if trx.command != 'delete']
+                            if trx.command != 'delete' and
+                            trx.id not in cached_reprs]
 
             object_cls = transaction_objects()[obj_type]
-
-            if object_cls == Account:
+            # Cached representations are only served for objects which
+            # still exist.
+            existing_cached_ids = _existing_ids(
+                db_session, object_cls, namespace,
+                [trx.record_id for trx in latest_trxs
+                 if trx.id in cached_reprs])
+
+            if not ids_to_query:
+                objects = {}
+            elif object_cls == Account:
                 # The base query for Account queries the /Namespace/ table
                 # since the API-returned "`account`" is a `namespace`
                 # under-the-hood.
@@ -210,12 +283,21 @@ def format_transactions_after_pointer(namespace, pointer, db_session,
                     'cursor': trx.public_id
                 }
                 if trx.command != 'delete':
-                    obj = objects.get(trx.record_id)
-                    if obj is None:
-                        continue
-                    repr_ = encode(
-                        obj, namespace_public_id=namespace.public_id,
-                        expand=expand, is_n1=is_n1)
+                    repr_ = cached_reprs.get(trx.id)
+                    if repr_ is not None:
+                        if trx.record_id not in existing_cached_ids:
+                            continue
+                    else:
+                        obj = objects.get(trx.record_id)
+                        if obj is None:
+                            continue
+                        repr_ = encode(
+                            obj, namespace_public_id=namespace.public_id,
+                            expand=expand, is_n1=is_n1)
+                        ENCODED_OBJECT_CACHE.set(
+                            _encoded_object_key(namespace, trx, expand,
+                                                is_n1),
+                            (repr_, _repr_size(repr_)))
                     delta['attributes'] = repr_
 
                 results.append((trx.id, delta))
@@ -238,14 +320,14 @@ def streaming_change_generator(namespace, poll_interval, timeout,
                                exclude_metadata=True, exclude_account=True,
                                expand=False, is_n1=False):
     """
-    Poll the transaction log for the given `namespace_id` until `timeout`
+    Watch the transaction log for the given `namespace_id` until `timeout`
     expires, and yield each time new entries are detected.
     Arguments
     ---------
     namespace_id: int
         Id of the namespace for which to check changes.
     poll_interval: float
-        How often to check for changes.
+        How often to send a keepalive newline while there are no changes.
     timeout: float
         How many seconds to allow the connection to remain open.
     transaction_pointer: int, optional
@@ -254,18 +336,35 @@ def streaming_change_generator(namespace, poll_interval, timeout,
 
     """
     encoder = APIEncoder(is_n1=is_n1)
-    start_time = time.time()
-    while time.time() - start_time < timeout:
-        with session_scope(namespace.id) as db_session:
-            deltas, new_pointer = format_transactions_after_pointer(
-                namespace, transaction_pointer, db_session, 100,
-                exclude_types, include_types, exclude_folders,
-                exclude_metadata, exclude_account, expand=expand, is_n1=is_n1)
-
-        if new_pointer is not None and new_pointer != transaction_pointer:
-            transaction_pointer = new_pointer
-            for delta in deltas:
-                yield encoder.cereal(delta) + '\n'
-        else:
+    notifier = get_transaction_notifier()
+    notifier.watch(namespace.id)
+    try:
+        start_time = time.time()
+        while time.time() - start_time < timeout:
+            seen = notifier.latest_transaction_id(namespace.id)
+            with session_scope(namespace.id) as db_session:
+                deltas, new_pointer = format_transactions_after_pointer(
+                    namespace, transaction_pointer, db_session, 100,
+                    exclude_types, include_types, exclude_folders,
+                    exclude_metadata, exclude_account, expand=expand,
+                    is_n1=is_n1)
+
+            if new_pointer is not None and new_pointer != transaction_pointer:
+                transaction_pointer = new_pointer
+                for delta in deltas:
+                    yield encoder.cereal(delta) + '\n'
+                continue
+
+            # Nothing new: rather than re-querying every `poll_interval`,
+            # sleep until the notifier sees new transactions for this
+            # namespace, sending a keepalive newline every `poll_interval`.
             yield '\n'
-            gevent.sleep(poll_interval)
+            idle_start = time.time()
+            while time.time() - idle_start < MAX_WAIT:
+                remaining = timeout - (time.time() - start_time)
+                if remaining <= 0 or notifier.wait(
+                        namespace.id, seen, min(poll_interval, remaining)):
+                    break
+                yield '\n'
+    finally:
+        notifier.unwatch(namespace.id)
@@ -0,0 +1,151 @@
+"""
+Per-process notification hub for new transaction log entries.
+
+Streaming and long-polling delta API requests used to re-run their delta
+query every second while idle, so N open streams cost N queries per second
+even when nothing changed. Instead, a single greenlet per shard tails the
+transaction log and wakes up only the requests watching a namespace which
+has new transactions.
+
+Usage:
+
+    notifier = get_transaction_notifier()
+    notifier.watch(namespace_id)
+    try:
+        seen = notifier.latest_transaction_id(namespace_id)
+        # ... query the transaction log ...
+        notifier.wait(namespace_id, seen, timeout)
+    finally:
+        notifier.unwatch(namespace_id)
+
+Capturing `seen` *before* querying the log means a transaction committed
+while the query runs still wakes up the next wait().
+
+"""
+from collections import defaultdict
+
+import gevent
+from gevent.event import Event
+from sqlalchemy import asc, func
+
+from inbox.config import config
+from inbox.ignition import engine_manager
+from inbox.models import Transaction
+from inbox.models.session import session_scope_by_shard_id
+from nylas.logging import get_logger
+log = get_logger()
+
+# How often each shard's transaction log is tailed.
+POLL_INTERVAL = config.get('TRANSACTION_NOTIFIER_POLL_INTERVAL', 1)
+# Transaction ids aren't necessarily committed in order, so a tailer may
+# occasionally skip past a row. Waiters therefore never sleep longer than
+# this before re-checking the log themselves.
+MAX_WAIT = config.get('TRANSACTION_NOTIFIER_MAX_WAIT', 30)
+TAIL_CHUNK_SIZE = 1000
+
+
+class TransactionNotifier(object):
+
+    def __init__(self, poll_interval=POLL_INTERVAL,
+                 chunk_size=TAIL_CHUNK_SIZE):
+        self.poll_interval = poll_interval
+        self.chunk_size = chunk_size
+        # Number of open requests per watched namespace.
+        self.watchers = defaultdict(int)
+        # Id of the latest transaction seen for each watched namespace.
+        self.latest = {}
+        # Event to wake up the next batch of waiters, per watched namespace.
+        self.events = {}
+        self.tailers = {}
+
+    def watch(self, namespace_id):
+        self._ensure_tailer(engine_manager.shard_key_for_id(namespace_id))
+        self.watchers[namespace_id] += 1
+        self.latest.setdefault(namespace_id, 0)
+
+    def unwatch(self, namespace_id):
+        self.watchers[namespace_id] -= 1
+        if self.watchers[namespace_id] <= 0:
+            del self.watchers[namespace_id]
+            self.latest.pop(namespace_id, None)
+            event = self.events.pop(namespace_id, None)
+            if event is not None:
+                event.set()
+
+    def latest_transaction_id(self, namespace_id):
+        return self.latest.get(namespace_id, 0)
+
+    def wait(self, namespace_id, seen, timeout):
+        """
+        Block until a transaction newer than `seen` (as previously returned by
+        latest_transaction_id()) is recorded for the namespace, or until
+        `timeout` seconds have passed.
+
+        Returns
+        -------
+        bool
+            True if new transactions are available, False on timeout.
+
+        """
+        if self.latest_transaction_id(namespace_id) > seen:
+            return True
+        event = self.events.get(namespace_id)
+        if event is None:
+            event = self.events[namespace_id] = Event()
+        event.wait(min(timeout, MAX_WAIT))
+        return self.latest_transaction_id(namespace_id) > seen
+
+    def _ensure_tailer(self, shard_id):
+        tailer = self.tailers.get(shard_id)
+        if tailer is None or tailer.dead:
+            self.tailers[shard_id] = gevent.spawn(self._tail, shard_id)
+
+    def _tail(self, shard_id):
+        pointer = None
+        while True:
+            has_more = False
+            try:
+                pointer, has_more = self._poll(shard_id, pointer)
+            except Exception:
+                log.error('Error tailing transaction log', shard_id=shard_id,
+                          exc_info=True)
+            if not has_more:
+                gevent.sleep(self.poll_interval)
+
+    def _poll(self, shard_id, pointer):
+        with session_scope_by_shard_id(shard_id, versioned=False) as \
+                db_session:
+            if pointer is None:
+                # Start from the end of the log. Watchers are only
+                # interested in transactions from now on.
+                max_id = db_session.query(func.max(Transaction.id)).scalar()
+                return max_id or 0, False
+            rows = db_session.query(Transaction.id,
+                                    Transaction.namespace_id). \
+                filter(Transaction.id > pointer). \
+                order_by(asc(Transaction.id)). \
+                limit(self.chunk_size).all()
+
+        if not rows:
+            return pointer, False
+
+        changed = set()
+        for id_, namespace_id in rows:
+            if namespace_id in self.latest:
+                self.latest[namespace_id] = id_
+                changed.add(namespace_id)
+        for namespace_id in changed:
+            event = self.events.pop(namespace_id, None)
+            if event is not None:
+                event.set()
+        return rows[-1][0], len(rows) == self.chunk_size
+
+
+_notifier = None
+
+
+def get_transaction_notifier():
+    global _notifier
+    if _notifier is None:
+        _notifier = TransactionNotifier()
+    return _notifier
@@ -3,17 +3,20 @@ from datetime import datetime
 
 from sqlalchemy import asc
 from sqlalchemy.sql import func
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import joinedload, load_only
 from gevent import Greenlet, sleep
 
 from inbox.ignition import engine_manager
 from inbox.util.itert import partition
-from inbox.models import Transaction, Contact
+from inbox.models import Transaction, Contact, Message
 from inbox.util.stats import statsd_client
 from inbox.models.session import session_scope_by_shard_id
-from inbox.models.search import ContactSearchIndexCursor
+from inbox.models.search import (ContactSearchIndexCursor,
+                                 MessageSearchIndexCursor)
 from inbox.contacts.search import (get_doc_service, DOC_UPLOAD_CHUNK_SIZE,
                                    cloudsearch_contact_repr)
+from inbox.search.index import (index_messages, unindex_messages,
+                                INDEX_COLUMNS)
 
 from nylas.logging import get_logger
 from nylas.logging.sentry import log_uncaught_errors
@@ -179,3 +182,101 @@ class ContactSearchIndexService(Greenlet):
             db_session.add(pointer)
         pointer.transaction_id = new_pointer
         self.transaction_pointers[shard_key] = new_pointer
+
+
+class MessageSearchIndexService(Greenlet):
+    """
+    Poll the transaction log for message and draft operations for all
+    namespaces and update the local message search index accordingly.
+
+    Synced messages are immutable as far as the index is concerned, so only
+    their inserts are indexed. Drafts are reindexed whenever they're updated.
+
+    """
+
+    def __init__(self, poll_interval=5, chunk_size=1000):
+        self.poll_interval = poll_interval
+        self.chunk_size = chunk_size
+        self.transaction_pointers = {}
+
+        self.log = log.new(component='message-search-index')
+        Greenlet.__init__(self)
+
+    def _set_transaction_pointers(self):
+        for key in engine_manager.engines:
+            with session_scope_by_shard_id(key) as db_session:
+                pointer = db_session.query(MessageSearchIndexCursor).first()
+                if pointer:
+                    self.transaction_pointers[key] = pointer.transaction_id
+                else:
+                    # As for contacts, start from the latest transaction and
+                    # expect existing messages to be backfilled separately.
+                    self.transaction_pointers[key] = db_session.query(
+                        func.max(Transaction.id)).scalar() or 0
+
+    def _index_transactions(self):
+        shard_should_sleep = []
+        for key in engine_manager.engines:
+            with session_scope_by_shard_id(key) as db_session:
+                transactions = db_session.query(Transaction).filter(
+                    Transaction.id > self.transaction_pointers[key],
+                    Transaction.object_type.in_(['message', 'draft'])). \
+                    order_by(asc(Transaction.id)). \
+                    limit(self.chunk_size).all()
+
+                if transactions:
+                    self.index(transactions, db_session)
+                    latency = (datetime.utcnow() -
+                               transactions[0].created_at).seconds
+                    statsd_client.timing(
+                        'message_search_index.transactions.latency', latency)
+                    self.update_pointer(transactions[-1].id, key, db_session)
+                    db_session.commit()
+                shard_should_sleep.append(
+                    len(transactions) < self.chunk_size)
+        if all(shard_should_sleep):
+            sleep(self.poll_interval)
+
+    def _run(self):
+        try:
+            self._set_transaction_pointers()
+
+            self.log.info('Starting message-search-index service',
+                          transaction_pointers=self.transaction_pointers)
+
+            while True:
+                statsd_client.incr('message_search_index.heartbeat')
+                self._index_transactions()
+
+        except Exception:
+            log_uncaught_errors(log)
+
+    def index(self, transactions, db_session):
+        delete_ids = set()
+        add_ids = set()
+        for txn in transactions:
+            if txn.command == 'delete':
+                delete_ids.add(txn.record_id)
+                add_ids.discard(txn.record_id)
+            elif txn.command == 'insert' or txn.object_type == 'draft':
+                add_ids.add(txn.record_id)
+                delete_ids.discard(txn.record_id)
+
+        unindex_messages(db_session, list(delete_ids))
+        messages = []
+        if add_ids:
+            messages = db_session.query(Message).filter(
+                Message.id.in_(add_ids)).options(
+                    load_only(*INDEX_COLUMNS)).all()
+            index_messages(db_session, messages)
+
+        self.log.info('messages indexed', adds=len(messages),
+                      deletes=len(delete_ids))
+
+    def update_pointer(self, new_pointer, shard_key, db_session):
+        pointer = db_session.query(MessageSearchIndexCursor).first()
+        if pointer is None:
+            pointer = MessageSearchIndexCursor()
+            db_session.add(pointer)
+        pointer.transaction_id = new_pointer
+        self.transaction_pointers[shard_key] = new_pointer
@@ -1,8 +1,28 @@
+"""
+Content-addressed storage for raw MIME messages and attachment data.
+
+Blobs are keyed by the hex SHA-256 of their contents, so a key is only ever
+written once and its value never changes. The storage itself is provided by
+a pluggable backend (local disk or S3, see BLOCKSTORE_BACKENDS), and
+recently read blobs are kept in a bounded in-process LRU cache. Blobs which
+nothing references anymore are deleted by inbox.util.blockstore_gc.
+
+"""
+import calendar
+import errno
 import os
+import re
 import time
 from hashlib import sha256
 
+from boto.s3.connection import S3Connection
+from boto.s3.key import Key
+from gevent.pool import Pool
+
 from inbox.config import config
+from inbox.util.file import mkdirp
+from inbox.util.itert import chunk
+from inbox.util.lru import LRUCache
 from inbox.util.stats import statsd_client
 from nylas.logging import get_logger
 log = get_logger()
@@ -10,76 +30,379 @@ log = get_logger()
 # TODO: store AWS credentials in a better way.
 STORE_MSG_ON_S3 = config.get('STORE_MESSAGES_ON_S3', None)
 
-if STORE_MSG_ON_S3:
-    from boto.s3.connection import S3Connection
-    from boto.s3.key import Key
-else:
-    from inbox.util.file import mkdirp
+# Bounds for the in-process cache of recently read blobs. Blobs larger than
+# BLOCKSTORE_CACHE_MAX_BLOB_BYTES (typically big attachments) aren't cached,
+# so that a single download can't evict every hot message.
+CACHE_MAX_ITEMS = config.get('BLOCKSTORE_CACHE_MAX_ITEMS', 1000)
+CACHE_MAX_BYTES = config.get('BLOCKSTORE_CACHE_MAX_BYTES', 64 * 2 ** 20)
+CACHE_MAX_BLOB_BYTES = config.get('BLOCKSTORE_CACHE_MAX_BLOB_BYTES', 2 ** 20)
 
-    def _data_file_directory(h):
-        return os.path.join(config.get_required('MSG_PARTS_DIRECTORY'),
-                            h[0], h[1], h[2], h[3], h[4], h[5])
+# Number of concurrent requests used by the batch API of remote backends.
+BATCH_CONCURRENCY = config.get('BLOCKSTORE_BATCH_CONCURRENCY', 8)
 
-    def _data_file_path(h):
-        return os.path.join(_data_file_directory(h), h)
+# Size of the chunks yielded by streaming reads.
+STREAM_CHUNK_SIZE = config.get('BLOCKSTORE_STREAM_CHUNK_SIZE', 64 * 2 ** 10)
 
+# Seconds for which remote backends trust that a key they saved still exists.
+# Must be well below the grace period of garbage collection.
+KNOWN_KEYS_TTL = config.get('BLOCKSTORE_KNOWN_KEYS_TTL', 60 * 60)
 
-def save_to_blockstore(data_sha256, data):
-    assert data is not None
-    assert type(data) is not unicode
 
-    if len(data) == 0:
-        log.warning('Not saving 0-length data blob')
-        return
+_SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
 
-    if STORE_MSG_ON_S3:
-        _save_to_s3(data_sha256, data)
-    else:
-        directory = _data_file_directory(data_sha256)
-        mkdirp(directory)
 
-        with open(_data_file_path(data_sha256), 'wb') as f:
-            f.write(data)
+def _iter_string_chunks(data, chunk_size):
+    for i in xrange(0, len(data), chunk_size):
+        yield data[i:i + chunk_size]
 
 
-def _save_to_s3(data_sha256, data):
-    assert 'TEMP_MESSAGE_STORE_BUCKET_NAME' in config, \
-        'Need temp bucket name to store message data!'
+class BlockstoreBackend(object):
+    """
+    Interface for blockstore backends.
 
-    _save_to_s3_bucket(data_sha256,
-                       config.get('TEMP_MESSAGE_STORE_BUCKET_NAME'), data)
+    Backends store opaque byte strings under their SHA-256 hex digest.
+    Callers are responsible for hashing the data and verifying what's
+    returned; backends only move bytes around.
 
+    """
 
-def _save_to_s3_bucket(data_sha256, bucket_name, data):
-    assert 'AWS_ACCESS_KEY_ID' in config, 'Need AWS key!'
-    assert 'AWS_SECRET_ACCESS_KEY' in config, 'Need AWS secret!'
-    start = time.time()
+    def save(self, data_sha256, data):
+        raise NotImplementedError
 
-    # Boto pools connections at the class level
-    conn = S3Connection(config.get('AWS_ACCESS_KEY_ID'),
-                        config.get('AWS_SECRET_ACCESS_KEY'))
-    bucket = conn.get_bucket(bucket_name, validate=False)
+    def get(self, data_sha256):
+        """ Returns the stored data, or None if there's no such blob. """
+        raise NotImplementedError
 
-    # See if it already exists; if so, don't recreate.
-    key = bucket.get_key(data_sha256)
-    if key:
-        return
+    def exists(self, data_sha256):
+        raise NotImplementedError
 
-    key = Key(bucket)
-    key.key = data_sha256
-    key.set_contents_from_string(data)
+    def open_stream(self, data_sha256, start=0, stop=None,
+                    chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Returns an iterator over the bytes [start, stop) of the blob in
+        chunks of at most `chunk_size` bytes, or None if there's no such
+        blob. Backends should override this to avoid reading the whole blob
+        into memory.
 
-    end = time.time()
-    latency_millis = (end - start) * 1000
-    statsd_client.timing('s3_blockstore.save_latency', latency_millis)
+        """
+        data = self.get(data_sha256)
+        if data is None:
+            return None
+        return _iter_string_chunks(data[start:stop], chunk_size)
 
+    def save_many(self, blobs):
+        """ Saves a {data_sha256: data} dict of blobs. """
+        for data_sha256, data in blobs.iteritems():
+            self.save(data_sha256, data)
 
-def get_from_blockstore(data_sha256):
-    if STORE_MSG_ON_S3:
-        value = _get_from_s3(data_sha256)
-    else:
-        value = _get_from_disk(data_sha256)
+    def get_many(self, data_sha256s):
+        """
+        Returns a {data_sha256: data} dict of the requested blobs. Missing
+        blobs map to None.
+
+        """
+        return {h: self.get(h) for h in data_sha256s}
+
+    def list_blobs(self):
+        """
+        Yields a (data_sha256, size, modified_at) tuple for every stored
+        blob, modified_at being a Unix timestamp.
+
+        """
+        raise NotImplementedError
+
+    def delete_many(self, data_sha256s):
+        """ Deletes the given blobs. Missing blobs are ignored. """
+        raise NotImplementedError
+
+
+class LocalBlockstoreBackend(BlockstoreBackend):
+    """
+    Stores blobs as files under MSG_PARTS_DIRECTORY, fanned out into
+    directories by the first six characters of their hash.
+
+    """
+
+    def __init__(self, root_directory=None):
+        self._root_directory = root_directory
+
+    @property
+    def root_directory(self):
+        if self._root_directory is not None:
+            return self._root_directory
+        return config.get_required('MSG_PARTS_DIRECTORY')
+
+    def _data_file_directory(self, h):
+        return os.path.join(self.root_directory,
+                            h[0], h[1], h[2], h[3], h[4], h[5])
+
+    def _data_file_path(self, h):
+        return os.path.join(self._data_file_directory(h), h)
+
+    def save(self, data_sha256, data):
+        path = self._data_file_path(data_sha256)
+        # Content-addressed, so an existing file already has the right data.
+        # Touch it though, so that garbage collection's grace period covers
+        # the row about to reference it.
+        try:
+            os.utime(path, None)
+            return
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        mkdirp(self._data_file_directory(data_sha256))
+        # Write to a temporary file first so that readers (and the existence
+        # check above) never see a partially written blob.
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+
+    def list_blobs(self):
+        for directory, _, filenames in os.walk(self.root_directory):
+            for filename in filenames:
+                if not _SHA256_RE.match(filename):
+                    # E.g. a temporary file being written.
+                    continue
+                try:
+                    st = os.stat(os.path.join(directory, filename))
+                except OSError:
+                    continue
+                yield filename, st.st_size, st.st_mtime
+
+    def delete_many(self, data_sha256s):
+        for data_sha256 in data_sha256s:
+            try:
+                os.remove(self._data_file_path(data_sha256))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def get(self, data_sha256):
+        if not data_sha256:
+            return None
+
+        try:
+            with open(self._data_file_path(data_sha256), 'rb') as f:
+                return f.read()
+        except IOError:
+            log.error('No file with name: {}!'.format(data_sha256))
+            return
+
+    def exists(self, data_sha256):
+        return bool(data_sha256) and \
+            os.path.exists(self._data_file_path(data_sha256))
+
+    def open_stream(self, data_sha256, start=0, stop=None,
+                    chunk_size=STREAM_CHUNK_SIZE):
+        if not data_sha256:
+            return None
+
+        try:
+            f = open(self._data_file_path(data_sha256), 'rb')
+        except IOError:
+            log.error('No file with name: {}!'.format(data_sha256))
+            return None
+
+        def stream():
+            with f:
+                f.seek(start)
+                remaining = None if stop is None else stop - start
+                while remaining is None or remaining > 0:
+                    size = chunk_size if remaining is None else \
+                        min(chunk_size, remaining)
+                    data = f.read(size)
+                    if not data:
+                        break
+                    if remaining is not None:
+                        remaining -= len(data)
+                    yield data
+        return stream()
+
+
+class S3BlockstoreBackend(BlockstoreBackend):
+    """
+    Stores blobs as keys of an S3 bucket.
+
+    The connection and bucket handles are created once and reused for every
+    request rather than per call. Since keys are immutable, the backend also
+    remembers which keys it has recently saved so that it can skip saving
+    them again. Garbage collection may delete keys behind its back, so these
+    are only trusted for KNOWN_KEYS_TTL seconds, which must be well below
+    the collection's grace period.
+
+    """
+
+    def __init__(self, bucket_name=None, known_keys_cache_size=100000,
+                 known_keys_ttl=KNOWN_KEYS_TTL):
+        self._bucket_name = bucket_name
+        self._conn = None
+        self._bucket = None
+        # data_sha256 -> when the key was last saved or touched.
+        self._known_keys = LRUCache(known_keys_cache_size)
+        self._known_keys_ttl = known_keys_ttl
+
+    def _recently_saved(self, data_sha256):
+        saved_at = self._known_keys.get(data_sha256)
+        return saved_at is not None and \
+            time.time() - saved_at < self._known_keys_ttl
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            assert 'AWS_ACCESS_KEY_ID' in config, 'Need AWS key!'
+            assert 'AWS_SECRET_ACCESS_KEY' in config, 'Need AWS secret!'
+            bucket_name = self._bucket_name
+            if bucket_name is None:
+                assert 'TEMP_MESSAGE_STORE_BUCKET_NAME' in config, \
+                    'Need temp bucket name to store message data!'
+                bucket_name = config.get('TEMP_MESSAGE_STORE_BUCKET_NAME')
+
+            # Boto pools the underlying HTTP connections per S3Connection
+            # object.
+            self._conn = S3Connection(config.get('AWS_ACCESS_KEY_ID'),
+                                      config.get('AWS_SECRET_ACCESS_KEY'))
+            self._bucket = self._conn.get_bucket(bucket_name, validate=False)
+        return self._bucket
+
+    def save(self, data_sha256, data):
+        start = time.time()
+
+        if self._recently_saved(data_sha256):
+            return
+
+        key = self.bucket.get_key(data_sha256)
+        if key is not None:
+            # Already stored, so don't reupload it, but refresh its last
+            # modified time (copying a key onto itself requires replacing
+            # its metadata) so that garbage collection's grace period covers
+            # the row about to reference it.
+            key.copy(self.bucket.name, data_sha256,
+                     metadata=key.metadata or {}, preserve_acl=True)
+        else:
+            key = Key(self.bucket)
+            key.key = data_sha256
+            key.set_contents_from_string(data)
+        self._known_keys.set(data_sha256, time.time())
+
+        end = time.time()
+        latency_millis = (end - start) * 1000
+        statsd_client.timing('s3_blockstore.save_latency', latency_millis)
+
+    def get(self, data_sha256):
+        if not data_sha256:
+            return None
+
+        key = self.bucket.get_key(data_sha256)
+        if not key:
+            log.info("Couldn't find data in blockstore",
+                     sha256=data_sha256, logstash_tag='s3_direct')
+            return None
 
+        log.info('Found hash in temporary blockstore!',
+                 sha256=data_sha256, logstash_tag='s3_direct')
+        return key.get_contents_as_string()
+
+    def exists(self, data_sha256):
+        if not data_sha256:
+            return False
+        if self._recently_saved(data_sha256):
+            return True
+        return self.bucket.get_key(data_sha256) is not None
+
+    def open_stream(self, data_sha256, start=0, stop=None,
+                    chunk_size=STREAM_CHUNK_SIZE):
+        if not data_sha256:
+            return None
+
+        key = self.bucket.get_key(data_sha256)
+        if not key:
+            log.info("Couldn't find data in blockstore",
+                     sha256=data_sha256, logstash_tag='s3_direct')
+            return None
+
+        headers = {}
+        if start or stop is not None:
+            headers['Range'] = 'bytes={}-{}'.format(
+                start, '' if stop is None else stop - 1)
+
+        def stream():
+            try:
+                key.open_read(headers=headers)
+                while True:
+                    data = key.read(chunk_size)
+                    if not data:
+                        break
+                    yield data
+            finally:
+                key.close(fast=True)
+        return stream()
+
+    def save_many(self, blobs):
+        pool = Pool(BATCH_CONCURRENCY)
+        for data_sha256, data in blobs.iteritems():
+            pool.spawn(self.save, data_sha256, data)
+        pool.join(raise_error=True)
+
+    def get_many(self, data_sha256s):
+        pool = Pool(BATCH_CONCURRENCY)
+        data_sha256s = list(data_sha256s)
+        return dict(zip(data_sha256s, pool.map(self.get, data_sha256s)))
+
+    def list_blobs(self):
+        for key in self.bucket.list():
+            if not _SHA256_RE.match(key.name):
+                continue
+            modified_at = calendar.timegm(time.strptime(
+                key.last_modified[:19], '%Y-%m-%dT%H:%M:%S'))
+            yield key.name, key.size, modified_at
+
+    def delete_many(self, data_sha256s):
+        # S3 deletes at most 1000 keys per request.
+        for batch in chunk(list(data_sha256s), 1000):
+            self.bucket.delete_keys(list(batch), quiet=True)
+            for data_sha256 in batch:
+                self._known_keys.pop(data_sha256)
+
+
+BLOCKSTORE_BACKENDS = {
+    'local': LocalBlockstoreBackend,
+    's3': S3BlockstoreBackend,
+}
+
+_backend = None
+_cache = LRUCache(CACHE_MAX_ITEMS, max_size=CACHE_MAX_BYTES, sizeof=len)
+
+
+def get_blockstore_backend():
+    """
+    Returns the configured backend. BLOCKSTORE_BACKEND selects one of
+    BLOCKSTORE_BACKENDS by name; by default S3 is used if
+    STORE_MESSAGES_ON_S3 is set and local disk otherwise.
+
+    """
+    global _backend
+    if _backend is None:
+        name = config.get('BLOCKSTORE_BACKEND',
+                          's3' if STORE_MSG_ON_S3 else 'local')
+        _backend = BLOCKSTORE_BACKENDS[name]()
+    return _backend
+
+
+def set_blockstore_backend(backend):
+    """ Replaces the process-wide backend, e.g. with a custom one. """
+    global _backend
+    _backend = backend
+    _cache.clear()
+
+
+def _cache_blob(data_sha256, data):
+    if len(data) <= CACHE_MAX_BLOB_BYTES:
+        _cache.set(data_sha256, data)
+
+
+def _verify(data_sha256, value):
     if value is None:
         # We don't store None values so if such is returned, it's an error.
         log.error('No data returned!')
@@ -87,56 +410,114 @@ def get_from_blockstore(data_sha256):
 
     assert data_sha256 == sha256(value).hexdigest(), \
         "Returned data doesn't match stored hash!"
+    _cache_blob(data_sha256, value)
     return value
 
 
-def _get_from_s3(data_sha256):
-    assert 'AWS_ACCESS_KEY_ID' in config, 'Need AWS key!'
-    assert 'AWS_SECRET_ACCESS_KEY' in config, 'Need AWS secret!'
+def save_to_blockstore(data_sha256, data):
+    assert data is not None
+    assert type(data) is not unicode
 
-    assert 'TEMP_MESSAGE_STORE_BUCKET_NAME' in config, \
-        'Need temp bucket name to store message data!'
+    if len(data) == 0:
+        log.warning('Not saving 0-length data blob')
+        return
 
-    # Try getting data from our temporary blockstore before
-    # trying getting it from the provider.
-    data = _get_from_s3_bucket(data_sha256,
-                               config.get('TEMP_MESSAGE_STORE_BUCKET_NAME'))
+    get_blockstore_backend().save(data_sha256, data)
 
-    if data is not None:
-        log.info('Found hash in temporary blockstore!',
-                 sha256=data_sha256, logstash_tag='s3_direct')
-        return data
 
-    log.info("Couldn't find data in blockstore",
-             sha256=data_sha256, logstash_tag='s3_direct')
+def save_many_to_blockstore(blobs):
+    """ Saves a {data_sha256: data} dict of blobs in one batch. """
+    to_save = {}
+    for data_sha256, data in blobs.iteritems():
+        assert data is not None
+        assert type(data) is not unicode
+        if len(data) == 0:
+            log.warning('Not saving 0-length data blob')
+            continue
+        to_save[data_sha256] = data
 
-    return None
+    if to_save:
+        get_blockstore_backend().save_many(to_save)
 
 
-def _get_from_s3_bucket(data_sha256, bucket_name):
-    if not data_sha256:
-        return None
+def delete_from_blockstore(data_sha256s):
+    """
+    Deletes the given blobs. Only use this for blobs which nothing
+    references anymore, see inbox.util.blockstore_gc.
 
-    conn = S3Connection(config.get('AWS_ACCESS_KEY_ID'),
-                        config.get('AWS_SECRET_ACCESS_KEY'))
-    bucket = conn.get_bucket(bucket_name, validate=False)
+    """
+    for data_sha256 in data_sha256s:
+        _cache.pop(data_sha256)
+    get_blockstore_backend().delete_many(data_sha256s)
 
-    key = bucket.get_key(data_sha256)
 
-    if not key:
-        log.error('No key with name: {} returned!'.format(data_sha256))
-        return
+def get_from_blockstore(data_sha256):
+    value = _cache.get(data_sha256)
+    if value is not None:
+        statsd_client.incr('blockstore.cache_hits')
+        return value
+
+    statsd_client.incr('blockstore.cache_misses')
+    value = get_blockstore_backend().get(data_sha256)
+    return _verify(data_sha256, value)
 
-    return key.get_contents_as_string()
 
+def stream_from_blockstore(data_sha256, start=0, stop=None,
+                           chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Returns an iterator over the bytes [start, stop) of a blob in chunks of
+    at most `chunk_size` bytes, or None if the blob isn't stored.
 
-def _get_from_disk(data_sha256):
-    if not data_sha256:
+    When the whole blob is read, its hash is verified incrementally and an
+    AssertionError is raised once the stream is exhausted if it doesn't
+    match. Partial reads can't be verified.
+
+    """
+    value = _cache.get(data_sha256)
+    if value is not None:
+        statsd_client.incr('blockstore.cache_hits')
+        return _iter_string_chunks(value[start:stop], chunk_size)
+
+    statsd_client.incr('blockstore.cache_misses')
+    stream = get_blockstore_backend().open_stream(data_sha256, start, stop,
+                                                  chunk_size)
+    if stream is None:
+        log.error('No data returned!')
         return None
+    if start == 0 and stop is None:
+        return _verified_stream(data_sha256, stream)
+    return stream
 
-    try:
-        with open(_data_file_path(data_sha256), 'rb') as f:
-            return f.read()
-    except IOError:
-        log.error('No file with name: {}!'.format(data_sha256))
-        return
+
+def _verified_stream(data_sha256, stream):
+    h = sha256()
+    for data in stream:
+        h.update(data)
+        yield data
+    assert data_sha256 == h.hexdigest(), \
+        "Returned data doesn't match stored hash!"
+
+
+def get_many_from_blockstore(data_sha256s):
+    """
+    Returns a {data_sha256: data} dict of the requested blobs, fetching the
+    ones which aren't cached in one batch. Missing blobs map to None.
+
+    """
+    values = {}
+    missing = []
+    for data_sha256 in set(data_sha256s):
+        value = _cache.get(data_sha256)
+        if value is None:
+            missing.append(data_sha256)
+        else:
+            values[data_sha256] = value
+
+    statsd_client.incr('blockstore.cache_hits', len(values))
+    if missing:
+        statsd_client.incr('blockstore.cache_misses', len(missing))
+        fetched = get_blockstore_backend().get_many(missing)
+        for data_sha256 in missing:
+            values[data_sha256] = _verify(data_sha256,
+                                          fetched.get(data_sha256))
+    return values
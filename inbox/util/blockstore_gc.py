@@ -0,0 +1,186 @@
+"""
+Garbage collection of blockstore blobs.
+
+Blobs are content-addressed and may be shared by several messages and
+blocks (e.g. the same attachment received twice), so deleting rows never
+deletes their blobs. Instead, collect_garbage() periodically:
+
+1. computes the set of live hashes, i.e. the data_sha256 of every message
+   and block of every shard, reading them in id-ordered windows;
+2. lists the blobs of the blockstore and diffs them against that set;
+3. deletes the unreferenced blobs older than a grace period, after checking
+   once more that no row references them.
+
+The grace period covers blobs saved ahead of the rows which reference them
+(sync saves messages to the blockstore before committing them), as well as
+rows created while the live set was being computed. Saving a blob which is
+already stored refreshes its modification time, so a blob which a new row
+starts using again is covered too; backends which remember the keys they
+saved only trust that memory for KNOWN_KEYS_TTL, well below the grace
+period. Should a blob still be deleted from under a new row, it's refetched
+from the provider on access, like any other blockstore miss.
+
+Blobs may be shared across shards, so a collection always considers the
+references of every shard.
+
+The live set keeps the binary digests, about 70 bytes per blob.
+
+With `throttle`, the reads of each shard are paced by its AdaptiveThrottle
+(see inbox.util.throttle).
+
+"""
+import binascii
+import time
+
+from inbox.ignition import engine_manager
+from inbox.models import Message, Block
+from inbox.models.session import session_scope_by_shard_id
+from inbox.sqlalchemy_ext.util import safer_yield_per
+from inbox.util.throttle import get_shard_throttle
+from inbox.util.blockstore import (get_blockstore_backend,
+                                   delete_from_blockstore, KNOWN_KEYS_TTL)
+
+from nylas.logging import get_logger
+log = get_logger()
+
+DEFAULT_GRACE_PERIOD = 3 * 24 * 60 * 60  # 3 days
+# Number of rows read per query when computing the live set.
+WINDOW_SIZE = 10000
+# Number of blobs deleted at once.
+DELETE_BATCH_SIZE = 1000
+
+
+class GCReport(object):
+    """ Counts (and sizes, in bytes) of the blobs seen by a collection. """
+
+    def __init__(self, dry_run):
+        self.dry_run = dry_run
+        self.live = 0
+        self.stored = 0
+        self.stored_bytes = 0
+        # Not referenced, but within the grace period.
+        self.recent = 0
+        self.recent_bytes = 0
+        self.collectable = 0
+        self.collectable_bytes = 0
+        # Referenced again by the time they were about to be deleted.
+        self.resurrected = 0
+        self.deleted = 0
+        self.deleted_bytes = 0
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+def _digest(data_sha256):
+    try:
+        return binascii.unhexlify(data_sha256)
+    except TypeError:
+        return None
+
+
+def live_hashes(shard_ids=None, window_size=WINDOW_SIZE, throttle=False):
+    """
+    Set of the (binary) SHA-256 digests referenced by the messages and
+    blocks of the given shards, all of them by default.
+
+    """
+    if shard_ids is None:
+        shard_ids = sorted(engine_manager.engines)
+    live = set()
+    for shard_id in shard_ids:
+        shard_throttle = get_shard_throttle(shard_id, throttle)
+        with session_scope_by_shard_id(shard_id, versioned=False) as \
+                db_session:
+            for model in (Message, Block):
+                query = db_session.query(model.id, model.data_sha256). \
+                    filter(model.data_sha256.isnot(None))
+                for i, (_, data_sha256) in enumerate(safer_yield_per(
+                        query, model.id, 0, window_size)):
+                    if i % window_size == 0:
+                        shard_throttle.wait()
+                    digest = _digest(data_sha256)
+                    if digest is not None:
+                        live.add(digest)
+        log.info('Computed live blockstore hashes for shard',
+                 shard_id=shard_id, live=len(live))
+    return live
+
+
+def referenced_hashes(data_sha256s, shard_ids=None, throttle=False):
+    """ The subset of the given hashes which some message or block uses. """
+    if shard_ids is None:
+        shard_ids = sorted(engine_manager.engines)
+    data_sha256s = list(data_sha256s)
+    referenced = set()
+    for shard_id in shard_ids:
+        get_shard_throttle(shard_id, throttle).wait()
+        with session_scope_by_shard_id(shard_id, versioned=False) as \
+                db_session:
+            for model in (Message, Block):
+                referenced.update(h for h, in db_session.query(
+                    model.data_sha256).filter(
+                        model.data_sha256.in_(data_sha256s)).distinct())
+    return referenced
+
+
+def collect_garbage(grace_period=DEFAULT_GRACE_PERIOD, dry_run=True,
+                    now=None, throttle=False):
+    """
+    Delete the blobs which no message or block references and which are
+    older than `grace_period` seconds. With `dry_run`, only report what
+    would be deleted. With `throttle`, database reads are paced by each
+    shard's AdaptiveThrottle.
+
+    Returns
+    -------
+    GCReport
+
+    Raises
+    ------
+    ValueError
+        If the grace period isn't longer than KNOWN_KEYS_TTL.
+
+    """
+    if grace_period <= KNOWN_KEYS_TTL:
+        raise ValueError('The grace period must be longer than '
+                         'BLOCKSTORE_KNOWN_KEYS_TTL ({}s)'.format(
+                             KNOWN_KEYS_TTL))
+    report = GCReport(dry_run)
+    live = live_hashes(throttle=throttle)
+    report.live = len(live)
+    cutoff = (now if now is not None else time.time()) - grace_period
+
+    batch = {}
+    for data_sha256, size, modified_at in \
+            get_blockstore_backend().list_blobs():
+        report.stored += 1
+        report.stored_bytes += size
+        if _digest(data_sha256) in live:
+            continue
+        if modified_at > cutoff:
+            report.recent += 1
+            report.recent_bytes += size
+            continue
+        report.collectable += 1
+        report.collectable_bytes += size
+        if dry_run:
+            continue
+        batch[data_sha256] = size
+        if len(batch) >= DELETE_BATCH_SIZE:
+            _delete_batch(batch, report, throttle)
+            batch = {}
+    if batch:
+        _delete_batch(batch, report, throttle)
+
+    log.info('Collected blockstore garbage', **report.as_dict())
+    return report
+
+
+def _delete_batch(batch, report, throttle):
+    referenced = referenced_hashes(batch, throttle=throttle)
+    report.resurrected += len(referenced)
+    to_delete = [h for h in batch if h not in referenced]
+    delete_from_blockstore(to_delete)
+    report.deleted += len(to_delete)
+    report.deleted_bytes += sum(batch[h] for h in to_delete)
@@ -0,0 +1,130 @@
+"""
+Reassemble messages without the bodies of their attachments, from their IMAP
+BODYSTRUCTURE (RFC 3501 section 7.4.2).
+
+Rather than BODY[], the message's header, the MIME headers of all its parts
+and the bodies of its text parts are fetched, and glued back together into a
+'skeleton' message with the same MIME tree as the original, in which the
+bodies of the other (attachment) parts are empty. Parsing the skeleton then
+yields the same message metadata, bodies and parts as parsing the full
+message; the attachments themselves are downloaded later, see
+CrispinClient.uids_without_attachments().
+
+"""
+
+
+class UnsupportedStructure(Exception):
+    pass
+
+
+def _is_multipart(structure):
+    return isinstance(structure[0], list)
+
+
+def _params(values):
+    if not values:
+        return {}
+    values = list(values)
+    return {values[i].lower(): values[i + 1]
+            for i in xrange(0, len(values) - 1, 2)}
+
+
+def _decoded_size(encoding, size):
+    # Approximation of the decoded size, exact for unencoded parts.
+    size = size or 0
+    if encoding and encoding.lower() == 'base64':
+        return size * 3 // 4
+    return size
+
+
+class MessageSkeleton(object):
+    """
+    The FETCH items needed to reassemble a message without its attachments,
+    computed from its BODYSTRUCTURE.
+
+    Attributes
+    ----------
+    fetch_items : list
+        FETCH items to request, besides BODY.PEEK[HEADER].
+    deferred_sections : dict
+        Maps the IMAP section of each part left out to its approximate
+        decoded size.
+
+    Raises
+    ------
+    UnsupportedStructure
+        If the message must be downloaded in full: if it isn't multipart,
+        if it encapsulates other messages or if boundaries are missing.
+
+    """
+
+    def __init__(self, bodystructure):
+        if not _is_multipart(bodystructure):
+            raise UnsupportedStructure('Not a multipart message')
+        self.bodystructure = bodystructure
+        self.text_sections = []
+        self.mime_sections = []
+        self.deferred_sections = {}
+        self._plan(bodystructure, '')
+
+    @property
+    def fetch_items(self):
+        return (['BODY.PEEK[{}.MIME]'.format(s) for s in self.mime_sections] +
+                ['BODY.PEEK[{}]'.format(s) for s in self.text_sections])
+
+    def _plan(self, structure, section):
+        if not _params(structure[2]).get('boundary'):
+            raise UnsupportedStructure('Missing boundary')
+        for i, child in enumerate(structure[0], 1):
+            child_section = '{}.{}'.format(section, i) if section else str(i)
+            self.mime_sections.append(child_section)
+            if _is_multipart(child):
+                self._plan(child, child_section)
+                continue
+            maintype = child[0].lower()
+            if maintype == 'message':
+                raise UnsupportedStructure('Encapsulated message')
+            elif maintype == 'text':
+                self.text_sections.append(child_section)
+            else:
+                self.deferred_sections[child_section] = \
+                    _decoded_size(child[5], child[6])
+
+    def assemble(self, header, fetched):
+        """
+        Build the skeleton message.
+
+        Parameters
+        ----------
+        header : str
+            The BODY[HEADER] of the message.
+        fetched : dict
+            The FETCH response of the message for `fetch_items`.
+
+        Raises
+        ------
+        UnsupportedStructure
+            If some of the items are missing from the response.
+
+        """
+        chunks = [header]
+        self._assemble(self.bodystructure, '', fetched, chunks)
+        return ''.join(chunks)
+
+    def _assemble(self, structure, section, fetched, chunks):
+        boundary = _params(structure[2])['boundary']
+        for i, child in enumerate(structure[0], 1):
+            child_section = '{}.{}'.format(section, i) if section else str(i)
+            chunks.append('\r\n--{}\r\n'.format(boundary))
+            chunks.append(self._item(fetched, '{}.MIME'.format(child_section)))
+            if _is_multipart(child):
+                self._assemble(child, child_section, fetched, chunks)
+            elif child_section not in self.deferred_sections:
+                chunks.append(self._item(fetched, child_section))
+        chunks.append('\r\n--{}--\r\n'.format(boundary))
+
+    def _item(self, fetched, section):
+        value = fetched.get('BODY[{}]'.format(section))
+        if value is None:
+            raise UnsupportedStructure('Missing section {}'.format(section))
+        return value
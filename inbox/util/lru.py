@@ -0,0 +1,65 @@
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A bounded in-memory mapping which evicts the least recently used entries
+    first.
+
+    The cache holds at most `max_items` entries. If `sizeof` is given (e.g.
+    `len` for byte strings), the total size of the cached values is also
+    capped at `max_size`, and values larger than that are never cached.
+
+    Not thread-safe, but safe to share between greenlets since none of the
+    operations yield.
+
+    """
+
+    def __init__(self, max_items, max_size=None, sizeof=None):
+        self.max_items = max_items
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return default
+        # Re-insert to mark the entry as most recently used.
+        self._data[key] = value
+        return value
+
+    def set(self, key, value):
+        self.pop(key)
+        if self.max_items <= 0:
+            return
+        if self.sizeof is not None:
+            value_size = self.sizeof(value)
+            if self.max_size is not None and value_size > self.max_size:
+                return
+            self.size += value_size
+        self._data[key] = value
+        while (len(self._data) > self.max_items or
+               (self.max_size is not None and self.size > self.max_size)):
+            self.pop(next(iter(self._data)))
+
+    def pop(self, key, default=None):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return default
+        if self.sizeof is not None:
+            self.size -= self.sizeof(value)
+        return value
+
+    def clear(self):
+        self._data.clear()
+        self.size = 0
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,358 @@
+"""
+CPU-bound parsing of raw RFC822 messages, optionally in worker processes.
+
+parse_message() hashes a raw message, parses it with flanker and extracts
+its headers, text bodies and attachments into a compact, picklable
+ParsedMessage. Message.create_from_synced() then builds the ORM objects from
+that result.
+
+By default parsing happens inline. Sync processes can start a pool of
+worker processes with start_parser_pool(); parse_message() then ships raw
+messages to an idle worker over a pipe, so that a greenlet parsing a large
+message only blocks itself rather than every other greenlet in the process.
+
+"""
+import binascii
+import cPickle as pickle
+import os
+import struct
+import sys
+import traceback
+from collections import namedtuple
+from hashlib import sha256
+
+import gevent
+from gevent import subprocess
+from gevent.queue import Queue
+from flanker import mime
+
+from inbox.util.addr import parse_mimepart_address_header
+from nylas.logging import get_logger
+log = get_logger()
+
+# Seconds to wait for a worker to parse one message before giving up on it
+# and parsing inline instead.
+WORKER_TIMEOUT = 60
+
+_LENGTH = struct.Struct('!I')
+
+# headers: dict of the header values Message uses.
+# parts: list of ParsedPart, in MIME tree order.
+# error: if set, the message couldn't be parsed and the other fields are
+# empty.
+ParsedMessage = namedtuple('ParsedMessage',
+                           ['data_sha256', 'headers', 'parts', 'error'])
+
+# kind is one of
+# - 'html' or 'plain': a text body part, data is normalized UTF-8.
+# - 'attachment': data is the encoded payload.
+# - 'text_attachment': a text part other than plain or HTML, saved as an
+#   attachment.
+# - 'bad_disposition': a part with an unknown Content-Disposition, skipped.
+# - 'error': a part which couldn't be decoded, data is the error message.
+# section is the IMAP section (RFC 3501) of the part, e.g. '2.1', and
+# transfer_encoding its lowercased Content-Transfer-Encoding, so that the
+# part can be fetched on its own later.
+ParsedPart = namedtuple('ParsedPart',
+                        ['kind', 'data', 'content_disposition',
+                         'content_type', 'filename', 'content_id',
+                         'section', 'transfer_encoding'])
+
+
+class ParserWorkerError(Exception):
+    pass
+
+
+def parse_message(body_string):
+    """
+    Parse a raw message.
+
+    Returns
+    -------
+    (ParsedMessage, flanker.mime.message.part.MimePart or None)
+        The flanker object is only available when the message was parsed
+        inline.
+
+    """
+    if _pool is not None:
+        try:
+            return _pool.parse(body_string), None
+        except ParserWorkerError as e:
+            # Parse inline, which also surfaces any exception the worker hit.
+            log.warning('Error parsing message in worker process',
+                        error=str(e))
+    return _parse(body_string)
+
+
+def _parse(body_string):
+    data_sha256 = sha256(body_string).hexdigest()
+    try:
+        parsed = mime.from_string(body_string)
+        headers = _parse_headers(parsed)
+    except (mime.DecodingError, AttributeError, RuntimeError,
+            TypeError) as e:
+        return ParsedMessage(data_sha256, {}, [], str(e)), None
+
+    parts = []
+    for mimepart, section in _walk_sections(parsed):
+        try:
+            if mimepart.content_type.is_multipart():
+                continue  # TODO should we store relations?
+            part = _parse_mimepart(mimepart)
+            if part is not None:
+                parts.append(part._replace(
+                    section=section,
+                    transfer_encoding=_transfer_encoding(mimepart)))
+        except (mime.DecodingError, AttributeError, RuntimeError,
+                TypeError, binascii.Error, UnicodeDecodeError) as e:
+            parts.append(ParsedPart('error', str(e), None, None, None, None,
+                                    section, None))
+    return ParsedMessage(data_sha256, headers, parts, None), parsed
+
+
+def _walk_sections(parsed):
+    """
+    Yield the (mimepart, section) pairs of a parsed message, in the order of
+    parsed.walk(with_self=parsed.content_type.is_singlepart()).
+
+    """
+    if parsed.content_type.is_singlepart():
+        # A non-multipart message only has a part 1.
+        yield parsed, '1'
+        prefix = '1'
+    else:
+        prefix = ''
+    for mimepart, section in _walk_children(parsed, prefix):
+        yield mimepart, section
+
+
+def _walk_children(mimepart, section):
+    if mimepart.content_type.is_multipart():
+        for i, child in enumerate(mimepart.parts, 1):
+            child_section = '{}.{}'.format(section, i) if section else str(i)
+            yield child, child_section
+            for x in _walk_children(child, child_section):
+                yield x
+    elif mimepart.content_type.is_message_container():
+        # The parts of an encapsulated message are numbered under the
+        # message/rfc822 part; if it isn't multipart, its body is part 1.
+        enclosed = mimepart.enclosed
+        if enclosed.content_type.is_multipart():
+            yield enclosed, section
+        else:
+            yield enclosed, '{}.1'.format(section)
+        for x in _walk_children(enclosed, section):
+            yield x
+
+
+def _transfer_encoding(mimepart):
+    encoding = mimepart.headers.get('Content-Transfer-Encoding')
+    if isinstance(encoding, tuple):
+        # Parsed with its parameters.
+        encoding = encoding[0]
+    return encoding.strip().lower() if encoding else None
+
+
+def _parse_headers(parsed):
+    headers = {
+        'mime_version': parsed.headers.get('Mime-Version'),
+        'subject': parsed.subject,
+        'in_reply_to': parsed.headers.get('In-Reply-To'),
+        'message_id_header': parsed.headers.get('Message-Id'),
+        'date': parsed.headers.get('Date'),
+        'received': parsed.headers.get('Received'),
+        # Custom Nylas header
+        'nylas_uid': parsed.headers.get('X-INBOX-ID'),
+        'references': parsed.headers.get('References', ''),
+    }
+    for field, header_name in (('from_addr', 'From'),
+                               ('sender_addr', 'Sender'),
+                               ('reply_to', 'Reply-To'),
+                               ('to_addr', 'To'),
+                               ('cc_addr', 'Cc'),
+                               ('bcc_addr', 'Bcc')):
+        headers[field] = parse_mimepart_address_header(parsed, header_name)
+    return headers
+
+
+def _parse_mimepart(mimepart):
+    disposition, _ = mimepart.content_disposition
+    content_id = mimepart.headers.get('Content-Id')
+    content_type, params = mimepart.content_type
+
+    filename = mimepart.detected_file_name
+    if filename == '':
+        filename = None
+
+    data = mimepart.body
+
+    is_text = content_type.startswith('text')
+    if disposition not in (None, 'inline', 'attachment'):
+        return ParsedPart('bad_disposition', None,
+                          mimepart.content_disposition, content_type,
+                          filename, content_id, None, None)
+
+    if disposition == 'attachment':
+        return _attachment('attachment', data, disposition, content_type,
+                           filename, content_id)
+
+    if (disposition == 'inline' and
+            not (is_text and filename is None and content_id is None)):
+        # Some clients set Content-Disposition: inline on text MIME parts
+        # that we really want to treat as part of the text body. Don't
+        # treat those as attachments.
+        return _attachment('attachment', data, disposition, content_type,
+                           filename, content_id)
+
+    if is_text:
+        if data is None:
+            return None
+        normalized_data = data.encode('utf-8', 'strict')
+        normalized_data = normalized_data.replace('\r\n', '\n'). \
+            replace('\r', '\n')
+        if content_type == 'text/html':
+            return ParsedPart('html', normalized_data, None, content_type,
+                              None, None, None, None)
+        elif content_type == 'text/plain':
+            return ParsedPart('plain', normalized_data, None, content_type,
+                              None, None, None, None)
+        return _attachment('text_attachment', data, 'attachment',
+                           content_type, filename, content_id)
+
+    # Finally, if we get a non-text MIME part without Content-Disposition,
+    # treat it as an attachment.
+    return _attachment('attachment', data, 'attachment', content_type,
+                       filename, content_id)
+
+
+def _attachment(kind, data, content_disposition, content_type, filename,
+                content_id):
+    data = data or ''
+    if isinstance(data, unicode):
+        data = data.encode('utf-8', 'strict')
+    return ParsedPart(kind, data, content_disposition, content_type,
+                      filename, content_id, None, None)
+
+
+def _write_frame(f, obj):
+    payload = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    f.write(_LENGTH.pack(len(payload)))
+    f.write(payload)
+    f.flush()
+
+
+def _read_frame(f):
+    header = _read_exactly(f, _LENGTH.size)
+    if header is None:
+        return None
+    length, = _LENGTH.unpack(header)
+    payload = _read_exactly(f, length)
+    if payload is None:
+        raise EOFError('Truncated frame')
+    return pickle.loads(payload)
+
+
+def _read_exactly(f, size):
+    chunks = []
+    while size > 0:
+        chunk = f.read(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+class ParserPool(object):
+    """
+    A fixed number of parser worker processes, each handling one message at
+    a time. Workers are started lazily and restarted if they die or time
+    out.
+
+    """
+
+    def __init__(self, size, timeout=WORKER_TIMEOUT):
+        self.size = size
+        self.timeout = timeout
+        self._idle = Queue()
+        for _ in range(size):
+            self._idle.put(None)
+
+    def parse(self, body_string):
+        worker = self._idle.get()
+        try:
+            if worker is None or worker.poll() is not None:
+                worker = self._spawn()
+            with gevent.Timeout(self.timeout, ParserWorkerError('Timed out')):
+                _write_frame(worker.stdin, body_string)
+                response = _read_frame(worker.stdout)
+        except Exception as e:
+            self._kill(worker)
+            worker = None
+            if isinstance(e, ParserWorkerError):
+                raise
+            raise ParserWorkerError(repr(e))
+        finally:
+            self._idle.put(worker)
+
+        if response is None:
+            raise ParserWorkerError('Worker exited')
+        status, result = response
+        if status != 'ok':
+            raise ParserWorkerError(result)
+        return result
+
+    def _spawn(self):
+        return subprocess.Popen(
+            [sys.executable, '-c',
+             'from inbox.util.mime_parsing import worker_main; worker_main()'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
+
+    def _kill(self, worker):
+        if worker is not None and worker.poll() is None:
+            try:
+                worker.kill()
+                worker.wait()
+            except OSError:
+                pass
+
+    def stop(self):
+        while not self._idle.empty():
+            self._kill(self._idle.get())
+
+
+def worker_main():
+    """ Entry point of a parser worker process. """
+    stdin = os.fdopen(os.dup(sys.stdin.fileno()), 'rb')
+    stdout = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    # Keep stray output (e.g. from logging) off the response pipe.
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    while True:
+        body_string = _read_frame(stdin)
+        if body_string is None:
+            # The parent went away.
+            return
+        try:
+            parsed, _ = _parse(body_string)
+            response = ('ok', parsed)
+        except Exception:
+            response = ('error', traceback.format_exc())
+        _write_frame(stdout, response)
+
+
+_pool = None
+
+
+def start_parser_pool(size):
+    global _pool
+    stop_parser_pool()
+    if size > 0:
+        _pool = ParserPool(size)
+
+
+def stop_parser_pool():
+    global _pool
+    if _pool is not None:
+        _pool.stop()
+        _pool = None
@@ -1,30 +1,94 @@
 # -*- coding: utf-8 -*-
+from collections import OrderedDict
+
+from inbox.models.message import Message
 from inbox.models.thread import Thread
-from sqlalchemy import desc
-from sqlalchemy.orm import joinedload, load_only
+from sqlalchemy import desc, func
+from sqlalchemy.orm import load_only
 from inbox.util.misc import cleanup_subject
 
 
 MAX_THREAD_LENGTH = 500
+# Only the most recent references are looked up; they're the closest
+# ancestors of the message and thus the most likely to be in the latest
+# thread of a long conversation.
+MAX_REFERENCES = 50
+# Number of most recent threads with the same subject considered when
+# falling back to matching on participants.
+MAX_SUBJECT_CANDIDATE_THREADS = 20
 
 
 def fetch_corresponding_thread(db_session, namespace_id, message):
     """fetch a thread matching the corresponding message. Returns None if
-       there's no matching thread."""
+       there's no matching thread.
+
+       Messages are first matched on their Message-Id, In-Reply-To and
+       References headers (like JWZ threading), using the
+       (namespace_id, message_id_header) index. Messages without a known
+       ancestor, or whose ancestor's thread already has MAX_THREAD_LENGTH
+       messages, fall back to a bounded lookup of recent threads with the
+       same subject and enough participants in common."""
+    thread = _fetch_thread_by_message_ids(db_session, namespace_id, message)
+    if thread is not None:
+        return thread
+    return _fetch_thread_by_participants(db_session, namespace_id, message)
+
+
+def _referenced_message_ids(message):
+    message_ids = list(message.references or [])[-MAX_REFERENCES:]
+    if message.in_reply_to:
+        message_ids.extend(message.in_reply_to.split()[:1])
+    if message.message_id_header:
+        # Another copy of the same message, e.g. in a different folder.
+        message_ids.append(message.message_id_header)
+    return set(message_ids)
+
+
+def _fetch_thread_by_message_ids(db_session, namespace_id, message):
+    message_ids = _referenced_message_ids(message)
+    if not message_ids:
+        return None
+
+    thread_id = db_session.query(Message.thread_id). \
+        filter(Message.namespace_id == namespace_id,
+               Message.message_id_header.in_(message_ids),
+               Message.thread_id.isnot(None),
+               Message.deleted_at.is_(None)). \
+        order_by(desc(Message.id)).limit(1).scalar()
+    if thread_id is None:
+        return None
+    thread_length = db_session.query(func.count(Message.id)). \
+        filter(Message.thread_id == thread_id).scalar()
+    if thread_length >= MAX_THREAD_LENGTH:
+        return None
+    return db_session.query(Thread).get(thread_id)
+
+
+def _fetch_thread_by_participants(db_session, namespace_id, message):
     # FIXME: for performance reasons, we make the assumption that a reply
     # to a message always has a similar subject. This is only
     # right 95% of the time.
     clean_subject = cleanup_subject(message.subject)
-    threads = db_session.query(Thread). \
-        filter(Thread.namespace_id == namespace_id,
-               Thread._cleaned_subject == clean_subject). \
-        order_by(desc(Thread.id)). \
-        options(load_only('id', 'discriminator'),
-                joinedload(Thread.messages).load_only(
-                    'from_addr', 'to_addr', 'bcc_addr', 'cc_addr'))
-
-    for thread in threads:
-        for match in thread.messages:
+    thread_ids = [id_ for id_, in db_session.query(Thread.id).
+                  filter(Thread.namespace_id == namespace_id,
+                         Thread._cleaned_subject == clean_subject).
+                  order_by(desc(Thread.id)).
+                  limit(MAX_SUBJECT_CANDIDATE_THREADS)]
+    if not thread_ids:
+        return None
+
+    # Load only the address columns of the candidate threads' messages,
+    # grouped by thread, most recent thread first.
+    thread_messages = OrderedDict((id_, []) for id_ in thread_ids)
+    matches = db_session.query(Message). \
+        filter(Message.thread_id.in_(thread_ids)). \
+        options(load_only('thread_id', 'from_addr', 'to_addr', 'bcc_addr',
+                          'cc_addr'))
+    for match in matches:
+        thread_messages[match.thread_id].append(match)
+
+    for thread_id, messages in thread_messages.iteritems():
+        for match in messages:
             # A lot of people BCC some address when sending mass
             # emails so ignore BCC.
             match_bcc = match.bcc_addr if match.bcc_addr else []
@@ -41,10 +105,10 @@ def fetch_corresponding_thread(db_session, namespace_id, message):
             if len(match_emails & message_emails) >= 2:
                 # No need to loop through the rest of the messages
                 # in the thread
-                if len(thread.messages) >= MAX_THREAD_LENGTH:
+                if len(messages) >= MAX_THREAD_LENGTH:
                     break
                 else:
-                    return match.thread
+                    return db_session.query(Thread).get(thread_id)
 
             # handle the case where someone is self-sending an email.
             if not message.from_addr or not message.to_addr:
@@ -60,9 +124,9 @@ def fetch_corresponding_thread(db_session, namespace_id, message):
                 # Check that we're not over max thread length in this case
                 # No need to loop through the rest of the messages
                 # in the thread.
-                if len(thread.messages) >= MAX_THREAD_LENGTH:
+                if len(messages) >= MAX_THREAD_LENGTH:
                     break
                 else:
-                    return match.thread
+                    return db_session.query(Thread).get(thread_id)
 
     return
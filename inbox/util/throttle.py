@@ -0,0 +1,234 @@
+"""
+Adaptive pacing of bulk maintenance jobs (account deletion, transaction log
+purges, garbage collection, backfills) by the health of the MySQL server
+they write to.
+
+An AdaptiveThrottle periodically samples the server through a sampler
+(MySQLHealthSampler by default): replication lag, running threads and InnoDB
+history list length, each compared to a limit. Like TCP congestion control
+(AIMD), while every signal is under its limit the job's batch size grows
+additively and the delay between batches shrinks; as soon as one is over,
+the batch size is halved and the delay doubled. Jobs thus settle at the
+highest rate the server sustains rather than alternating between full speed
+and fixed pauses.
+
+Jobs call `wait()` between batches and size their next batch with
+`batch_size`. Jobs of a process writing to the same host share its throttle,
+see throttle_for_shard(). The bulk scripts of bin/ enable throttling with
+their --throttle flag.
+
+"""
+import time
+from collections import namedtuple
+
+import gevent
+
+from inbox.config import config
+from nylas.logging import get_logger
+log = get_logger()
+
+MAX_REPLICA_LAG = config.get('THROTTLE_MAX_REPLICA_LAG', 10)
+MAX_THREADS_RUNNING = config.get('THROTTLE_MAX_THREADS_RUNNING', 32)
+MAX_HISTORY_LIST_LENGTH = config.get('THROTTLE_MAX_HISTORY_LIST_LENGTH',
+                                     500000)
+
+# None for signals which couldn't be sampled.
+HealthSample = namedtuple('HealthSample',
+                          'replica_lag threads_running history_list_length')
+
+
+class MySQLHealthSampler(object):
+    """
+    Samples a MySQL server through `engine`. Replication lag is the largest
+    Seconds_Behind_Master of the server itself and of `replica_engines`,
+    since a master doesn't know how far behind its replicas are.
+
+    """
+
+    def __init__(self, engine, replica_engines=()):
+        self.engine = engine
+        self.replica_engines = list(replica_engines)
+
+    def sample(self):
+        lags = [self._replica_lag(e)
+                for e in [self.engine] + self.replica_engines]
+        lags = [lag for lag in lags if lag is not None]
+        return HealthSample(
+            replica_lag=max(lags) if lags else None,
+            threads_running=self._scalar(
+                "SHOW GLOBAL STATUS LIKE 'Threads_running'", column=1),
+            history_list_length=self._scalar(
+                "SELECT count FROM information_schema.innodb_metrics "
+                "WHERE name = 'trx_rseg_history_len'"))
+
+    def _replica_lag(self, engine):
+        try:
+            row = engine.execute('SHOW SLAVE STATUS').first()
+        except Exception as e:
+            log.warning('Error sampling replica lag', error=str(e))
+            return None
+        if row is None:
+            # Not a replica.
+            return None
+        if row['Seconds_Behind_Master'] is None:
+            # Replication is stopped or broken: we can't tell how far behind
+            # the replica is, so assume too far.
+            return float('inf')
+        return row['Seconds_Behind_Master']
+
+    def _scalar(self, query, column=0):
+        try:
+            row = self.engine.execute(query).first()
+        except Exception as e:
+            log.warning('Error sampling MySQL status', query=query,
+                        error=str(e))
+            return None
+        if row is None or row[column] is None:
+            return None
+        return int(row[column])
+
+
+class AdaptiveThrottle(object):
+    """
+    AIMD controller of the batch size of, and delay between, the batches of
+    bulk jobs. See the module docstring.
+
+    Parameters
+    ----------
+    sampler: object
+        Has a `sample()` method returning a HealthSample.
+    sample_interval: float
+        Minimum number of seconds between two samples.
+
+    """
+
+    def __init__(self, sampler, min_batch_size=100, max_batch_size=10000,
+                 initial_batch_size=1000, batch_size_step=100,
+                 max_delay=60, delay_step=0.5, sample_interval=5,
+                 max_replica_lag=MAX_REPLICA_LAG,
+                 max_threads_running=MAX_THREADS_RUNNING,
+                 max_history_list_length=MAX_HISTORY_LIST_LENGTH):
+        self.sampler = sampler
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.batch_size = initial_batch_size
+        self.batch_size_step = batch_size_step
+        self.max_delay = max_delay
+        self.delay_step = delay_step
+        self.delay = 0
+        self.sample_interval = sample_interval
+        self.limits = HealthSample(max_replica_lag, max_threads_running,
+                                   max_history_list_length)
+        self._sampled_at = None
+
+    def is_healthy(self, sample):
+        for value, limit in zip(sample, self.limits):
+            if value is not None and value > limit:
+                return False
+        return True
+
+    def update(self, sample):
+        if self.is_healthy(sample):
+            self.batch_size = min(self.max_batch_size,
+                                  self.batch_size + self.batch_size_step)
+            self.delay = max(0, self.delay - self.delay_step)
+        else:
+            self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+            self.delay = min(self.max_delay,
+                             max(self.delay * 2, self.delay_step))
+            log.info('Throttling bulk writes', sample=sample._asdict(),
+                     batch_size=self.batch_size, delay=self.delay)
+
+    def wait(self):
+        """ Call before each batch. """
+        now = time.time()
+        if self._sampled_at is None or \
+                now - self._sampled_at >= self.sample_interval:
+            self._sampled_at = now
+            self.update(self.sampler.sample())
+        if self.delay:
+            gevent.sleep(self.delay)
+
+
+class NoThrottle(object):
+    """ Stands in for an AdaptiveThrottle when throttling is disabled. """
+
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+
+    def wait(self):
+        pass
+
+
+_throttles = {}
+
+
+def _host_for_shard(shard_id):
+    for host in config.get('DATABASE_HOSTS', []):
+        for shard in host['SHARDS']:
+            if shard['ID'] == shard_id:
+                return host
+    return None
+
+
+def _replica_engines(host, shard_id):
+    from inbox.ignition import build_uri, engine
+    users = config.get_required('DATABASE_USERS')
+    schema_name = [shard['SCHEMA_NAME'] for shard in host['SHARDS']
+                   if shard['ID'] == shard_id][0]
+    engines = []
+    for replica in host.get('REPLICAS', []):
+        user = users[replica['HOSTNAME']]
+        uri = build_uri(username=user['USER'], password=user['PASSWORD'],
+                        hostname=replica['HOSTNAME'], port=replica['PORT'],
+                        database_name=schema_name)
+        engines.append(engine(schema_name, uri, pool_size=1, max_overflow=0))
+    return engines
+
+
+def throttle_for_shard(shard_id):
+    """
+    The AdaptiveThrottle of the MySQL host of the given shard, shared by
+    every job of this process writing to that host. Replicas to sample for
+    lag can be listed in the REPLICAS (HOSTNAME, PORT) of the host's
+    DATABASE_HOSTS entry.
+
+    """
+    from inbox.ignition import engine_manager
+    host = _host_for_shard(shard_id)
+    key = (host['HOSTNAME'], host['PORT']) if host is not None else shard_id
+    if key not in _throttles:
+        replica_engines = _replica_engines(host, shard_id) \
+            if host is not None else []
+        sampler = MySQLHealthSampler(engine_manager.engines[shard_id],
+                                     replica_engines)
+        _throttles[key] = AdaptiveThrottle(sampler)
+    return _throttles[key]
+
+
+def throttle_for_id(id_):
+    """ The throttle of the shard of the given object id. """
+    from inbox.ignition import engine_manager
+    return throttle_for_shard(engine_manager.shard_key_for_id(id_))
+
+
+def get_throttle(id_, throttle, batch_size=1000):
+    """
+    throttle_for_id(id_) if `throttle`, otherwise a NoThrottle of
+    `batch_size`.
+
+    """
+    if throttle:
+        return throttle_for_id(id_)
+    return NoThrottle(batch_size)
+
+
+def get_shard_throttle(shard_id, throttle, batch_size=1000):
+    """
+    throttle_for_shard(shard_id) if `throttle`, otherwise a NoThrottle of
+    `batch_size`.
+
+    """
+    if throttle:
+        return throttle_for_shard(shard_id)
+    return NoThrottle(batch_size)
@@ -0,0 +1,90 @@
+from array import array
+from bisect import bisect_left, bisect_right
+
+
+class UidSet(object):
+    """
+    A compact set of IMAP UIDs.
+
+    UIDs are kept sorted in an array of unsigned 32-bit integers (UIDs are
+    32-bit per RFC 3501), which takes 4 bytes per UID rather than the ~60
+    bytes of a long in a Python set. Membership tests are binary searches.
+
+    Adding UIDs in ascending order, as sync does, is an append; other
+    insertions and removals shift the tail of the array.
+
+    """
+
+    def __init__(self, uids=()):
+        self._uids = array('I', sorted(set(uids)))
+
+    def __len__(self):
+        return len(self._uids)
+
+    def __iter__(self):
+        return iter(self._uids)
+
+    def __contains__(self, uid):
+        i = bisect_left(self._uids, uid)
+        return i < len(self._uids) and self._uids[i] == uid
+
+    def __eq__(self, other):
+        if isinstance(other, UidSet):
+            return self._uids == other._uids
+        return NotImplemented
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<UidSet ({} uids)>'.format(len(self))
+
+    def max(self):
+        """ The largest UID in the set, or None if it's empty. """
+        return self._uids[-1] if self._uids else None
+
+    def add(self, uid):
+        if not self._uids or uid > self._uids[-1]:
+            self._uids.append(uid)
+            return
+        i = bisect_left(self._uids, uid)
+        if i == len(self._uids) or self._uids[i] != uid:
+            self._uids.insert(i, uid)
+
+    def update(self, uids):
+        for uid in sorted(uids):
+            self.add(uid)
+
+    def discard(self, uid):
+        i = bisect_left(self._uids, uid)
+        if i < len(self._uids) and self._uids[i] == uid:
+            del self._uids[i]
+
+    def difference_update(self, uids):
+        uids = set(uids)
+        if len(uids) > 100:
+            # Rebuild rather than shift the array once per removed UID.
+            self._uids = array('I', (u for u in self._uids if u not in uids))
+        else:
+            for uid in uids:
+                self.discard(uid)
+
+    def difference(self, other):
+        """ UIDs in this set which aren't in `other`, in ascending order. """
+        return [uid for uid in self._uids if uid not in other]
+
+    def largest(self, count):
+        """ The `count` largest UIDs, in descending order. """
+        return self._uids[-count:][::-1].tolist() if count > 0 else []
+
+    def in_ranges(self, uid_ranges):
+        """
+        UIDs in this set which fall in any of the given inclusive
+        (first, last) ranges.
+
+        """
+        uids = set()
+        for first, last in uid_ranges:
+            uids.update(self._uids[bisect_left(self._uids, first):
+                                   bisect_right(self._uids, last)])
+        return uids
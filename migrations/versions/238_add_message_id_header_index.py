@@ -0,0 +1,27 @@
+"""Add index on Message.message_id_header for threading
+
+Revision ID: 4d0f5e34bd4c
+Revises: 780b1dabd51
+Create Date: 2017-03-14 18:02:11.472103
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4d0f5e34bd4c'
+down_revision = '780b1dabd51'
+
+from alembic import op
+from sqlalchemy.sql import text
+
+
+def upgrade():
+    conn = op.get_bind()
+    conn.execute(text("ALTER TABLE message"
+                      " ADD INDEX ix_message_namespace_id_message_id_header"
+                      "(namespace_id, message_id_header(191))"))
+
+
+def downgrade():
+    conn = op.get_bind()
+    conn.execute(text("ALTER TABLE message"
+                      " DROP INDEX ix_message_namespace_id_message_id_header"))
@@ -0,0 +1,59 @@
+"""add local message search index tables
+
+Revision ID: 6b1e4f9d2c07
+Revises: 4d0f5e34bd4c
+Create Date: 2017-03-20 11:24:37.104362
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6b1e4f9d2c07'
+down_revision = '4d0f5e34bd4c'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('messagesearchterm',
+                    sa.Column('created_at', sa.DateTime(), nullable=False),
+                    sa.Column('id', sa.BigInteger(), nullable=False),
+                    sa.Column('namespace_id', sa.BigInteger(), nullable=False),
+                    sa.Column('term', sa.String(length=64), nullable=False),
+                    sa.Column('message_id', sa.BigInteger(), nullable=False),
+                    sa.Column('weight', sa.Integer(), nullable=False),
+                    sa.ForeignKeyConstraint(['message_id'], [u'message.id'],
+                                            ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    op.create_index('ix_messagesearchterm_created_at',
+                    'messagesearchterm', ['created_at'], unique=False)
+    op.create_index('ix_messagesearchterm_namespace_id_term_message_id',
+                    'messagesearchterm',
+                    ['namespace_id', 'term', 'message_id'], unique=True)
+
+    op.create_table('messagesearchindexcursor',
+                    sa.Column('created_at', sa.DateTime(), nullable=False),
+                    sa.Column('updated_at', sa.DateTime(), nullable=False),
+                    sa.Column('deleted_at', sa.DateTime(), nullable=True),
+                    sa.Column('id', sa.BigInteger(), nullable=False),
+                    sa.Column('transaction_id', sa.BigInteger(),
+                              nullable=True),
+                    sa.ForeignKeyConstraint(['transaction_id'],
+                                            [u'transaction.id'], ),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    op.create_index('ix_messagesearchindexcursor_created_at',
+                    'messagesearchindexcursor', ['created_at'], unique=False)
+    op.create_index('ix_messagesearchindexcursor_deleted_at',
+                    'messagesearchindexcursor', ['deleted_at'], unique=False)
+    op.create_index('ix_messagesearchindexcursor_transaction_id',
+                    'messagesearchindexcursor', ['transaction_id'],
+                    unique=False)
+    op.create_index('ix_messagesearchindexcursor_updated_at',
+                    'messagesearchindexcursor', ['updated_at'], unique=False)
+
+
+def downgrade():
+    op.drop_table('messagesearchindexcursor')
+    op.drop_table('messagesearchterm')
@@ -0,0 +1,33 @@
+"""add incrementally maintained contact score state
+
+Revision ID: 2a7b9c3e51d4
+Revises: 6b1e4f9d2c07
+Create Date: 2017-03-28 15:02:41.512037
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2a7b9c3e51d4'
+down_revision = '6b1e4f9d2c07'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+def upgrade():
+    op.add_column('dataprocessingcache',
+                  sa.Column('contact_score_state', mysql.MEDIUMBLOB(),
+                            nullable=True))
+    op.add_column('dataprocessingcache',
+                  sa.Column('contact_score_state_message_id', sa.BigInteger(),
+                            nullable=True))
+    op.add_column('dataprocessingcache',
+                  sa.Column('contact_score_state_rebuilt_at', sa.DateTime(),
+                            nullable=True))
+
+
+def downgrade():
+    op.drop_column('dataprocessingcache', 'contact_score_state_rebuilt_at')
+    op.drop_column('dataprocessingcache', 'contact_score_state_message_id')
+    op.drop_column('dataprocessingcache', 'contact_score_state')
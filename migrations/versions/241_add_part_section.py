@@ -0,0 +1,26 @@
+"""add IMAP section and transfer encoding to parts
+
+Revision ID: 5e3a8d1c0f29
+Revises: 2a7b9c3e51d4
+Create Date: 2017-04-03 10:41:18.220364
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5e3a8d1c0f29'
+down_revision = '2a7b9c3e51d4'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('part', sa.Column('section', sa.String(length=64),
+                                    nullable=True))
+    op.add_column('part', sa.Column('transfer_encoding',
+                                    sa.String(length=32), nullable=True))
+
+
+def downgrade():
+    op.drop_column('part', 'transfer_encoding')
+    op.drop_column('part', 'section')
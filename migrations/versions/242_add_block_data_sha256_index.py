@@ -0,0 +1,22 @@
+"""add data_sha256 index to blocks
+
+Revision ID: 7c1e4b2a9f83
+Revises: 5e3a8d1c0f29
+Create Date: 2017-04-10 16:22:47.531908
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7c1e4b2a9f83'
+down_revision = '5e3a8d1c0f29'
+
+from alembic import op
+
+
+def upgrade():
+    op.create_index('ix_block_data_sha256', 'block', ['data_sha256'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_block_data_sha256', table_name='block')
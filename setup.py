@@ -43,12 +43,16 @@ setup(
              'bin/contact-search-service',
              'bin/contact-search-backfill',
              'bin/contact-search-delete-index',
+             'bin/message-search-service',
+             'bin/message-search-backfill',
+             'bin/contact-scores-service',
              'bin/backfix-generic-imap-separators.py',
              'bin/backfix-duplicate-categories.py',
              'bin/correct-autoincrements',
              'bin/update-categories',
              'bin/detect-missing-sync-host',
              'bin/purge-transaction-log',
+             'bin/blockstore-gc',
              'bin/mysql-prompt',
              'bin/unschedule-account-syncs',
              'bin/syncback-stats',